@@ -0,0 +1,73 @@
+"""Measure the cost of turning a Payload into a MongoDB document.
+
+Compares `dataclasses.asdict`, which deep-copies the message, with
+`Payload.asdict`, for several message sizes. Allocations are measured with
+tracemalloc and latencies with timeit.
+
+Usage::
+
+    python benchmarks/payload.py --runs 1000
+"""
+import argparse
+import dataclasses
+import json
+import sys
+import timeit
+import tracemalloc
+
+import pendulum
+
+from payler.structs import Payload
+
+
+def build_messages() -> dict:
+    """Return sample messages by name."""
+    return {
+        'bytes-1KB': b'x' * 1024,
+        'bytes-256KB': b'x' * 256 * 1024,
+        'dict-256KB': {'items': [{'id': index, 'data': 'x' * 240} for index in range(1024)]},
+    }
+
+
+def allocated(function, runs: int) -> float:
+    """Return the bytes allocated per call of `function`, kept alive meanwhile."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [function() for _ in range(runs)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / runs
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, message in build_messages().items():
+        payload = Payload(message, pendulum.now(), 'source', 'destination')
+        strategies = {
+            'dataclasses.asdict': lambda: dataclasses.asdict(payload),  # pylint: disable=cell-var-from-loop
+            'Payload.asdict': payload.asdict,
+        }
+        results[name] = {
+            strategy: {
+                'bytes_per_payload': round(allocated(function, args.runs)),
+                'us_per_payload': round(
+                    timeit.timeit(function, number=args.runs) / args.runs * 1e6,
+                    2,
+                ),
+            }
+            for strategy, function in strategies.items()
+        }
+    results['payload_size'] = {
+        'bytes': sys.getsizeof(Payload(b'', pendulum.now(), 'source', 'destination')),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Measure the cold start of the payler entrypoints.
+
+Every sample runs in a fresh interpreter, so that no module is cached.
+
+Usage::
+
+    python benchmarks/startup.py --runs 20
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+TARGETS = {
+    'import': 'import payler.client',
+    'event_loop': (
+        'from payler import client, config, utils; '
+        'utils.install_event_loop_policy(config.get("EVENT_LOOP"))'
+    ),
+    'drivers': 'import payler.client, payler.broker, payler.db, payler.process',
+}
+
+
+def sample(statement: str) -> float:
+    """Return the time in seconds spent running `statement` in a new interpreter."""
+    code = (
+        'import time; start = time.perf_counter(); '
+        f'{statement}; '
+        'print(time.perf_counter() - start)'
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    """Run the startup benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in TARGETS.items():
+        durations = sorted(sample(statement) for _ in range(args.runs))
+        results[name] = {
+            'runs': args.runs,
+            'median_ms': round(statistics.median(durations) * 1000, 2),
+            'min_ms': round(durations[0] * 1000, 2),
+            'max_ms': round(durations[-1] * 1000, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
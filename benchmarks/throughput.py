@@ -0,0 +1,319 @@
+"""Measure the end-to-end throughput and re-injection lateness of payler.
+
+`client.process_queue` and `client.watch_storage` run together on one event
+loop, either against the RabbitMQ and MongoDB servers of `BROKER_URL` and
+`MONGODB_URL` (`--mode services`) or against an in-memory broker and an SQLite
+spool (`--mode fake`). `auto` uses the services when they are reachable.
+
+Every scenario (payload size, delay distribution, backlog depth) publishes its
+backlog at once and runs in a fresh interpreter, so that its peak RSS is its
+own. Lateness is measured from the publication time plus the requested delay.
+Logs below WARNING are disabled.
+
+Usage::
+
+    python benchmarks/throughput.py --sizes 128 16384 --delays none uniform \\
+        --backlogs 1000 10000 --output results.json
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import random
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from payler import client, config, runtime
+from payler.driver import BaseDriver, DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.structs import Payload
+
+
+INPUT_QUEUE = 'payler-jobs'
+OUTPUT_QUEUE = 'payler-benchmark'
+DELAYS = ('none', 'fixed', 'uniform', 'exponential')
+
+# Queues of the in-memory broker, by routing key
+QUEUES = collections.defaultdict(asyncio.Queue)  # type: typing.DefaultDict[str, asyncio.Queue]
+
+# Body prefix holding the due timestamp of a message
+DUE = struct.Struct('!d')
+
+
+class FakeMessage:
+    """In-memory stand-in for an aio_pika incoming message."""
+
+    def __init__(self, body: bytes, headers: dict):
+        self.body = body
+        self.headers = headers
+
+    async def ack(self, **kwargs):
+        """Nothing to acknowledge in memory."""
+
+    async def nack(self, **kwargs):
+        """Nothing to acknowledge in memory."""
+
+    async def reject(self, **kwargs):
+        """Nothing to acknowledge in memory."""
+
+
+class MemoryBroker(BaseDriver):
+    """Broker driver publishing to and consuming from in-process queues."""
+    DEFAULTS = {
+        'queue_name': INPUT_QUEUE,
+        'routing_key': 'payloads',
+    }
+
+    def __init__(self, configuration: DriverConfiguration):
+        super().__init__(configuration)
+        self.queue_name = configuration.extra.get('queue_name', self.DEFAULTS['queue_name'])
+
+    async def setup(self, **kwargs) -> typing.Any:
+        """Nothing to declare in memory."""
+        return None
+
+    async def is_reachable(self) -> bool:
+        """The queues are always available."""
+        return True
+
+    async def process(self, payload: Payload, **kwargs) -> Result:
+        """Publish the message along its publication time."""
+        routing = kwargs.get('routing_key', self.DEFAULTS['routing_key'])
+        QUEUES[routing].put_nowait((time.time(), payload.message))
+        return Result(success=True, headers={}, payload=payload, data=None)
+
+    async def listen(self, **kwargs):
+        """Apply the action to the messages of `queue_name`."""
+        queue = QUEUES[self.queue_name]
+        while True:
+            message = await queue.get()
+            try:
+                await self.action(message, self.driver)
+            except ProcessingError as err:
+                self.logger.error('Could not process reason=%s', err)
+
+
+def build_body(size: int, due: float) -> bytes:
+    """Return a message of `size` bytes starting with its due timestamp."""
+    return DUE.pack(due) + b'x' * max(0, size - DUE.size)
+
+
+def build_delays(distribution: str, count: int, delay: int) -> typing.List[int]:
+    """Return `count` delays in milliseconds following `distribution`."""
+    if distribution == 'none':
+        return [0] * count
+    if distribution == 'fixed':
+        return [delay] * count
+    if distribution == 'uniform':
+        return [random.randint(0, 2 * delay) for _ in range(count)]
+    return [int(random.expovariate(1 / delay)) for _ in range(count)]
+
+
+def percentile(values: typing.List[float], ratio: float) -> float:
+    """Return the nearest-rank percentile of sorted `values`."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+async def publish_fake(messages: typing.List[typing.Tuple[bytes, int]]):
+    """Publish `(body, delay)` messages to the in-memory input queue."""
+    for body, delay in messages:
+        headers = {'x-delay': delay, 'x-destination': OUTPUT_QUEUE}
+        QUEUES[INPUT_QUEUE].put_nowait(FakeMessage(body, headers))
+
+
+async def receive_fake(count: int) -> typing.AsyncIterator[typing.Tuple[float, bytes]]:
+    """Yield `count` re-injected messages along their publication time."""
+    queue = QUEUES[OUTPUT_QUEUE]
+    for _ in range(count):
+        yield await queue.get()
+
+
+def fake_workflows(directory: str) -> typing.Dict[str, dict]:
+    """Return the workflow options using the in-memory broker and an SQLite spool."""
+    runtime.DRIVERS['memory'] = (__name__, 'MemoryBroker', None)
+    spool = {'driver': 'sqlite', 'url': f'sqlite:///{directory}/spool.db', 'commit_interval': 1}
+    return {
+        'process_queue': {'input': {'driver': 'memory'}, 'output': spool},
+        'watch_storage': {'input': dict(spool, sleep_duration=1), 'output': {'driver': 'memory'}},
+    }
+
+
+async def prepare_services():
+    """Purge the benchmark queues and collection."""
+    import aio_pika  # pylint: disable=import-outside-toplevel
+    import motor.motor_asyncio  # pylint: disable=import-outside-toplevel
+
+    mongo = motor.motor_asyncio.AsyncIOMotorClient(config.get('MONGODB_URL'))
+    await mongo.get_default_database().drop_collection('benchmark')
+    connection = await aio_pika.connect(config.get('BROKER_URL'))
+    async with connection:
+        channel = await connection.channel()
+        for name in (INPUT_QUEUE, OUTPUT_QUEUE):
+            queue = await channel.declare_queue(name)
+            await queue.purge()
+
+
+async def publish_services(messages: typing.List[typing.Tuple[bytes, int]]):
+    """Publish `(body, delay)` messages to the RabbitMQ input queue."""
+    import aio_pika  # pylint: disable=import-outside-toplevel
+
+    connection = await aio_pika.connect(config.get('BROKER_URL'))
+    async with connection:
+        channel = await connection.channel()
+        for body, delay in messages:
+            await channel.default_exchange.publish(
+                aio_pika.Message(body, headers={'x-delay': delay, 'x-destination': OUTPUT_QUEUE}),
+                routing_key=INPUT_QUEUE,
+            )
+
+
+async def receive_services(count: int) -> typing.AsyncIterator[typing.Tuple[float, bytes]]:
+    """Yield `count` re-injected messages along their reception time."""
+    import aio_pika  # pylint: disable=import-outside-toplevel
+
+    connection = await aio_pika.connect(config.get('BROKER_URL'))
+    async with connection:
+        channel = await connection.channel()
+        queue = await channel.declare_queue(OUTPUT_QUEUE)
+        received = 0
+        async with queue.iterator(no_ack=True) as queue_iter:
+            async for message in queue_iter:
+                yield time.time(), message.body
+                received += 1
+                if received >= count:
+                    return
+
+
+def service_workflows() -> typing.Dict[str, dict]:
+    """Return the workflow options using RabbitMQ and a MongoDB spool."""
+    spool = {'driver': 'mongodb', 'spool_collection': 'benchmark'}
+    return {
+        'process_queue': {'output': spool},
+        'watch_storage': {'input': dict(spool, sleep_duration=1)},
+    }
+
+
+async def services_available() -> bool:
+    """Tell whether the RabbitMQ and MongoDB servers are reachable."""
+    try:
+        await asyncio.wait_for(prepare_services(), timeout=5)
+    except Exception:  # pylint: disable=broad-except
+        return False
+    return True
+
+
+async def run_scenario(scenario: dict) -> dict:
+    """Run a single scenario and return its results."""
+    count = scenario['backlog']
+    delays = build_delays(scenario['delay'], count, scenario['delay_ms'])
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        if scenario['mode'] == 'fake':
+            workflows, publish, receive = fake_workflows(directory), publish_fake, receive_fake
+        else:
+            await prepare_services()
+            workflows, publish, receive = service_workflows(), publish_services, receive_services
+        tasks = [
+            asyncio.ensure_future(getattr(client, name)(loop, workflow=name, **kwargs))
+            for name, kwargs in workflows.items()
+        ]
+        start = time.time()
+        await publish([
+            (build_body(scenario['size'], start + delay / 1000), delay) for delay in delays
+        ])
+        lateness = []
+        last = start
+
+        async def collect():
+            nonlocal last
+            async for received_at, body in receive(count):
+                lateness.append(received_at - DUE.unpack_from(body)[0])
+                last = received_at
+
+        try:
+            await asyncio.wait_for(collect(), timeout=scenario['timeout'])
+        except asyncio.TimeoutError:
+            pass
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    lateness.sort()
+    return dict(
+        scenario,
+        received=len(lateness),
+        duration_s=round(last - start, 3),
+        msgs_per_s=round(len(lateness) / (last - start), 1) if last > start else None,
+        lateness_p50_ms=round(percentile(lateness, 0.5) * 1000, 2),
+        lateness_p99_ms=round(percentile(lateness, 0.99) * 1000, 2),
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+
+
+def run_isolated(scenario: dict) -> dict:
+    """Run `scenario` in a new interpreter and return its results."""
+    output = subprocess.run(
+        [sys.executable, __file__, '--scenario', json.dumps(scenario)],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(output.stdout)
+
+
+def main():
+    """Run the scenarios and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('auto', 'fake', 'services'), default='auto')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 16384])
+    parser.add_argument('--delays', choices=DELAYS, nargs='+', default=['none', 'uniform'])
+    parser.add_argument('--delay-ms', type=int, default=1000)
+    parser.add_argument('--backlogs', type=int, nargs='+', default=[1000])
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--output', help='File to save the results in')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    if args.scenario:
+        print(json.dumps(asyncio.get_event_loop().run_until_complete(
+            run_scenario(json.loads(args.scenario)),
+        )))
+        return
+
+    mode = args.mode
+    if mode == 'auto':
+        available = asyncio.get_event_loop().run_until_complete(services_available())
+        mode = 'services' if available else 'fake'
+    results = {
+        'mode': mode,
+        'python': sys.version.split()[0],
+        'scenarios': [
+            run_isolated({
+                'mode': mode,
+                'size': size,
+                'delay': delay,
+                'delay_ms': args.delay_ms,
+                'backlog': backlog,
+                'timeout': args.timeout,
+            })
+            for size, delay, backlog in itertools.product(args.sizes, args.delays, args.backlogs)
+        ],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as results_file:
+            results_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
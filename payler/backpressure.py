@@ -0,0 +1,192 @@
+"""Backpressure shared by the workflows of an event loop.
+
+The controller periodically samples the spool depth, reported by the storage
+drivers, and the mean storage write and broker publish latencies, read from
+the `payler.metrics` histograms, aggregated over the worker processes when
+running replicas. The highest ratio of a signal to its
+threshold is the pressure:
+
+- from 1, consumers are `throttled` to `throttled_prefetch` messages
+- from `pause_ratio`, consumers are `paused`
+- consumers only go back to a lower state once the pressure drops below
+  `resume_ratio` times the threshold of their current state.
+
+A threshold set to 0 disables its signal.
+"""
+import asyncio
+import logging
+import typing
+
+from payler.logs import build_logger
+from payler.metrics import (
+    BACKPRESSURE_PRESSURE,
+    BACKPRESSURE_STATE,
+    INSERT_LATENCY,
+    PUBLISH_LATENCY,
+    SPOOL_DEPTH,
+    multiprocess_registry,
+)
+
+
+STATE_OPEN = 'open'
+STATE_THROTTLED = 'throttled'
+STATE_PAUSED = 'paused'
+
+# States by increasing pressure, their index being exposed as a metric
+STATES = (STATE_OPEN, STATE_THROTTLED, STATE_PAUSED)
+
+# Factor applied to a mean latency at every tick without a new observation
+IDLE_DECAY = 0.5
+
+
+class BackpressureController:  # pylint: disable=too-many-instance-attributes
+    """Throttle or pause the consumers when the spool is under pressure."""
+    DEFAULTS = {
+        'interval': 1.0,
+        'max_depth': 0,
+        'max_write_latency': 0.5,
+        'max_publish_latency': 0.5,
+        'pause_ratio': 2.0,
+        'resume_ratio': 0.8,
+        'throttled_prefetch': 10,
+    }
+
+    def __init__(self, options: typing.Optional[dict] = None,
+                 logger: typing.Optional[logging.Logger] = None):
+        options = options or {}
+        self.logger = logger or build_logger(self.__class__.__name__)
+        self.interval = float(options.get('interval', self.DEFAULTS['interval']))
+        self.max_depth = int(options.get('max_depth', self.DEFAULTS['max_depth']))
+        self.max_write_latency = float(options.get(
+            'max_write_latency',
+            self.DEFAULTS['max_write_latency'],
+        ))
+        self.max_publish_latency = float(options.get(
+            'max_publish_latency',
+            self.DEFAULTS['max_publish_latency'],
+        ))
+        self.pause_ratio = float(options.get('pause_ratio', self.DEFAULTS['pause_ratio']))
+        self.resume_ratio = float(options.get('resume_ratio', self.DEFAULTS['resume_ratio']))
+        self.throttled_prefetch = int(options.get(
+            'throttled_prefetch',
+            self.DEFAULTS['throttled_prefetch'],
+        ))
+        self.state = STATE_OPEN
+        self.consumers = []  # type: typing.List[typing.Any]
+        self.probes = []  # type: typing.List[typing.Callable[[], typing.Awaitable[int]]]
+        # sum, count and mean of the latency histograms at the previous tick
+        self._totals = {}  # type: typing.Dict[str, typing.Tuple[float, float, float]]
+        # histograms of every worker process, when running replicas
+        self._registry = multiprocess_registry()
+        self._task = None  # type: typing.Optional[asyncio.Future]
+
+    def register(self, consumer: typing.Any = None,
+                 probe: typing.Optional[typing.Callable[[], typing.Awaitable[int]]] = None):
+        """Register a consumer to throttle and a spool depth probe, then start sampling.
+
+        Consumers implement `apply_pressure(state, prefetch_count)`.
+        """
+        if consumer is not None:
+            self.consumers.append(consumer)
+        if probe is not None:
+            self.probes.append(probe)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    def _collect(self, histogram: typing.Any) -> typing.List[typing.Any]:
+        """Return the metrics of `histogram`, observed by all the worker processes."""
+        if self._registry is None:
+            return histogram.collect()
+        name = histogram.describe()[0].name
+        return [metric for metric in self._registry.collect() if metric.name == name]
+
+    def _mean_latency(self, histogram: typing.Any) -> float:
+        """Return the mean latency observed by `histogram` since the previous call.
+
+        Without any observation since then, as when the consumers are paused,
+        the previous mean is kept, decayed by `IDLE_DECAY`: the consumers then
+        resume through the hysteresis rather than at once, and a pause caused
+        by the latency cannot last forever.
+        """
+        total = count = 0.0
+        name = histogram.describe()[0].name
+        for metric in self._collect(histogram):
+            for sample in metric.samples:
+                if sample.name.endswith('_sum'):
+                    total += sample.value
+                elif sample.name.endswith('_count'):
+                    count += sample.value
+        last_total, last_count, mean = self._totals.get(name, (0.0, 0.0, 0.0))
+        if count > last_count:
+            mean = (total - last_total) / (count - last_count)
+        else:
+            mean *= IDLE_DECAY
+        self._totals[name] = (total, count, mean)
+        return mean
+
+    async def _depth(self) -> int:
+        """Return the deepest spool, workflows sharing a storage reporting it twice."""
+        depths = await asyncio.gather(*(probe() for probe in self.probes))
+        return max(depths, default=0)
+
+    def pressure(self, depth: int, write_latency: float, publish_latency: float) -> float:
+        """Return the highest ratio of a signal to its threshold."""
+        ratios = [
+            value / threshold
+            for value, threshold in (
+                (depth, self.max_depth),
+                (write_latency, self.max_write_latency),
+                (publish_latency, self.max_publish_latency),
+            )
+            if threshold
+        ]
+        return max(ratios, default=0.0)
+
+    def next_state(self, pressure: float) -> str:
+        """Return the state matching `pressure`, lowering it with hysteresis."""
+        state = STATE_OPEN
+        if pressure >= self.pause_ratio:
+            state = STATE_PAUSED
+        elif pressure >= 1:
+            state = STATE_THROTTLED
+        current = STATES.index(self.state)
+        if STATES.index(state) >= current:
+            return state
+        threshold = self.pause_ratio if self.state == STATE_PAUSED else 1
+        if pressure < self.resume_ratio * threshold:
+            return state
+        return self.state
+
+    async def tick(self) -> str:
+        """Sample the signals, update the state and apply it to the consumers."""
+        depth = await self._depth()
+        pressure = self.pressure(
+            depth,
+            self._mean_latency(INSERT_LATENCY),
+            self._mean_latency(PUBLISH_LATENCY),
+        )
+        state = self.next_state(pressure)
+        SPOOL_DEPTH.set(depth)
+        BACKPRESSURE_PRESSURE.set(pressure)
+        BACKPRESSURE_STATE.set(STATES.index(state))
+        if state != self.state:
+            self.logger.warning(
+                'Backpressure going from %s to %s with pressure=%.2f depth=%d',
+                self.state,
+                state,
+                pressure,
+                depth,
+            )
+            self.state = state
+        for consumer in self.consumers:
+            await consumer.apply_pressure(state, self.throttled_prefetch)
+        return state
+
+    async def run(self):
+        """Sample the signals every `interval` seconds."""
+        while True:
+            try:
+                await self.tick()
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.error('Could not sample backpressure signals: %s', err)
+            await asyncio.sleep(self.interval)
@@ -1,24 +1,152 @@
 """Broker-related utilities."""
+import asyncio
+import collections
+from contextlib import asynccontextmanager
+import typing
+
 import aio_pika
+from aiormq.exceptions import DeliveryError
 
+from payler import utils
+from payler.backpressure import STATE_OPEN, STATE_PAUSED
 from payler.driver import BaseDriver, DriverConfiguration, Result
 from payler.errors import ProcessingError
-from payler.logs import build_logger
+from payler.logs import SAMPLED, build_logger
+from payler.metrics import PUBLISH_LATENCY
+from payler.ratelimit import RateLimiter
 from payler.structs import Payload
 
 
-class BrokerManager(BaseDriver):
+class ChannelPool:
+    """Bounded pool of long-lived channels used to publish messages.
+
+    Channels are opened lazily up to `size`, checked when borrowed and
+    re-created when found closed. A reconnection of the underlying
+    `RobustConnection` invalidates every channel opened before it.
+    """
+
+    def __init__(self, connection: aio_pika.RobustConnection, size: int):
+        self.connection = connection
+        self.size = size
+        self.created = 0
+        self._idle = collections.deque()  # type: typing.Deque[aio_pika.Channel]
+        # notified whenever a channel is checked in or a slot is freed
+        self._available = asyncio.Condition()
+        self._generation = 0
+
+    async def _checkout(self, shared: bool = False) -> aio_pika.Channel:
+        async with self._available:
+            while True:
+                if (shared or not self._idle) and self.created < self.size:
+                    self.created += 1
+                    break
+                if self._idle:
+                    channel = self._idle.popleft()
+                    if not channel.is_closed:
+                        return channel
+                    self.created -= 1
+                    continue
+                await self._available.wait()
+        try:
+            return await self.connection.channel()
+        except Exception:
+            async with self._available:
+                self.created -= 1
+                self._available.notify()
+            raise
+
+    def _discard(self, channel: aio_pika.Channel):
+        self.created -= 1
+        if not channel.is_closed:
+            asyncio.ensure_future(channel.close())
+
+    async def _checkin(self, channel: aio_pika.Channel, generation: int):
+        async with self._available:
+            if channel.is_closed or generation != self._generation:
+                # frees a slot for the borrowers waiting on a full pool
+                self._discard(channel)
+            else:
+                self._idle.append(channel)
+            self._available.notify()
+
+    @asynccontextmanager
+    async def acquire(self, shared: bool = False) -> typing.AsyncIterator[aio_pika.Channel]:
+        """Borrow a healthy channel and give it back once done.
+
+        A `shared` channel is handed back to the pool right away, so that
+        concurrent publishers can pipeline their messages on the same channels.
+        Borrowers wait for a channel to be given back, or discarded, when the
+        pool is full.
+        """
+        generation = self._generation
+        channel = await self._checkout(shared)
+        if shared:
+            await self._checkin(channel, generation)
+            yield channel
+            return
+        try:
+            yield channel
+        finally:
+            await self._checkin(channel, generation)
+
+    def invalidate(self, *_args, **_kwargs):
+        """Drop every pooled channel, used as a reconnect callback."""
+        self._generation += 1
+        while self._idle:
+            self._discard(self._idle.popleft())
+
+    async def close(self):
+        """Close the idle channels."""
+        while self._idle:
+            channel = self._idle.popleft()
+            self.created -= 1
+            if not channel.is_closed:
+                await channel.close()
+
+
+class BrokerManager(BaseDriver):  # pylint: disable=too-many-instance-attributes
     """Service to fetch and re-inject payloads."""
     # NOTE: Maybe bind queue to exchange + routing key in configure ?
     DEFAULTS = {
         'routing_key': 'payloads',
         'queue_name': 'payler-jobs',
+        'channel_pool_size': 4,
+        'batch_size': 1,
+        'batch_timeout': 100,
+        'prefetch_count': 0,
+        'max_concurrency': 1,
+        'rate': 0,
+        'burst': 1,
+        'jitter': 0,
+        'rate_limits': {},
     }
 
     def __init__(self, config: DriverConfiguration):
         super().__init__(config)
         self.connection: aio_pika.RobustConnection
         self.queue: aio_pika.Queue
+        self.channel_pool: ChannelPool
+        self.batch_size = int(config.extra.get('batch_size', self.DEFAULTS['batch_size']))
+        self.batch_timeout = float(config.extra.get(
+            'batch_timeout',
+            self.DEFAULTS['batch_timeout'],
+        ))
+        self.prefetch_count = int(config.extra.get(
+            'prefetch_count',
+            self.DEFAULTS['prefetch_count'],
+        ))
+        self.max_concurrency = int(config.extra.get(
+            'max_concurrency',
+            self.DEFAULTS['max_concurrency'],
+        ))
+        self.rate_limiter = RateLimiter(
+            {key: config.extra.get(key, self.DEFAULTS[key]) for key in ('rate', 'burst', 'jitter')},
+            config.extra.get('rate_limits', self.DEFAULTS['rate_limits']),
+            self.workflow,
+        )
+        self.channel = None  # type: typing.Optional[aio_pika.Channel]
+        self._applied_prefetch = self.prefetch_count
+        self._resumed = None  # type: typing.Optional[asyncio.Event]
 
     @classmethod
     async def create(cls, configuration: DriverConfiguration):
@@ -31,6 +159,14 @@ class BrokerManager(BaseDriver):
             configuration.url,
             loop=configuration.loop,
         )
+        pool_size = configuration.extra.get(
+            'channel_pool_size',
+            cls.DEFAULTS['channel_pool_size'],
+        )
+        broker_manager.channel_pool = ChannelPool(broker_manager.connection, int(pool_size))
+        broker_manager.connection.reconnect_callbacks.add(
+            broker_manager.channel_pool.invalidate,
+        )
         return broker_manager
 
     async def is_reachable(self) -> bool:
@@ -39,30 +175,66 @@ class BrokerManager(BaseDriver):
         return result is None
 
     async def process(self, payload: Payload, **kwargs) -> Result:
-        """Send a Payload to self.routing_key."""
+        """Send a Payload to self.routing_key.
+
+        Using `confirm=True`, the payload is published on a shared channel
+        and the Result is only successful once the broker acknowledged it.
+
+        Publications are delayed up to `jitter` milliseconds past the payload
+        `reference_date`, so that late payloads are sent at once, and limited to
+        `rate` per second by bursts of `burst`, which `rate_limits` overrides
+        by routing key (see `payler.ratelimit`). A payload over the limit is
+        not published: the unsuccessful Result tells in its `retry_after`
+        header how long to defer it, in seconds. The payload priority is set
+        as the AMQP `priority`, honoured by queues declaring `x-max-priority`.
+        """
+        confirm = kwargs.get('confirm', False)
         routing = kwargs.get('routing_key', self.DEFAULTS['routing_key'])
         self.logger.info(
-            'Processing payload due for %s with routing_key=%s and kwargs=%s',
-            payload.reference_date.isoformat(),
+            'Processing payload due for %s with routing_key=%s',
+            payload.reference_date,
             routing,
-            kwargs,
+            extra=SAMPLED,
         )
 
         try:
             message = aio_pika.Message(
                 body=payload.message,
+                priority=min(max(payload.priority, 0), 255) or None,
             )
         except TypeError as err:
             raise ProcessingError('Invalid payload') from err
-        channel = await self.connection.channel()
-        published = await channel.default_exchange.publish(
-            message,
-            routing_key=routing,
+        retry_after = await self.rate_limiter.acquire(
+            routing,
+            utils.timestamp(payload.reference_date),
         )
-        self.logger.debug('Sent payload to %s', routing)
-        await channel.close()
+        if retry_after:
+            self.logger.debug(
+                'Deferring payload to %s by %.3fs', routing, retry_after, extra=SAMPLED,
+            )
+            return Result(
+                success=False,
+                headers={'retry_after': retry_after},
+                payload=payload,
+                data=None,
+            )
+        success = True
+        async with self.channel_pool.acquire(shared=confirm) as channel:
+            try:
+                with PUBLISH_LATENCY.labels(self.workflow).time():
+                    published = await channel.default_exchange.publish(
+                        message,
+                        routing_key=routing,
+                    )
+            except DeliveryError as err:
+                if not confirm:
+                    raise
+                self.logger.warning('Broker rejected payload for %s: %s', routing, err)
+                success = False
+                published = err.frame
+        self.logger.debug('Sent payload to %s', routing, extra=SAMPLED)
         result = Result(
-            success=True,
+            success=success,
             headers={},
             payload=payload,
             data=published,
@@ -80,7 +252,15 @@ class BrokerManager(BaseDriver):
         return queue
 
     async def listen(self, **kwargs):
-        """Consume messages from `queue`."""
+        """Consume messages from `queue`.
+
+        When `batch_size` is greater than 1, the action receives lists of up to
+        `batch_size` messages, gathered for at most `batch_timeout` milliseconds.
+
+        The channel allows `prefetch_count` unacknowledged messages (0 meaning
+        unlimited) and up to `max_concurrency` messages or batches are handled
+        at the same time.
+        """
         queue_name = self.DEFAULTS['queue_name']
         self.logger.info(
             "Listening for events (action=%s, driver=%s) with queue_name=%s",
@@ -94,20 +274,157 @@ class BrokerManager(BaseDriver):
             )
         async with self.connection:
             async with self.connection.channel() as channel:
+                self.channel = channel
+                self._applied_prefetch = self.prefetch_count
+                self._resumed = asyncio.Event()
+                self._resumed.set()
+                if self.prefetch_count:
+                    await channel.set_qos(prefetch_count=self.prefetch_count)
                 # TODO: Variabilize queue name based on listen_queue or equivalent
                 queue = await channel.declare_queue(queue_name, **kwargs)
                 async with queue.iterator() as queue_iter:
-                    async for message in queue_iter:
-                        async with message.process():
-                            try:
-                                self.logger.debug('Processing %s', message)
-                                await self.action(message, self.driver, **kwargs)
-                                self._notify_done('success')
-                            except ProcessingError as reason:
-                                self.logger.error(
-                                    'Could not process reason=%s payload=%r',
-                                    reason,
-                                    message,
-                                )
-                                self._notify_done('success')
-                                continue
+                    if self.batch_size > 1:
+                        await self._consume(self._batches(queue_iter), self._handle_batch, **kwargs)
+                    else:
+                        await self._consume(queue_iter, self._handle, **kwargs)
+
+    async def _consume(self, items: typing.AsyncIterator, handler: typing.Callable, **kwargs):
+        """Apply `handler` to `items`, running at most `max_concurrency` at once."""
+        if self.max_concurrency <= 1:
+            async for item in items:
+                await self._wait_resumed()
+                await handler(item, **kwargs)
+            return
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        pending = set()  # type: typing.Set[asyncio.Future]
+        errors = []  # type: typing.List[Exception]
+
+        async def run(item):
+            try:
+                await handler(item, **kwargs)
+            except Exception as err:  # pylint: disable=broad-except
+                errors.append(err)
+            finally:
+                semaphore.release()
+
+        try:
+            async for item in items:
+                await self._wait_resumed()
+                await semaphore.acquire()
+                if errors:
+                    raise errors[0]
+                task = asyncio.ensure_future(run(item))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _wait_resumed(self):
+        """Hold the delivered messages while consumption is paused."""
+        if self._resumed is not None:
+            await self._resumed.wait()
+
+    async def apply_pressure(self, state: str, prefetch_count: int):
+        """Throttle the consumer to `prefetch_count` messages or pause it.
+
+        Paused consumers also keep at most `prefetch_count` messages, which are
+        processed once consumption is resumed.
+        """
+        if self.channel is None or self._resumed is None:
+            return
+        prefetch = self.prefetch_count if state == STATE_OPEN else prefetch_count
+        if prefetch != self._applied_prefetch:
+            await self.channel.set_qos(prefetch_count=prefetch)
+            self._applied_prefetch = prefetch
+        if state == STATE_PAUSED:
+            self._resumed.clear()
+        else:
+            self._resumed.set()
+
+    async def _batches(self, queue_iter: typing.AsyncIterator) -> typing.AsyncIterator[list]:
+        """Group the incoming messages by `batch_size` or `batch_timeout`."""
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                batch = [await queue_iter.__anext__()]
+            except StopAsyncIteration:
+                return
+            deadline = loop.time() + self.batch_timeout / 1000
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue_iter.__anext__(), remaining))
+                except (asyncio.TimeoutError, StopAsyncIteration):
+                    break
+            yield batch
+
+    async def _handle_batch(self, messages: typing.List[aio_pika.IncomingMessage], **kwargs):
+        """Apply the action to a list of messages and acknowledge them together.
+
+        The action returns one `Result` per message, None for an invalid one.
+        When all of them succeeded and batches are handled one at a time, the
+        whole batch is acknowledged at once. Otherwise messages are settled one
+        by one: the invalid ones are rejected, and all of them when the action
+        raises a ProcessingError, and the failed ones are requeued, as are all
+        of them when the action raises another error.
+        """
+        acknowledge_all = self.max_concurrency <= 1
+        try:
+            self.logger.debug('Processing %d messages', len(messages))
+            results = await self.action(messages, self.driver, **kwargs)
+        except ProcessingError as reason:
+            self.logger.error('Could not process batch reason=%s', reason)
+            results = [None] * len(messages)
+        except Exception:
+            for message in messages:
+                await message.reject(requeue=True)
+            raise
+        for result in results:
+            self._notify_done('success' if result is not None and result.success else 'failed')
+        if acknowledge_all and all(result is not None and result.success for result in results):
+            await messages[-1].ack(multiple=True)
+            return
+        for message, result in zip(messages, results):
+            if result is None:
+                await message.reject()
+            elif result.success:
+                await message.ack()
+            else:
+                await message.nack(requeue=True)
+
+    async def _handle(self, message: aio_pika.IncomingMessage, **kwargs):
+        """Apply the action to `message` and acknowledge it.
+
+        A driver holding on to the message after the action can take over its
+        acknowledgement by returning a `Result` with a `deferred_ack` header.
+        A message whose `Result` is unsuccessful, its storage being unavailable,
+        or whose action raises an unexpected error is requeued.
+        """
+        try:
+            self.logger.debug('Processing %s', message, extra=SAMPLED)
+            result = await self.action(message, self.driver, **kwargs)
+        except ProcessingError as reason:
+            self.logger.error(
+                'Could not process reason=%s payload=%r',
+                reason,
+                message,
+            )
+            self._notify_done('failed')
+            await message.ack()
+            return
+        except Exception:
+            await message.reject(requeue=True)
+            raise
+        if isinstance(result, Result) and not result.success:
+            self.logger.warning('Could not store payload=%r, requeueing it', message)
+            self._notify_done('failed')
+            await message.nack(requeue=True)
+            return
+        self._notify_done('success')
+        if isinstance(result, Result) and result.headers.get('deferred_ack'):
+            return
+        await message.ack()
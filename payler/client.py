@@ -1,70 +1,77 @@
-"""CLI entrypoints."""
+"""CLI entrypoints.
+
+Drivers are imported by the workflows using them, to keep the startup fast.
+"""
+# pylint: disable=import-outside-toplevel
 import asyncio
 import io
 
 import click
 
-from payler import config, logs, process, runtime
-from payler.broker import BrokerManager
-from payler.db import SpoolManager
-from payler.driver import DriverConfiguration
+from payler import config, logs, runtime, utils
 from payler import metrics
 
 
-async def process_queue(loop: asyncio.events.AbstractEventLoop):
-    """Start Payler using the CLI flags."""
+def register_backpressure(controller, consumer, storage):
+    """Let `controller` throttle `consumer` according to the depth of `storage`."""
+    if controller is None:
+        return
+    controller.register(consumer=consumer, probe=getattr(storage, 'depth', None))
+
+
+async def process_queue(loop: asyncio.events.AbstractEventLoop, **kwargs):
+    """Start Payler using the CLI flags.
+
+    The `input` driver (a BrokerManager by default) feeds the `output` storage
+    driver (a SpoolManager by default), see `runtime.DriverSpec`. The input is
+    throttled by the `backpressure` controller, if any.
+    """
+    from payler import process
+
     logger = logs.build_logger('process_queue')
-    broker_url = config.get('BROKER_URL')
-    mongo_url = config.get('MONGODB_URL')
-    spooler_config = DriverConfiguration(
-        'output-spooler',
-        mongo_url,
-        loop,
-        logger,
+    storage_manager = await runtime.driver_spec(kwargs.get('output')).build(
+        'output-spooler', loop, logger, 'mongodb', kwargs.get('workflow'),
     )
-    storage_manager = SpoolManager(spooler_config)
     await storage_manager.is_reachable()
 
-    broker_config = DriverConfiguration(
-        'input-broker',
-        broker_url,
-        loop,
-        logger,
+    broker_manager = await runtime.driver_spec(kwargs.get('input')).build(
+        'input-broker', loop, logger, 'broker', kwargs.get('workflow'),
     )
-    broker_manager = await BrokerManager.create(broker_config)
+    action = process.spool_message
+    if getattr(broker_manager, 'batch_size', 1) > 1:
+        action = process.spool_messages
     broker_manager.configure(
-        action=process.spool_message,
+        action=action,
         driver=storage_manager,
     )  # action=print, driver=None
+    register_backpressure(kwargs.get('backpressure'), broker_manager, storage_manager)
     logger.info('starting process_queue...')
     await broker_manager.listen()
 
 
-async def watch_storage(loop: asyncio.events.AbstractEventLoop):
-    """Watch the storage and inject in BrokerManager exchange."""
+async def watch_storage(loop: asyncio.events.AbstractEventLoop, **kwargs):
+    """Watch the storage and inject in BrokerManager exchange.
+
+    The `input` storage driver (a SpoolManager by default) re-injects matured
+    payloads using the `output` driver (a BrokerManager by default), see
+    `runtime.DriverSpec`.
+    """
+    from payler import process
+
     logger = logs.build_logger('watch_storage')
-    broker_url = config.get('BROKER_URL')
-    mongo_url = config.get('MONGODB_URL')
-    watcher_config = DriverConfiguration(
-        'input-spooler',
-        mongo_url,
-        loop,
-        logger,
+    storage_manager = await runtime.driver_spec(kwargs.get('input')).build(
+        'input-spooler', loop, logger, 'mongodb', kwargs.get('workflow'),
     )
-    storage_manager = SpoolManager(watcher_config)
     await storage_manager.is_reachable()
 
-    broker_config = DriverConfiguration(
-        'output-broker',
-        broker_url,
-        loop,
-        logger,
+    broker_manager = await runtime.driver_spec(kwargs.get('output')).build(
+        'output-broker', loop, logger, 'broker', kwargs.get('workflow'),
     )
-    broker_manager = await BrokerManager.create(broker_config)
     logger.info(
-        'configuring SpoolManager with action=%s driver=%s',
+        'configuring %s with action=%s driver=%s',
+        type(storage_manager).__name__,
         'process.send_message_back',
-        'BrokerManager',
+        type(broker_manager).__name__,
     )
     storage_manager.configure(
         action=process.send_message_back,
@@ -72,13 +79,55 @@ async def watch_storage(loop: asyncio.events.AbstractEventLoop):
     )  # action=print, driver=None
 
     await storage_manager.setup()
+    register_backpressure(kwargs.get('backpressure'), None, storage_manager)
 
     logger.info('starting watch_storage...')
     await storage_manager.listen()
 
 
+async def process_queue_in_memory(loop: asyncio.events.AbstractEventLoop, **kwargs):
+    """Hold short delays in memory and spool the longer ones.
+
+    The `input` driver (a BrokerManager by default) feeds the `output` driver
+    (a WheelManager by default), which hands longer delays over to the `spooler`
+    storage driver (a SpoolManager by default), see `runtime.DriverSpec`.
+    Matured payloads are re-injected using a BrokerManager.
+    """
+    from payler import process
+
+    logger = logs.build_logger('process_queue_in_memory')
+    storage_manager = await runtime.driver_spec(kwargs.get('spooler')).build(
+        'output-spooler', loop, logger, 'mongodb', kwargs.get('workflow'),
+    )
+    await storage_manager.is_reachable()
+
+    output_manager = await runtime.DriverSpec().build(
+        'output-broker', loop, logger, 'broker', kwargs.get('workflow'),
+    )
+    wheel_manager = await runtime.driver_spec(kwargs.get('output')).build(
+        'memory-wheel', loop, logger, 'wheel', kwargs.get('workflow'),
+    )
+    wheel_manager.configure(
+        action=process.send_message_back,
+        driver=output_manager,
+        spooler=storage_manager,
+    )
+
+    input_manager = await runtime.driver_spec(kwargs.get('input')).build(
+        'input-broker', loop, logger, 'broker', kwargs.get('workflow'),
+    )
+    input_manager.configure(
+        action=process.hold_message,
+        driver=wheel_manager,
+    )
+    register_backpressure(kwargs.get('backpressure'), input_manager, storage_manager)
+    logger.info('starting process_queue_in_memory...')
+    await asyncio.gather(wheel_manager.listen(), input_manager.listen())
+
+
 def listen_to_broker():
     """Watch the payload queue for payload to delay."""
+    utils.install_event_loop_policy(config.get('EVENT_LOOP'))
     loop = asyncio.get_event_loop()
     loop.run_until_complete(process_queue(loop))
     loop.close()
@@ -86,6 +135,7 @@ def listen_to_broker():
 
 def watch_payloads_ready():
     """Watch the Storage and re-inject matured payloads."""
+    utils.install_event_loop_policy(config.get('EVENT_LOOP'))
     loop = asyncio.get_event_loop()
     loop.run_until_complete(watch_storage(loop))
     loop.close()
@@ -105,12 +155,26 @@ def run_payler(config_file: io.TextIOWrapper):
     logger.info("Starting up payler with config_file=%s", config_file.name)
     configuration = config.load(config_file)
     http_metric_port = int(config.get('METRIC_SERVER_PORT'))
+    if runtime.has_replicas(configuration['workflows']):
+        registry = metrics.enable_multiprocess()
+        metrics.start_http_server(http_metric_port, registry=registry)
+        logger.info("Exposing metrics at %d", http_metric_port)
+        logger.info("Firing up workflows in worker processes.")
+        runtime.Supervisor(
+            configuration['workflows'],
+            logger,
+            backpressure=configuration.get('backpressure'),
+        ).run()
+        return
     metrics.start_http_server(http_metric_port)
     logger.info("Exposing metrics at %d", http_metric_port)
+    policy = utils.install_event_loop_policy(config.get('EVENT_LOOP'))
+    logger.info("Using the %s event loop", policy)
     loop = asyncio.get_event_loop()
     workflows = runtime.register_workflows(
         configuration['workflows'],
         loop,
+        backpressure=configuration.get('backpressure'),
     )
     logger.info(
         "Found %d workflows: %s",
@@ -0,0 +1,76 @@
+"""Compression of the spooled message bodies.
+
+Bodies are compressed with the configured codec when they are at least
+`threshold` bytes long. The codec name is stored along the document, so that
+compressed and raw documents can coexist in the same collection.
+
+`zlib` is always available, `zstd` and `lz4` respectively require the
+`zstandard` and `lz4` packages.
+"""
+import importlib
+import typing
+import zlib
+
+from payler.errors import ProcessingError
+
+
+class Codec(typing.NamedTuple):
+    """Compression functions for a codec."""
+    compress: typing.Callable[[bytes], bytes]
+    decompress: typing.Callable[[bytes], bytes]
+
+
+def _zlib() -> Codec:
+    return Codec(zlib.compress, zlib.decompress)
+
+
+def _zstd() -> Codec:
+    zstandard = importlib.import_module('zstandard')
+    return Codec(
+        zstandard.ZstdCompressor().compress,
+        zstandard.ZstdDecompressor().decompress,
+    )
+
+
+def _lz4() -> Codec:
+    frame = importlib.import_module('lz4.frame')
+    return Codec(frame.compress, frame.decompress)
+
+
+CODECS = {
+    'zlib': _zlib,
+    'zstd': _zstd,
+    'lz4': _lz4,
+}  # type: typing.Dict[str, typing.Callable[[], Codec]]
+
+_LOADED = {}  # type: typing.Dict[str, Codec]
+
+
+def get_codec(name: str) -> Codec:
+    """Return the codec registered as `name`."""
+    if name not in _LOADED:
+        if name not in CODECS:
+            raise ProcessingError(f'Unknown codec {name}, expected one of {sorted(CODECS)}')
+        try:
+            _LOADED[name] = CODECS[name]()
+        except ImportError as err:
+            raise ProcessingError(f'Codec {name} is not installed') from err
+    return _LOADED[name]
+
+
+def compress(body: typing.Any, name: typing.Optional[str],
+             threshold: int = 0) -> typing.Tuple[typing.Any, typing.Optional[str]]:
+    """Compress `body` using the `name` codec and return it along the codec used.
+
+    Bodies which are not bytes or are shorter than `threshold` are left as is.
+    """
+    if name is None or not isinstance(body, bytes) or len(body) < threshold:
+        return body, None
+    return get_codec(name).compress(body), name
+
+
+def decompress(body: typing.Any, name: typing.Optional[str]) -> typing.Any:
+    """Return the original `body`, compressed using the `name` codec if any."""
+    if name is None:
+        return body
+    return get_codec(name).decompress(body)
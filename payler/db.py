@@ -1,25 +1,115 @@
 """Database-related utilities."""
+# pylint: disable=too-many-lines
 import asyncio
-
+import collections
+from datetime import datetime
+import heapq
+import os
+import re
+import socket
+import time
 import typing
+import uuid
+import zlib
+
+from bson import ObjectId
 
 import motor.motor_asyncio
 from motor.motor_asyncio import AsyncIOMotorCollection
 import pendulum
 import pymongo
+import pymongo.errors
 
-from payler.driver import BaseDriver, DriverConfiguration, Result
+from payler import compression, utils
+from payler.logs import SAMPLED
+from payler.driver import DriverConfiguration, Result
 from payler.errors import ProcessingError
+from payler.metrics import INSERT_LATENCY
 from payler.structs import Payload
+from payler.watcher import WatchingDriver
+
+
+# Fields fetched to process a matured document, along its `_id`
+PROJECTION = ('message', 'reference_date', 'source', 'destination', 'codec', 'priority')
+
+# Order in which matured documents are released, most urgent first, the `_id`
+# breaking ties so that a drain can resume after the last released document
+RELEASE_ORDER = [
+    ('priority', pymongo.DESCENDING),
+    ('reference_date', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING),
+]
+
+# Ways of finding out about the next documents to process
+WATCH_POLL = 'poll'
+WATCH_CHANGE_STREAM = 'change_stream'
+
+# Seconds by which the clocks of the writers may lag behind the watcher's,
+# when looking for the documents stored without a state since the last pass
+LEGACY_MARGIN = 60
+
+# Document states, leases being held by `claimed` documents
+STATE_PENDING = 'pending'
+STATE_CLAIMED = 'claimed'
+
 
+# Indexes managed by `SpoolManager.setup`, as `create_index` keys and options
+DEFAULT_INDEXES = (
+    {'keys': [('reference_date', pymongo.ASCENDING), ('state', pymongo.ASCENDING)]},
+    {
+        'keys': [('state', pymongo.ASCENDING), ('reference_date', pymongo.ASCENDING)],
+        'partialFilterExpression': {'state': STATE_PENDING},
+    },
+    {
+        'keys': [('state', pymongo.ASCENDING)] + RELEASE_ORDER,
+        'partialFilterExpression': {'state': STATE_PENDING},
+    },
+    {
+        'keys': [('state', pymongo.ASCENDING), ('lease_expiry', pymongo.ASCENDING)],
+        'partialFilterExpression': {'state': STATE_CLAIMED},
+    },
+)
 
-class SpoolManager(BaseDriver):
+# Index options compared to tell whether an existing index matches its declaration
+INDEX_OPTIONS = ('partialFilterExpression', 'expireAfterSeconds', 'unique', 'sparse')
+
+
+def _key_spec(keys: typing.Iterable) -> typing.List[typing.Tuple[str, typing.Any]]:
+    """Normalize index keys, as stored by MongoDB or declared in the configuration."""
+    return [
+        (field, int(direction) if isinstance(direction, (int, float)) else direction)
+        for field, direction in keys
+    ]
+
+
+def _default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class SpoolManager(WatchingDriver):  # pylint: disable=too-many-instance-attributes
     """Service to store payloads and interact with the Database."""
+    STORAGE = 'database'
     # TODO: Move to conf.py
     DEFAULTS = {
         'spool_collection': 'payloads',
         'sleep_duration': 30,
         'default_collection_name': 'payloads',
+        'batch_size': 1,
+        'max_concurrency': 16,
+        'confirm_mode': False,
+        'lease_duration': 0,
+        'claim_size': 100,
+        'shard_count': 1,
+        'shard_index': 0,
+        'compression': None,
+        'compression_threshold': 1024,
+        'cursor_batch_size': 100,
+        'max_documents_per_cycle': 10000,
+        'abandoned_ttl': 0,
+        'watch_mode': WATCH_POLL,
+        'schedule_horizon': 300,
+        'bucket_duration': 0,
+        'bucket_grace': 60,
     }
 
     def __init__(self, configuration: DriverConfiguration):
@@ -40,45 +130,255 @@ class SpoolManager(BaseDriver):
             self.DEFAULTS['default_collection_name'],
         )
         self.collection = self.database[collection_name]  # type: AsyncIOMotorCollection
+        self.batch_size = int(configuration.extra.get(
+            'batch_size',
+            self.DEFAULTS['batch_size'],
+        ))
+        self.max_concurrency = int(configuration.extra.get(
+            'max_concurrency',
+            self.DEFAULTS['max_concurrency'],
+        ))
+        self.confirm_mode = bool(configuration.extra.get(
+            'confirm_mode',
+            self.DEFAULTS['confirm_mode'],
+        ))
+        self.sleep_duration = float(configuration.extra.get(
+            'sleep_duration',
+            self.DEFAULTS['sleep_duration'],
+        ))
+        self.lease_duration = float(configuration.extra.get(
+            'lease_duration',
+            self.DEFAULTS['lease_duration'],
+        ))
+        self.claim_size = int(configuration.extra.get(
+            'claim_size',
+            self.DEFAULTS['claim_size'],
+        ))
+        self.shard_count = int(configuration.extra.get(
+            'shard_count',
+            self.DEFAULTS['shard_count'],
+        ))
+        self.shard_index = int(configuration.extra.get(
+            'shard_index',
+            self.DEFAULTS['shard_index'],
+        ))
+        self.worker_id = configuration.extra.get('worker_id') or _default_worker_id()
+        self.compression = configuration.extra.get(
+            'compression',
+            self.DEFAULTS['compression'],
+        )
+        if self.compression is not None:
+            compression.get_codec(self.compression)
+        self.compression_threshold = int(configuration.extra.get(
+            'compression_threshold',
+            self.DEFAULTS['compression_threshold'],
+        ))
+        self.cursor_batch_size = int(configuration.extra.get(
+            'cursor_batch_size',
+            self.DEFAULTS['cursor_batch_size'],
+        ))
+        self.max_documents_per_cycle = int(configuration.extra.get(
+            'max_documents_per_cycle',
+            self.DEFAULTS['max_documents_per_cycle'],
+        ))
+        self.indexes = list(configuration.extra.get('indexes', DEFAULT_INDEXES))
+        abandoned_ttl = int(configuration.extra.get(
+            'abandoned_ttl',
+            self.DEFAULTS['abandoned_ttl'],
+        ))
+        if abandoned_ttl:
+            self.indexes.append({
+                'keys': [('reference_date', pymongo.ASCENDING)],
+                'expireAfterSeconds': abandoned_ttl,
+            })
+        self.projection = {
+            field: True for field in configuration.extra.get('projection', PROJECTION)
+        }
+        self.watch_mode = configuration.extra.get('watch_mode', self.DEFAULTS['watch_mode'])
+        if self.watch_mode not in (WATCH_POLL, WATCH_CHANGE_STREAM):
+            raise ProcessingError(f'Unknown watch_mode {self.watch_mode}')
+        self.schedule_horizon = float(configuration.extra.get(
+            'schedule_horizon',
+            self.DEFAULTS['schedule_horizon'],
+        ))
+        self.bucket_duration = int(configuration.extra.get(
+            'bucket_duration',
+            self.DEFAULTS['bucket_duration'],
+        ))
+        self.bucket_grace = float(configuration.extra.get(
+            'bucket_grace',
+            self.DEFAULTS['bucket_grace'],
+        ))
+        self._buckets = set()  # type: typing.Set[str]
+        # cursors over the ended buckets being drained, by name
+        self._drains = {}  # type: typing.Dict[str, typing.Any]
+        self._schedule = []  # type: typing.List[typing.Tuple[float, typing.Any]]
+        self._synced_at = 0.0
+        # match date of the latest search for documents without a state, by collection
+        self._marked = {}  # type: typing.Dict[str, pendulum.DateTime]
+        self._changes = None  # type: typing.Optional[asyncio.Future]
+        # `_id`s the current pass is restricted to, taken from the schedule
+        self._targets = None  # type: typing.Optional[typing.List[typing.Any]]
+        # `_id`s of the documents deferred by the action, not rescheduled yet
+        self._deferred = []  # type: typing.List[typing.Any]
 
     def __str__(self):
         return f'{type(self)} - {self.database}'
 
+    @property
+    def storage_key(self) -> tuple:
+        return (self.collection.full_name,)
+
     async def setup(self, **kwargs) -> typing.Any:
         """Prepare the OutputDriver configuration.
 
-        Create an index on the storage collection to improve querying spooled payloads.
-        Index is created on the `reference_date` field.
-        """
-        infos = await self.collection.index_information()
-        for key in infos:
-            if 'reference_date' not in key:
-                continue
-            self.logger.info('Index %s exists', key)
-            return key
+        Create the `indexes` declared in the configuration (`DEFAULT_INDEXES`
+        unless overridden, along a TTL index on `reference_date` when
+        `abandoned_ttl` is set). Existing indexes are matched by key spec and
+        options; an index with the same keys but different options is replaced.
+        Documents stored before the `state` field existed are marked pending,
+        and those stored before the `priority` field get the default one.
 
-        result = await self.collection.create_index(
-            [('reference_date', pymongo.ASCENDING),],
+        Return the names of the managed indexes.
+        """
+        self._marked[self.collection.name] = pendulum.now()
+        legacy = await self.collection.update_many(
+            {'state': {'$exists': False}},
+            {'$set': {'state': STATE_PENDING}},
         )
-        if result:
+        if legacy.modified_count:
+            self.logger.info('Marked %d documents as pending', legacy.modified_count)
+        legacy = await self.collection.update_many(
+            {'priority': {'$exists': False}},
+            {'$set': {'priority': 0}},
+        )
+        if legacy.modified_count:
+            self.logger.info('Set the default priority of %d documents', legacy.modified_count)
+
+        return await self._ensure_indexes(self.collection)
+
+    async def _ensure_indexes(self, collection: AsyncIOMotorCollection) -> typing.List[str]:
+        """Create the declared `indexes` on `collection` and return their names."""
+        infos = await collection.index_information()
+        names = []
+        for declaration in self.indexes:
+            keys = _key_spec(declaration['keys'])
+            options = {key: value for key, value in declaration.items() if key != 'keys'}
+            same_keys = {
+                name: info for name, info in infos.items()
+                if _key_spec(info['key']) == keys
+            }
+            matching = [
+                name for name, info in same_keys.items()
+                if all(info.get(option) == options.get(option) for option in INDEX_OPTIONS)
+            ]
+            if matching:
+                self.logger.info('Index %s exists', matching[0])
+                names.append(matching[0])
+                continue
+            for name in same_keys:
+                self.logger.warning('Index %s does not match its declaration, dropping it', name)
+                await collection.drop_index(name)
+            result = await collection.create_index(keys, **options)
             self.logger.info('Index %s created', result)
-        return result
+            names.append(result)
+        return names
 
     async def is_reachable(self) -> bool:
         """Ensure connection integrity."""
         result = await self.client.server_info()
         return result is not None
 
+    async def depth(self) -> int:
+        """Return the estimated number of spooled documents, in all the buckets."""
+        targets = [self.collection]
+        if self.bucket_duration:
+            targets = [collection for collection, _ in await self._due_buckets()]
+        counts = [await collection.estimated_document_count() for collection in targets]
+        return sum(counts)
+
+    def _document(self, payload: Payload) -> dict:
+        """Return the document storing `payload`, in `pending` state.
+
+        The `shard` field is derived from the `_id` and lets several watchers
+        split the collection between them. Large messages are compressed using
+        the `compression` codec, stored in the `codec` field.
+        """
+        document = payload.asdict()
+        document['message'], codec = compression.compress(
+            payload.message,
+            self.compression,
+            self.compression_threshold,
+        )
+        if codec is not None:
+            document['codec'] = codec
+        identifier = ObjectId()
+        document['_id'] = identifier
+        document['shard'] = zlib.crc32(identifier.binary)
+        document['state'] = STATE_PENDING
+        return document
+
+    def _bucket_start(self, reference_date: datetime) -> int:
+        """Return the start of the `bucket_duration` window storing `reference_date`.
+
+        Payloads already due go to the current window, so that past windows
+        only ever shrink and can be dropped once drained.
+        """
+        due = max(utils.timestamp(reference_date), time.time())
+        return int(due // self.bucket_duration * self.bucket_duration)
+
+    async def _target(self, reference_date: datetime) -> AsyncIOMotorCollection:
+        """Return the collection storing payloads due at `reference_date`.
+
+        With `bucket_duration`, it is the collection of the matching time window,
+        whose indexes are created on first use.
+        """
+        if not self.bucket_duration:
+            return self.collection
+        name = f'{self.collection.name}_{self._bucket_start(reference_date)}'
+        collection = self.database[name]
+        if name not in self._buckets:
+            await self._ensure_indexes(collection)
+            self._buckets.add(name)
+        return collection
+
+    async def _due_buckets(self, match_date: typing.Optional[datetime] = None
+                           ) -> typing.List[typing.Tuple[AsyncIOMotorCollection, float]]:
+        """Return the buckets started before `match_date`, along their end, oldest first.
+
+        All the buckets are returned when `match_date` is None.
+        """
+        pattern = f'^{re.escape(self.collection.name)}_([0-9]+)$'
+        names = await self.database.list_collection_names(filter={'name': {'$regex': pattern}})
+        starts = sorted(int(re.match(pattern, name).group(1)) for name in names)
+        if match_date is not None:
+            starts = [start for start in starts if start <= utils.timestamp(match_date)]
+        return [
+            (self.database[f'{self.collection.name}_{start}'], start + self.bucket_duration)
+            for start in starts
+        ]
+
     async def process(self, payload: Payload, **kwargs) -> Result:
-        """Store the Payload in the collection along its metadatas."""
-        inserted = await self.collection.insert_one(payload.asdict())
+        """Store the Payload in the collection along its metadatas.
+
+        The Result is unsuccessful when the database cannot be reached.
+        """
+        try:
+            collection = await self._target(payload.reference_date)
+            with INSERT_LATENCY.labels(self.workflow).time():
+                inserted = await collection.insert_one(self._document(payload))
+        except pymongo.errors.ConnectionFailure as err:
+            self.logger.error('could not store payload: %s', err)
+            return Result(success=False, headers={}, payload=payload, data=None)
+        self._notify_watchers(utils.timestamp(payload.reference_date))
         self.logger.debug(
             'stored payload with id=%s reference_date=%s kwargs=%s',
             inserted.inserted_id,
             payload.reference_date,
             kwargs,
+            extra=SAMPLED,
         )
-        headers = {'location': self.collection.name}
+        headers = {'location': collection.name}
         result = Result(
             success=True,
             headers=headers,
@@ -87,42 +387,522 @@ class SpoolManager(BaseDriver):
         )
         return result
 
-    async def _search_ready(self, match_date: pendulum.DateTime) -> typing.Any:
+    async def process_many(self, payloads: typing.List[Payload],
+                           **kwargs) -> typing.List[Result]:
+        """Store the Payloads in the collection using a single unordered `insert_many`.
+
+        With `bucket_duration`, one `insert_many` is issued per bucket. The
+        Results of the payloads which could not be written, the database being
+        unreachable, are unsuccessful.
+        """
+        documents = [self._document(payload) for payload in payloads]
+        groups = collections.defaultdict(list)  # type: typing.Dict[str, typing.List[int]]
+        targets = {}  # type: typing.Dict[str, AsyncIOMotorCollection]
+        try:
+            for index, payload in enumerate(payloads):
+                collection = await self._target(payload.reference_date)
+                targets[collection.name] = collection
+                groups[collection.name].append(index)
+        except pymongo.errors.ConnectionFailure as err:
+            self.logger.error('could not store %d payloads: %s', len(payloads), err)
+            return [
+                Result(success=False, headers={}, payload=payload, data=None)
+                for payload in payloads
+            ]
+        failed = set()  # type: typing.Set[int]
+        for name, indexes in groups.items():
+            try:
+                with INSERT_LATENCY.labels(self.workflow).time():
+                    await targets[name].insert_many(
+                        [documents[index] for index in indexes],
+                        ordered=False,
+                    )
+            except pymongo.errors.BulkWriteError as err:
+                errors = err.details.get('writeErrors', [])
+                failed.update(indexes[error['index']] for error in errors)
+                self.logger.error('could not store %d payloads in %s', len(errors), name)
+            except pymongo.errors.ConnectionFailure as err:
+                failed.update(indexes)
+                self.logger.error('could not store %d payloads in %s: %s', len(indexes), name, err)
+        self.logger.debug('stored %d payloads kwargs=%s', len(documents) - len(failed), kwargs)
+        if payloads:
+            self._notify_watchers(
+                utils.timestamp(min(payload.reference_date for payload in payloads)),
+            )
+        locations = {
+            index: name for name, indexes in groups.items() for index in indexes
+        }
+        return [
+            Result(
+                success=index not in failed,
+                headers={'location': locations[index]},
+                payload=payload,
+                data=documents[index].get('_id'),
+            )
+            for index, payload in enumerate(payloads)
+        ]
+
+    def _ready_query(self, match_date: pendulum.DateTime) -> dict:
+        """Return the query matching the documents to process at `match_date`."""
         query = {
             'reference_date': {'$lte': match_date},
-        }
-        documents = self.collection.find(query)
+            'state': STATE_PENDING,
+        }  # type: typing.Dict[str, typing.Any]
+        if self._targets is not None:
+            query['_id'] = {'$in': self._targets}
+        if self.shard_count > 1:
+            query['shard'] = {'$mod': [self.shard_count, self.shard_index]}
+        if self.lease_duration:
+            del query['state']
+            query['$or'] = [
+                {'state': STATE_PENDING},
+                {'state': STATE_CLAIMED, 'lease_expiry': {'$lte': match_date}},
+            ]
+        return query
+
+    def _cursor(self, query: dict, limit: int = 0,
+                collection: typing.Optional[AsyncIOMotorCollection] = None) -> typing.Any:
+        """Return a cursor over the documents matching `query`, by `RELEASE_ORDER`.
+
+        Only the `projection` fields are fetched, by batches of `cursor_batch_size`.
+        """
+        collection = collection or self.collection
+        cursor = collection.find(query, projection=self.projection)
+        cursor.sort(RELEASE_ORDER)
+        cursor.batch_size(self.cursor_batch_size)
+        if limit:
+            cursor.limit(limit)
+        return cursor
+
+    async def _search_ready(self, match_date: pendulum.DateTime,
+                            collection: typing.Optional[AsyncIOMotorCollection] = None
+                            ) -> typing.Any:
+        query = self._ready_query(match_date)
+        documents = self._cursor(query, self.max_documents_per_cycle, collection)
         async for doc in documents:
             yield doc
         else:
             self.logger.debug('no matching document')
         return
 
-    async def listen(self, **kwargs):
-        """Find documents with a `reference_date` older than `match_date`."""
-        should_loop = kwargs.get('should_loop', True)
-        self.logger.info(
-            "Engaging database polling - Applying (action=%s, driver=%s) to events",
-            self.action.__name__,
-            type(self.driver),
-        )
-        if not should_loop:
-            return await self.process_and_cleanup()
+    async def _claim_ready(self, match_date: pendulum.DateTime,
+                           collection: typing.Optional[AsyncIOMotorCollection] = None
+                           ) -> typing.Any:
+        """Claim the matured documents by batches of `claim_size` and yield them.
+
+        A claim sets the `owner` and a `lease_expiry` on documents which are
+        not claimed yet or whose lease expired, so that concurrent watchers
+        never process the same document. Documents left behind by a crashed
+        watcher are claimed again once their lease expired.
+        At most `max_documents_per_cycle` documents are claimed.
+        """
+        collection = collection or self.collection
+        remaining = self.max_documents_per_cycle
         while True:
-            await self.process_and_cleanup()
-            self.logger.debug('waiting for %ds', self.DEFAULTS.get('sleep_duration'))
-            await asyncio.sleep(self.DEFAULTS['sleep_duration'])
+            size = self.claim_size
+            if self.max_documents_per_cycle:
+                if remaining <= 0:
+                    return
+                size = min(size, remaining)
+            query = self._ready_query(match_date)
+            candidates = collection.find(query, projection={'_id': True})
+            candidates.sort(RELEASE_ORDER).limit(size)
+            identifiers = [doc['_id'] for doc in await candidates.to_list(size)]
+            if not identifiers:
+                self.logger.debug('no matching document')
+                return
+            token = uuid.uuid4().hex
+            query['_id'] = {'$in': identifiers}
+            await collection.update_many(query, {'$set': {
+                'state': STATE_CLAIMED,
+                'owner': self.worker_id,
+                'claim': token,
+                'lease_expiry': pendulum.now().add(seconds=self.lease_duration),
+            }})
+            remaining -= len(identifiers)
+            # `claim` is not indexed: look the claimed documents up by `_id`
+            claimed = {'_id': {'$in': identifiers}, 'claim': token}
+            async for doc in self._cursor(claimed, collection=collection):
+                yield doc
+
+    def _ready_documents(self, match_date: pendulum.DateTime,
+                         collection: AsyncIOMotorCollection) -> typing.Any:
+        """Return the documents to process, claimed when `lease_duration` is set."""
+        if self.lease_duration:
+            return self._claim_ready(match_date, collection)
+        return self._search_ready(match_date, collection)
+
+    async def _next_reference_date(self, after: float) -> typing.Optional[float]:
+        """Return the earliest pending `reference_date`, or lease expiry, past `after`.
+
+        Documents due before `after` were left behind by the previous pass and
+        are retried after `sleep_duration`. The lookups use the indexes on
+        `(state, reference_date)` and `(state, lease_expiry)`; with
+        `bucket_duration`, buckets are looked up from the oldest one.
+        """
+        after_date = pendulum.from_timestamp(after)
+        if self.bucket_duration:
+            buckets = await self._due_buckets()
+        else:
+            buckets = [(self.collection, 0.0)]
+        dates = []
+        for collection, _ in buckets:
+            doc = await collection.find_one(
+                {'state': STATE_PENDING, 'reference_date': {'$gt': after_date}},
+                projection={'reference_date': True},
+                sort=[('reference_date', pymongo.ASCENDING)],
+            )
+            if doc is not None:
+                dates.append(utils.timestamp(doc['reference_date']))
+                break
+        if self.lease_duration:
+            for collection, _ in buckets:
+                doc = await collection.find_one(
+                    {'state': STATE_CLAIMED, 'lease_expiry': {'$gt': after_date}},
+                    projection={'lease_expiry': True},
+                    sort=[('lease_expiry', pymongo.ASCENDING)],
+                )
+                if doc is not None:
+                    dates.append(utils.timestamp(doc['lease_expiry']))
+        return min(dates) if dates else None
+
+    def _plan(self, document: dict):
+        """Add `document` to the schedule if it is due within `schedule_horizon`."""
+        due = utils.timestamp(document['reference_date'])
+        if due > time.time() + self.schedule_horizon:
+            return
+        heapq.heappush(self._schedule, (due, document['_id']))
+        self.wake_up(due)
+
+    async def _resync(self):
+        """Rebuild the schedule from the pending documents due within `schedule_horizon`."""
+        self._synced_at = time.time()
+        self._schedule = []
+        horizon = pendulum.now().add(seconds=self.schedule_horizon)
+        if self.bucket_duration:
+            buckets = await self._due_buckets(horizon)
+        else:
+            buckets = [(self.collection, 0.0)]
+        for collection, _ in buckets:
+            cursor = collection.find(
+                {'state': STATE_PENDING, 'reference_date': {'$lte': horizon}},
+                projection={'reference_date': True},
+            )
+            cursor.sort('reference_date', pymongo.ASCENDING).batch_size(self.cursor_batch_size)
+            async for doc in cursor:
+                self._schedule.append((utils.timestamp(doc['reference_date']), doc['_id']))
+        heapq.heapify(self._schedule)
+        self.logger.debug('scheduled %d documents', len(self._schedule))
+
+    def _change_pipeline(self) -> typing.List[dict]:
+        """Return the change stream pipeline of the inserts to schedule.
 
-    async def process_and_cleanup(self):
-        """Find the matching jobs, process them and remove them from storage."""
+        Only the `_id` and `reference_date` of the inserted documents are
+        streamed, leaving their message in the database.
+        """
+        match = {'operationType': 'insert'}  # type: typing.Dict[str, typing.Any]
+        if self.bucket_duration:
+            match['ns.coll'] = {'$regex': f'^{re.escape(self.collection.name)}_[0-9]+$'}
+        return [
+            {'$match': match},
+            {'$project': {'documentKey': True, 'fullDocument.reference_date': True}},
+        ]
+
+    async def _watch_changes(self):
+        """Add the documents inserted in the collection, or its buckets, to the schedule."""
+        watched = self.database if self.bucket_duration else self.collection
+        async with watched.watch(self._change_pipeline()) as stream:
+            async for change in stream:
+                self._plan({
+                    '_id': change['documentKey']['_id'],
+                    'reference_date': change['fullDocument']['reference_date'],
+                })
+
+    def _pop_scheduled(self, until: float) -> typing.List[typing.Any]:
+        """Pop the `_id`s of the scheduled documents due by `until`.
+
+        At most `max_documents_per_cycle` `_id`s are popped.
+        """
+        identifiers = []
+        while self._schedule and self._schedule[0][0] <= until:
+            if self.max_documents_per_cycle and len(identifiers) >= self.max_documents_per_cycle:
+                break
+            identifiers.append(heapq.heappop(self._schedule)[1])
+        return identifiers
+
+    def _next_scheduled(self) -> float:
+        """Return the next due date of the schedule, or of the next resynchronization."""
+        resync = self._synced_at + self.schedule_horizon
+        if self._schedule:
+            return min(self._schedule[0][0], resync)
+        return resync
+
+    def _max_wait(self) -> float:
+        """Poll every `schedule_horizon` when following a change stream."""
+        if self._changes is None:
+            return self.sleep_duration
+        return self.schedule_horizon
+
+    async def _next_due(self, after: float) -> typing.Optional[float]:
+        """Return the next due date past `after`.
+
+        It comes from a sorted query or, in `change_stream` watch mode, from
+        the in-memory schedule, whose entries left are planned during the pass.
+        """
+        if self._changes is None:
+            return await self._next_reference_date(after)
+        if self._changes.done():
+            self._changes.result()
+        return self._next_scheduled()
+
+    async def listen(self, **kwargs):
+        """Find documents with a `reference_date` older than `match_date`.
+
+        Between two passes, the manager sleeps until the next `reference_date`
+        (see `WatchingDriver.listen`). In `change_stream` watch mode, the
+        inserted documents are followed using a change stream, which requires
+        a replica set, and kept in an in-memory schedule: passes only fetch
+        the scheduled documents by `_id`, the whole collection being polled
+        every `schedule_horizon` seconds.
+        """
+        if self.watch_mode != WATCH_CHANGE_STREAM or not kwargs.get('should_loop', True):
+            return await super().listen(**kwargs)
+        self._synced_at = 0.0
+        self._changes = asyncio.ensure_future(self._watch_changes())
+        try:
+            return await super().listen(**kwargs)
+        finally:
+            self._changes.cancel()
+            self._changes = None
+
+    async def process_and_cleanup(self) -> int:
+        """Find the matching jobs, process them and remove them from storage.
+
+        When `batch_size` is greater than 1 or when `confirm_mode` is enabled,
+        jobs are handled by windows (see `_process_batches`).
+        A pass handles at most `max_documents_per_cycle` jobs (0 meaning
+        unlimited) and returns the number of jobs fetched; the number of jobs
+        removed is kept in `_removed`.
+
+        With `bucket_duration`, the due buckets are processed from the oldest
+        one and a drained bucket whose window is over is dropped at once.
+
+        In `change_stream` watch mode, a pass only fetches the scheduled
+        documents due, unless the schedule is due for resynchronization.
+        """
         match_date = pendulum.now()
-        async for doc in self._search_ready(match_date):
+        self._removed = 0
+        if self._changes is None:
+            return await self._process_due(match_date)
+        if time.time() - self._synced_at < self.schedule_horizon:
+            self._targets = self._pop_scheduled(utils.timestamp(match_date))
+            if not self._targets:
+                self._targets = None
+                return 0
+            try:
+                return await self._process_due(match_date)
+            finally:
+                self._targets = None
+        fetched = await self._process_due(match_date)
+        await self._resync()
+        return fetched
+
+    async def _process_due(self, match_date: pendulum.DateTime) -> int:
+        """Process the matured jobs of the collection, or its buckets."""
+        if not self.bucket_duration:
+            return await self._process_collection(self.collection, match_date)
+        fetched = 0
+        for collection, end in await self._due_buckets(match_date):
+            limit = 0
+            if self.max_documents_per_cycle:
+                limit = self.max_documents_per_cycle - fetched
+                if limit <= 0:
+                    break
+            if self._drainable(end):
+                fetched += await self._drain_bucket(collection, limit)
+                continue
+            fetched += await self._process_collection(collection, match_date)
+            if end > utils.timestamp(match_date):
+                continue
+            if await collection.find_one({}, projection={'_id': True}) is None:
+                await collection.drop()
+                self._buckets.discard(collection.name)
+                self._marked.pop(collection.name, None)
+                self.logger.info('dropped drained bucket %s', collection.name)
+        return fetched
+
+    def _drainable(self, end: float) -> bool:
+        """Tell whether the bucket ending at `end` can be drained then dropped.
+
+        Writers stop filling a window once it ends, `bucket_grace` seconds are
+        left for the inserts in flight. Leases and shards need the documents to
+        be claimed one by one, so their buckets are processed as the live ones.
+        """
+        if self.lease_duration or self.shard_count > 1:
+            return False
+        return end + self.bucket_grace <= time.time()
+
+    @property
+    def _drain_progress(self) -> AsyncIOMotorCollection:
+        """Collection keeping the last document released from each drained bucket."""
+        return self.database[f'{self.collection.name}_drains']
+
+    @staticmethod
+    def _drain_query(progress: typing.Optional[dict]) -> dict:
+        """Return the query of the documents to drain after `progress`, by `RELEASE_ORDER`.
+
+        Each branch of the query matches the index on `RELEASE_ORDER`.
+        """
+        if progress is None:
+            return {'state': STATE_PENDING}
+        priority = progress['priority']
+        reference_date = progress['reference_date']
+        return {'$or': [
+            {'state': STATE_PENDING, 'priority': {'$lt': priority}},
+            {
+                'state': STATE_PENDING,
+                'priority': priority,
+                'reference_date': {'$gt': reference_date},
+            },
+            {
+                'state': STATE_PENDING,
+                'priority': priority,
+                'reference_date': reference_date,
+                '_id': {'$gt': progress['last_id']},
+            },
+        ]}
+
+    async def _save_drain(self, collection: AsyncIOMotorCollection, last: dict):
+        """Record `last` as the last document released from `collection`."""
+        await self._drain_progress.update_one(
+            {'_id': collection.name},
+            {'$set': {
+                'priority': last.get('priority', 0),
+                'reference_date': last['reference_date'],
+                'last_id': last['_id'],
+            }},
+            upsert=True,
+        )
+
+    async def _drain_bucket(self, collection: AsyncIOMotorCollection, limit: int = 0) -> int:
+        """Release the documents of an ended bucket, then drop it.
+
+        The documents are read from a cursor kept across passes, by
+        `RELEASE_ORDER`, and are never deleted one by one: the last document
+        released is recorded every `cursor_batch_size` documents and at the end
+        of the pass, so that a lost cursor or a restarted watcher resumes after
+        it, and the bucket is dropped once the cursor is exhausted. The
+        documents left behind by the action are moved to the current window.
+        Return the number of jobs fetched, at most `limit` (0 meaning unlimited).
+        """
+        cursor = self._drains.get(collection.name)
+        if cursor is None:
+            progress = await self._drain_progress.find_one({'_id': collection.name})
+            cursor = collection.find(self._drain_query(progress), projection=self.projection)
+            cursor.sort(RELEASE_ORDER).batch_size(self.cursor_batch_size)
+            self._drains[collection.name] = cursor
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        window = []  # type: typing.List[dict]
+        fetched = unsaved = 0
+        exhausted = False
+        try:
+            async for doc in cursor:
+                fetched += 1
+                window.append(doc)
+                if len(window) >= self.batch_size:
+                    await self._drain_window(window, semaphore, collection)
+                    unsaved += len(window)
+                    last, window = window[-1], []
+                    if unsaved >= self.cursor_batch_size:
+                        await self._save_drain(collection, last)
+                        unsaved = 0
+                if limit and fetched >= limit:
+                    break
+            else:
+                exhausted = True
+        except pymongo.errors.CursorNotFound:
+            # the cursor timed out between two passes, the next one resumes
+            self.logger.warning('lost the cursor draining %s, resuming', collection.name)
+            self._drains.pop(collection.name, None)
+        if window:
+            await self._drain_window(window, semaphore, collection)
+            unsaved += len(window)
+            last = window[-1]
+        if not exhausted:
+            if unsaved:
+                await self._save_drain(collection, last)
+            return fetched
+        await collection.drop()
+        await self._drain_progress.delete_one({'_id': collection.name})
+        del self._drains[collection.name]
+        self._buckets.discard(collection.name)
+        self.logger.info('dropped drained bucket %s', collection.name)
+        return fetched
+
+    async def _drain_window(self, window: typing.List[dict],
+                            semaphore: asyncio.Semaphore,
+                            collection: AsyncIOMotorCollection):
+        """Process a window of an ended bucket and move its failed jobs to the current window."""
+        processed = await asyncio.gather(
+            *(self._process_document(doc, semaphore) for doc in window),
+        )
+        released = {identifier for identifier in processed if identifier is not None}
+        self._removed += len(released)
+        # the documents left behind, deferred ones included, are retried from the current window
+        self._deferred = []
+        failed = [doc['_id'] for doc in window if doc['_id'] not in released]
+        if not failed:
+            return
+        target = await self._target(pendulum.now())
+        documents = await collection.find({'_id': {'$in': failed}}).to_list(None)
+        try:
+            await target.insert_many(documents, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            # documents moved by a previous attempt are already there
+            errors = err.details.get('writeErrors', [])
+            if any(error.get('code') != 11000 for error in errors):
+                raise
+        self.logger.info('moved %d jobs from %s to %s', len(failed), collection.name, target.name)
+
+    async def _mark_pending(self, collection: AsyncIOMotorCollection,
+                            match_date: pendulum.DateTime):
+        """Mark the matured documents stored without a `state` as pending.
+
+        Writers running an earlier release keep inserting documents without
+        a `state`, which the ready query would never match, nor a `priority`,
+        without which they would be released last.
+
+        Every pass only looks at the documents matured since the previous one
+        of `collection`, minus `LEGACY_MARGIN` seconds, so that its cost does not
+        grow with the backlog; the first one looks at all the matured documents.
+        """
+        query = {'$lte': match_date}
+        previous = self._marked.get(collection.name)
+        if previous is not None:
+            query['$gt'] = previous.subtract(seconds=LEGACY_MARGIN)
+        legacy = await collection.update_many(
+            {'reference_date': query, 'state': {'$exists': False}},
+            {'$set': {'state': STATE_PENDING, 'priority': 0}},
+        )
+        self._marked[collection.name] = match_date
+        if legacy.modified_count:
+            self.logger.info('Marked %d documents as pending', legacy.modified_count)
+
+    async def _process_collection(self, collection: AsyncIOMotorCollection,
+                                  match_date: pendulum.DateTime) -> int:
+        """Process the matured jobs of `collection` and return the number fetched."""
+        if self._targets is None:
+            await self._mark_pending(collection, match_date)
+        if self.batch_size > 1 or self.confirm_mode:
+            return await self._process_batches(match_date, collection)
+        fetched = 0
+        async for doc in self._ready_documents(match_date, collection):
+            fetched += 1
             try:
                 result = await self.action(doc, self.driver)
                 self.logger.info(
-                    'Processed job with id=%s result=%s', doc['_id'], result,
+                    'Processed job with id=%s result=%s', doc['_id'], result, extra=SAMPLED,
                 )
-                self._notify_done('success')
             except ProcessingError as err:
                 self.logger.error(
                     'Could not process id=%s reason=%s payload=%r',
@@ -130,10 +910,112 @@ class SpoolManager(BaseDriver):
                     err,
                     doc,
                 )
-                self._notify_done('success')
+                self._notify_done('failed')
+                continue
+            outcome = self._outcome(result)
+            self._notify_done(outcome)
+            if outcome != 'success':
+                # kept in storage
+                if outcome == 'deferred':
+                    self._deferred.append(doc['_id'])
                 continue
-            if result:
-                await self.collection.delete_one({'_id': doc['_id']})
-                self.logger.debug('deleted job _id=%s', doc['_id'])
+            await collection.delete_one({'_id': doc['_id']})
+            self._removed += 1
+            self.logger.debug('deleted job _id=%s', doc['_id'], extra=SAMPLED)
         else:
             self.logger.info('Could not find any document with match_date=%s', match_date)
+        await self._reschedule(collection)
+        return fetched
+
+    async def _reschedule(self, collection: AsyncIOMotorCollection):
+        """Plan the retry of the documents of `collection` deferred by the action.
+
+        Their lease, if any, is cut short so that they can be claimed again
+        once they can be retried, and they are put back in the schedule in
+        `change_stream` watch mode.
+        """
+        deferred, self._deferred = self._deferred, []
+        if not deferred or self._retry_at is None:
+            return
+        if self.lease_duration:
+            await collection.update_many(
+                {'_id': {'$in': deferred}, 'state': STATE_CLAIMED, 'owner': self.worker_id},
+                {'$set': {'lease_expiry': pendulum.from_timestamp(self._retry_at)}},
+            )
+        if self._targets is not None:
+            for identifier in deferred:
+                heapq.heappush(self._schedule, (self._retry_at, identifier))
+
+    async def _process_document(self, doc: dict, semaphore: asyncio.Semaphore) -> typing.Any:
+        """Apply the action to `doc` and return its `_id` when it can be removed.
+
+        In `confirm_mode`, the action receives `confirm=True` and the document
+        is only removed when the returned `Result` is successful. A document
+        which is not removed is reported as failed, or deferred (see
+        `WatchingDriver._outcome`).
+        """
+        async with semaphore:
+            try:
+                if self.confirm_mode:
+                    result = await self.action(doc, self.driver, confirm=True)
+                else:
+                    result = await self.action(doc, self.driver)
+            except ProcessingError as err:
+                self.logger.error(
+                    'Could not process id=%s reason=%s payload=%r',
+                    doc['_id'],
+                    err,
+                    doc,
+                )
+                self._notify_done('failed')
+                return None
+        self.logger.debug(
+            'Processed job with id=%s result=%s', doc['_id'], result, extra=SAMPLED,
+        )
+        outcome = self._outcome(result, confirm=self.confirm_mode)
+        self._notify_done(outcome)
+        if outcome != 'success':
+            if outcome == 'deferred':
+                self._deferred.append(doc['_id'])
+            return None
+        return doc['_id']
+
+    async def _process_window(self, window: typing.List[dict],
+                              semaphore: asyncio.Semaphore,
+                              collection: AsyncIOMotorCollection) -> int:
+        """Process a window of jobs concurrently and remove the successful ones."""
+        processed = await asyncio.gather(
+            *(self._process_document(doc, semaphore) for doc in window),
+        )
+        identifiers = [identifier for identifier in processed if identifier is not None]
+        if identifiers:
+            deleted = await collection.delete_many({'_id': {'$in': identifiers}})
+            self._removed += deleted.deleted_count
+            self.logger.debug('deleted %d jobs', deleted.deleted_count)
+        await self._reschedule(collection)
+        return len(identifiers)
+
+    async def _process_batches(self, match_date: pendulum.DateTime,
+                               collection: AsyncIOMotorCollection) -> int:
+        """Process matured jobs by windows of `batch_size` documents.
+
+        Return the number of jobs fetched.
+
+        At most `max_concurrency` actions run at the same time and every window
+        is cleaned up using a single `delete_many`, once all of its
+        confirmations have been collected.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        window = []  # type: typing.List[dict]
+        processed = 0
+        fetched = 0
+        async for doc in self._ready_documents(match_date, collection):
+            fetched += 1
+            window.append(doc)
+            if len(window) >= self.batch_size:
+                processed += await self._process_window(window, semaphore, collection)
+                window = []
+        if window:
+            processed += await self._process_window(window, semaphore, collection)
+        self.logger.info('Processed %d jobs with match_date=%s', processed, match_date)
+        return fetched
@@ -4,11 +4,11 @@ from asyncio import AbstractEventLoop
 from dataclasses import dataclass, field
 import logging
 import typing
-from typing import Any, Dict, Union, Optional
+from typing import Any, Dict, List, Union, Optional
 
 
 from payler.logs import build_logger
-from payler.metrics import JOB_COUNTER
+from payler.metrics import CYCLE_DOCUMENTS, CYCLE_DURATION, JOB_COUNTER
 from payler.structs import Payload
 
 
@@ -35,12 +35,14 @@ class DriverConfiguration:
     :attr loop: asyncio EventLoop
     :attr logger: used by the Driver
     :attr extra: kwargs-style extra argument for further driver configuration
+    :attr workflow: name of the workflow running the driver, labelling its metrics
     """
     name: str
     url: str
     loop: AbstractEventLoop
     logger: logging.Logger
     extra: Dict[str, Any] = field(default_factory=_generate_empty_dict)
+    workflow: Optional[str] = None
 
 
 class BaseDriver(ABC):
@@ -59,6 +61,7 @@ class BaseDriver(ABC):
         self.action: typing.Callable
         self.driver = None  # type: Optional[BaseDriver]
         self.kwargs = config.extra
+        self.workflow = config.workflow or self.__class__.__name__
 
     def __str__(self):
         return f'{type(self)}'
@@ -95,6 +98,13 @@ class BaseDriver(ABC):
         """
         ...
 
+    async def process_many(self, payloads: List[Payload], **kwargs) -> List[Result]:
+        """Interact with several Payloads, returning one Result per Payload.
+
+        Drivers supporting bulk operations should override this method.
+        """
+        return [await self.process(payload, **kwargs) for payload in payloads]
+
     def configure(self, action: typing.Callable, driver: Optional['BaseDriver']=None, **kwargs):
         """Configure the manager for post-spooling processing."""
         self.action = action
@@ -110,9 +120,14 @@ class BaseDriver(ABC):
         """Increase the counter with matching status label.
 
 
-        status can be either 'success' or 'failed'
+        status can be either 'success', 'failed' or 'deferred'
         """
         JOB_COUNTER.labels(
-            self.kwargs.get('name', self.__class__.__name__),
+            self.kwargs.get('name', self.workflow),
             status,
         ).inc()
+
+    def _notify_cycle(self, duration: float, documents: int):
+        """Observe the duration of a polling cycle and the documents it fetched."""
+        CYCLE_DURATION.labels(self.workflow).observe(duration)
+        CYCLE_DOCUMENTS.labels(self.workflow).observe(documents)
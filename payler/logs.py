@@ -1,27 +1,112 @@
 """Logging-related utility functions.
 
 Provide a friendly interface to log payler's operations.
+
+Loggers only enqueue their records, which a `QueueListener` thread formats and
+writes to stderr, so that the event loop never blocks on the output. Records
+are written as JSON lines, or as text when `LOG_FORMAT` is `text`, from the
+`LOG_LEVEL` level.
+
+Per-payload messages, logged with `extra=SAMPLED`, are only kept with a
+probability of `LOG_SAMPLE_RATE`.
 """
+import atexit
+import copy
+import datetime
+import json
 import logging
+import logging.handlers
+import queue
+import random
+import typing
+
+from payler import config
 
 
 LOG_FORMAT = "%(asctime)s - [%(levelname)8s] - %(name)s: %(message)s"
 
+# `extra` marking the records which are sampled
+SAMPLED = {'sampled': True}
+
+_HANDLER = None  # type: typing.Optional[QueueHandler]
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records with their message merged and their traceback as text."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as JSON lines."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created,
+                datetime.timezone.utc,
+            ).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document, default=str)
+
+
+class SamplingFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Keep the sampled records with a probability of `rate`."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self.rate
+
+
+def _handler() -> QueueHandler:
+    """Return the handler shared by the loggers, starting its listener on first use."""
+    global _HANDLER  # pylint: disable=global-statement
+    if _HANDLER is None:
+        formatter = logging.Formatter(LOG_FORMAT)
+        if config.get('LOG_FORMAT') != 'text':
+            formatter = JSONFormatter()
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        records = queue.Queue()  # type: queue.Queue
+        listener = logging.handlers.QueueListener(records, stream_handler)
+        listener.start()
+        # flush the pending records on exit
+        atexit.register(listener.stop)
+        _HANDLER = QueueHandler(records)
+        _HANDLER.addFilter(SamplingFilter(float(config.get('LOG_SAMPLE_RATE'))))
+    return _HANDLER
+
 
-# TODO: Variabilize verbosity
 # TODO: Create common logger ? (or prefix with module name)
 def build_logger(name: str) -> logging.Logger:
     """Configure a logger with a `name`.
 
     Example output:
-        2020-10-30 17:55:59,927 - [    INFO ] - SpookManager: inserted document with _id=...
+        {"time": "2020-10-30T17:55:59.927+00:00", "level": "INFO",
+         "logger": "SpoolManager", "message": "inserted document with _id=..."}
     """
     logger = logging.getLogger(name)
     if logger.handlers:
         return logger
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(LOG_FORMAT)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    logger.setLevel(config.get('LOG_LEVEL').upper())
+    logger.addHandler(_handler())
     return logger
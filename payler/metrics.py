@@ -1,5 +1,20 @@
-"""Expose payler internal metrics"""
-from prometheus_client import start_http_server, Counter
+"""Expose payler internal metrics
+
+Every metric but the backpressure gauges, shared by the workflows of a
+process, is labelled by the name of the workflow running the driver.
+"""
+import os
+import tempfile
+import typing
+
+from prometheus_client import (
+    start_http_server,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    multiprocess,
+)
 
 
 def run_metric_server(port: int):
@@ -15,7 +30,104 @@ JOB_COUNTER = Counter(
     labelnames=['workflow', 'status'],
 )
 
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+INSERT_LATENCY = Histogram(
+    'payler_storage_insert_seconds',
+    'Time spent storing payloads.',
+    labelnames=['workflow'],
+    buckets=LATENCY_BUCKETS,
+)
+PUBLISH_LATENCY = Histogram(
+    'payler_broker_publish_seconds',
+    'Time spent publishing a payload to the broker.',
+    labelnames=['workflow'],
+    buckets=LATENCY_BUCKETS,
+)
+CYCLE_DURATION = Histogram(
+    'payler_poll_cycle_seconds',
+    'Duration of a storage polling cycle.',
+    labelnames=['workflow'],
+    buckets=LATENCY_BUCKETS + (30, 60),
+)
+CYCLE_DOCUMENTS = Histogram(
+    'payler_poll_cycle_documents',
+    'Number of documents fetched by a storage polling cycle.',
+    labelnames=['workflow'],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000),
+)
+LATENESS = Histogram(
+    'payler_reinjection_lateness_seconds',
+    'Delay between the reference date of a payload and its re-injection.',
+    labelnames=['workflow'],
+    buckets=LATENCY_BUCKETS + (30, 60, 300),
+)
+THROTTLED_PAYLOADS = Counter(
+    'payler_throttled_payloads',
+    'Payloads deferred by the re-injection rate limit, by routing key.',
+    labelnames=['workflow', 'routing_key'],
+)
+BACKPRESSURE_STATE = Gauge(
+    'payler_backpressure_state',
+    'Backpressure applied to the consumers: 0 open, 1 throttled, 2 paused.',
+    multiprocess_mode='max',
+)
+BACKPRESSURE_PRESSURE = Gauge(
+    'payler_backpressure_pressure',
+    'Highest ratio of a backpressure signal to its threshold.',
+    multiprocess_mode='max',
+)
+SPOOL_DEPTH = Gauge(
+    'payler_spool_depth',
+    'Number of payloads waiting in the deepest spool.',
+    multiprocess_mode='max',
+)
+
+
+def enable_multiprocess() -> CollectorRegistry:
+    """Aggregate the metrics of the worker processes started from now on.
+
+    Workers write their metrics in `PROMETHEUS_MULTIPROC_DIR`, which defaults
+    to a temporary directory, and the returned registry collects them.
+    """
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='payler-metrics-')
+    return multiprocess_registry()
+
+
+def multiprocess_registry() -> typing.Optional[CollectorRegistry]:
+    """Return a registry collecting the metrics of all the worker processes.
+
+    Return None unless the workers write their metrics in
+    `PROMETHEUS_MULTIPROC_DIR`, the metrics of the process being the only ones.
+    """
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return None
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid: int):
+    """Cleanup the metrics of a dead worker process, if aggregating workers."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
+
+
 __all__ = [
     'run_metric_server',
+    'enable_multiprocess',
+    'multiprocess_registry',
+    'mark_process_dead',
     'JOB_COUNTER',
+    'INSERT_LATENCY',
+    'PUBLISH_LATENCY',
+    'CYCLE_DURATION',
+    'CYCLE_DOCUMENTS',
+    'LATENESS',
+    'THROTTLED_PAYLOADS',
+    'BACKPRESSURE_STATE',
+    'BACKPRESSURE_PRESSURE',
+    'SPOOL_DEPTH',
 ]
@@ -1,16 +1,31 @@
 """Processing functions for broker operations."""
-import aio_pika
+import time
+import typing
+
 import pendulum
 
-from payler.broker import BrokerManager
-from payler.db import SpoolManager
-from payler.driver import Result
+from payler import compression, utils
+from payler.metrics import LATENESS
+from payler.driver import BaseDriver, Result
+from payler.errors import ProcessingError
 from payler.structs import Payload
 
+if typing.TYPE_CHECKING:  # pragma: no cover
+    import aio_pika
+    from payler.broker import BrokerManager
+    from payler.db import SpoolManager
 
-async def spool_message(message: aio_pika.Message, driver: SpoolManager, **kwargs) -> Result:
-    """Decode and spool `message` using `driver`."""
-    delay = int(message.headers.get('x-delay'))
+
+def build_payload(message: 'aio_pika.Message') -> Payload:
+    """Create the Payload matching the `x-delay`, `x-destination` and `x-priority` headers."""
+    try:
+        delay = int(message.headers.get('x-delay'))
+    except (TypeError, ValueError) as err:
+        raise ProcessingError(f"Invalid x-delay {message.headers.get('x-delay')!r}") from err
+    try:
+        priority = int(message.headers.get('x-priority', 0))
+    except (TypeError, ValueError) as err:
+        raise ProcessingError(f"Invalid x-priority {message.headers['x-priority']!r}") from err
     # NOTE: transform default destination in constant
     destination = message.headers.get('x-destination', 'payler-out')
     data = message.body
@@ -18,23 +33,72 @@ async def spool_message(message: aio_pika.Message, driver: SpoolManager, **kwarg
     reference = now.add(microseconds=delay * 1000)  # switch form us to ms
     # TODO: Variabilize source
     source = 'payler-jobs'
-    payload = Payload(
+    return Payload(
         data,
         reference,
         source,
         destination,
+        priority,
     )
+
+
+async def spool_message(message: 'aio_pika.Message', driver: 'SpoolManager', **kwargs) -> Result:
+    """Decode and spool `message` using `driver`."""
+    payload = build_payload(message)
     result = await driver.process(payload, **kwargs)
     # TODO: do correct post-processing logging
     return result
 
 
-async def send_message_back(document: dict, driver: BrokerManager, **kwargs):
-    """Inject the Payload back in the Broker."""
+async def spool_messages(messages: typing.List['aio_pika.IncomingMessage'], driver: 'SpoolManager',
+                         **kwargs) -> typing.List[typing.Optional[Result]]:
+    """Decode and spool a batch of `messages` using `driver`.
+
+    Every message is decoded on its own: the result of an invalid message is
+    None, so that only this one is dropped, and the others are spooled.
+    """
+    payloads = {}  # type: typing.Dict[int, Payload]
+    for index, message in enumerate(messages):
+        try:
+            payloads[index] = build_payload(message)
+        except ProcessingError as err:
+            driver.logger.error('Could not decode message reason=%s', err)
+    results = [None] * len(messages)  # type: typing.List[typing.Optional[Result]]
+    if payloads:
+        spooled = await driver.process_many(list(payloads.values()), **kwargs)
+        for index, result in zip(payloads, spooled):
+            results[index] = result
+    return results
+
+
+async def hold_message(message: 'aio_pika.IncomingMessage', driver: BaseDriver, **kwargs) -> Result:
+    """Decode `message` and hand it over to `driver` along with its payload.
+
+    The driver is then responsible for acknowledging `message`.
+    """
+    payload = build_payload(message)
+    return await driver.process(payload, message=message, **kwargs)
+
+
+async def send_message_back(document: dict, driver: 'BrokerManager', **kwargs):
+    """Inject the Payload back in the Broker, decompressing its message if needed.
+
+    Documents spooled before priorities were stored are released with priority 0.
+
+    The lateness of the re-injection relative to the `reference_date` is
+    observed once the payload is sent, an unsuccessful Result meaning that it
+    was not.
+    """
     payload = Payload(
-        message=document['message'],
+        message=compression.decompress(document['message'], document.get('codec')),
         reference_date=document['reference_date'],
         source=document['source'],
         destination=document['destination'],
+        priority=document.get('priority') or 0,
     )
-    return await driver.process(payload, routing_key=payload.destination, **kwargs)
+    result = await driver.process(payload, routing_key=payload.destination, **kwargs)
+    if getattr(result, 'success', True):
+        LATENESS.labels(driver.workflow).observe(
+            time.time() - utils.timestamp(payload.reference_date),
+        )
+    return result
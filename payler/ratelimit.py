@@ -0,0 +1,90 @@
+"""Rate limiting of the re-injected payloads.
+
+Publications are spread by an optional random `jitter`, added to the time they
+are due, and limited by a token bucket per routing key, refilled with `rate`
+tokens per second and holding at most `burst` tokens. Payloads finding the
+bucket of their routing key empty are not waited for: they are deferred, and
+counted by the `payler_throttled_payloads` metric, so that one throttled
+routing key does not hold the publications to the others.
+"""
+import asyncio
+import random
+import time
+import typing
+
+from payler.metrics import THROTTLED_PAYLOADS
+
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    """Token bucket releasing `rate` acquisitions per second, by bursts of `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = None  # type: typing.Optional[float]
+
+    def take(self, now: float) -> float:
+        """Take a token at `now`, or return how long until one is available."""
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets and jitter by routing key.
+
+    `limits` maps routing keys to their `rate`, `burst` and `jitter` (in
+    milliseconds), the other ones using `default`. A `rate` of 0 disables
+    the token bucket.
+    """
+
+    def __init__(self, default: typing.Dict[str, float],
+                 limits: typing.Optional[typing.Dict[str, dict]] = None,
+                 workflow: str = ''):
+        self.default = default
+        self.limits = limits or {}
+        self.workflow = workflow
+        self.buckets = {}  # type: typing.Dict[str, typing.Optional[TokenBucket]]
+
+    def _option(self, routing_key: str, key: str) -> float:
+        return float(self.limits.get(routing_key, {}).get(key, self.default[key]))
+
+    def bucket(self, routing_key: str) -> typing.Optional[TokenBucket]:
+        """Return the token bucket of `routing_key`, None when unlimited."""
+        if routing_key not in self.buckets:
+            rate = self._option(routing_key, 'rate')
+            self.buckets[routing_key] = None
+            if rate > 0:
+                self.buckets[routing_key] = TokenBucket(
+                    rate,
+                    int(self._option(routing_key, 'burst')),
+                )
+        return self.buckets[routing_key]
+
+    async def acquire(self, routing_key: str, due: typing.Optional[float] = None) -> float:
+        """Wait for the jitter, then take a token of `routing_key`.
+
+        The jitter delays a payload up to `jitter` milliseconds past its `due`
+        timestamp (now by default): payloads released late are not delayed.
+        Return 0 once the payload can be published, or how long until a token
+        is available, in seconds, when the payload has to be deferred.
+        """
+        jitter = self._option(routing_key, 'jitter')
+        if jitter:
+            if due is None:
+                due = time.time()
+            delay = due + random.uniform(0, jitter / 1000) - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        bucket = self.bucket(routing_key)
+        if bucket is None:
+            return 0.0
+        retry_after = bucket.take(time.monotonic())
+        if retry_after:
+            THROTTLED_PAYLOADS.labels(self.workflow, routing_key).inc()
+        return retry_after
@@ -0,0 +1,271 @@
+"""Storage of spooled payloads in Redis.
+
+Payload identifiers are kept in a sorted set scored by their `reference_date`
+in epoch milliseconds, and their bodies in one hash per payload. Matured
+payloads are claimed atomically by a Lua script, which moves them to a
+`processing` sorted set scored by the expiry of their lease: payloads claimed
+by a stopped watcher are claimed again once their lease expired.
+"""
+import asyncio
+import time
+import typing
+import uuid
+
+import pendulum
+import redis.asyncio
+
+from payler import compression
+from payler.driver import DriverConfiguration, Result
+from payler.metrics import INSERT_LATENCY
+from payler.structs import Payload
+from payler.watcher import WatchingDriver
+
+# KEYS: schedule, processing - ARGV: now, count, lease expiry, payload key prefix
+CLAIM_SCRIPT = '''
+local count = tonumber(ARGV[2])
+local ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, count)
+if #ids < count then
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, count - #ids)
+    if #due > 0 then
+        redis.call('ZREM', KEYS[1], unpack(due))
+        for _, id in ipairs(due) do
+            table.insert(ids, id)
+        end
+    end
+end
+local claimed = {}
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[2], ARGV[3], id)
+    table.insert(claimed, {id, redis.call('HGETALL', ARGV[4] .. id)})
+end
+return claimed
+'''
+
+
+def _milliseconds(timestamp: float) -> int:
+    return int(timestamp * 1000)
+
+
+class RedisManager(WatchingDriver):  # pylint: disable=too-many-instance-attributes
+    """Service to store payloads in a Redis sorted set."""
+    STORAGE = 'Redis'
+    DEFAULTS = {
+        'prefix': 'payler',
+        'sleep_duration': 30,
+        'claim_size': 100,
+        'lease_duration': 60,
+        'max_concurrency': 16,
+        'max_documents_per_cycle': 10000,
+        'compression': None,
+        'compression_threshold': 1024,
+    }
+
+    def __init__(self, configuration: DriverConfiguration):
+        """Create the Redis client, connections being opened on first use."""
+        super().__init__(configuration)
+        extra = configuration.extra
+        self.url = configuration.url
+        self.client = redis.asyncio.from_url(configuration.url)
+        prefix = extra.get('prefix', self.DEFAULTS['prefix'])
+        self.prefix = prefix
+        self.schedule_key = f'{prefix}:schedule'
+        self.processing_key = f'{prefix}:processing'
+        self.payload_prefix = f'{prefix}:payload:'
+        self.sleep_duration = float(extra.get('sleep_duration', self.DEFAULTS['sleep_duration']))
+        self.claim_size = int(extra.get('claim_size', self.DEFAULTS['claim_size']))
+        self.lease_duration = float(extra.get('lease_duration', self.DEFAULTS['lease_duration']))
+        self.max_concurrency = int(extra.get('max_concurrency', self.DEFAULTS['max_concurrency']))
+        self.max_documents_per_cycle = int(extra.get(
+            'max_documents_per_cycle',
+            self.DEFAULTS['max_documents_per_cycle'],
+        ))
+        self.compression = extra.get('compression', self.DEFAULTS['compression'])
+        if self.compression is not None:
+            compression.get_codec(self.compression)
+        self.compression_threshold = int(extra.get(
+            'compression_threshold',
+            self.DEFAULTS['compression_threshold'],
+        ))
+        self._claim = self.client.register_script(CLAIM_SCRIPT)
+
+    def __str__(self):
+        return f'{type(self)} - {self.prefix}'
+
+    @property
+    def storage_key(self) -> tuple:
+        return (self.url, self.prefix)
+
+    async def setup(self, **kwargs) -> typing.Any:
+        """Nothing to prepare, Redis keys being created on first write."""
+        return None
+
+    async def is_reachable(self) -> bool:
+        """Ensure connection integrity."""
+        return bool(await self.client.ping())
+
+    async def depth(self) -> int:
+        """Return the number of spooled payloads, claimed or not."""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.schedule_key)
+            pipe.zcard(self.processing_key)
+            counts = await pipe.execute()
+        return sum(counts)
+
+    def _fields(self, payload: Payload) -> typing.Dict[str, typing.Any]:
+        """Return the hash fields storing `payload`."""
+        message, codec = compression.compress(
+            payload.message,
+            self.compression,
+            self.compression_threshold,
+        )
+        fields = {
+            'message': message,
+            'reference_date': _milliseconds(payload.reference_date.timestamp()),
+            'source': payload.source,
+            'destination': payload.destination,
+            'priority': payload.priority,
+        }
+        if codec is not None:
+            fields['codec'] = codec
+        return fields
+
+    async def process_many(self, payloads: typing.List[Payload],
+                           **kwargs) -> typing.List[Result]:
+        """Store the Payloads using a single transaction.
+
+        When Redis is unavailable, every Result is unsuccessful so that the
+        incoming messages are delivered again.
+        """
+        identifiers = [uuid.uuid4().hex for _ in payloads]
+        success = True
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                for identifier, payload in zip(identifiers, payloads):
+                    fields = self._fields(payload)
+                    pipe.hset(self.payload_prefix + identifier, mapping=fields)
+                    pipe.zadd(self.schedule_key, {identifier: fields['reference_date']})
+                with INSERT_LATENCY.labels(self.workflow).time():
+                    await pipe.execute()
+        except redis.RedisError as err:
+            self.logger.error('Could not store %d payloads: %s', len(payloads), err)
+            success = False
+        if success:
+            self._notify_watchers(min(payload.reference_date.timestamp() for payload in payloads))
+            self.logger.debug('stored %d payloads kwargs=%s', len(payloads), kwargs)
+        return [
+            Result(
+                success=success,
+                headers={'location': self.schedule_key},
+                payload=payload,
+                data=identifier,
+            )
+            for identifier, payload in zip(identifiers, payloads)
+        ]
+
+    async def process(self, payload: Payload, **kwargs) -> Result:
+        """Store the Payload along its metadatas."""
+        results = await self.process_many([payload], **kwargs)
+        return results[0]
+
+    @staticmethod
+    def _document(identifier: bytes, fields: typing.List[bytes]) -> dict:
+        """Return the document handed to the action from the claimed hash fields."""
+        values = dict(zip(fields[::2], fields[1::2]))
+        codec = values.get(b'codec')
+        return {
+            '_id': identifier.decode(),
+            'message': values[b'message'],
+            'reference_date': pendulum.from_timestamp(int(values[b'reference_date']) / 1000),
+            'source': values[b'source'].decode(),
+            'destination': values[b'destination'].decode(),
+            'codec': codec.decode() if codec is not None else None,
+            'priority': int(values.get(b'priority', 0)),
+        }
+
+    async def _claim_ready(self, size: int) -> typing.List[dict]:
+        """Atomically claim up to `size` matured payloads, including expired claims.
+
+        Payloads are claimed by due date, and returned by priority within a claim.
+        """
+        now = time.time()
+        claimed = await self._claim(
+            keys=[self.schedule_key, self.processing_key],
+            args=[
+                _milliseconds(now),
+                size,
+                _milliseconds(now + self.lease_duration),
+                self.payload_prefix,
+            ],
+            client=self.client,
+        )
+        documents = []
+        missing = []
+        for identifier, fields in claimed:
+            if fields:
+                documents.append(self._document(identifier, fields))
+            else:
+                missing.append(identifier)
+        if missing:
+            await self.client.zrem(self.processing_key, *missing)
+        documents.sort(key=lambda doc: -doc['priority'])
+        return documents
+
+    async def _release(self, done: typing.List[dict], failed: typing.List[dict]):
+        """Delete the processed payloads and schedule the failed ones again."""
+        async with self.client.pipeline(transaction=True) as pipe:
+            for doc in done:
+                pipe.zrem(self.processing_key, doc['_id'])
+                pipe.delete(self.payload_prefix + doc['_id'])
+            for doc in failed:
+                pipe.zrem(self.processing_key, doc['_id'])
+                pipe.zadd(self.schedule_key, {
+                    doc['_id']: _milliseconds(doc['reference_date'].timestamp()),
+                })
+            await pipe.execute()
+
+    async def process_and_cleanup(self) -> int:
+        """Process the matured payloads by claims of `claim_size`.
+
+        Processed payloads are deleted after each claim, failed ones are
+        scheduled again at the end of the pass. A pass handles at most
+        `max_documents_per_cycle` payloads (0 meaning unlimited) and returns
+        the number of payloads fetched; the number of payloads removed is kept
+        in `_removed`.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._removed = 0
+        fetched = 0
+        failed = []  # type: typing.List[dict]
+        while True:
+            size = self.claim_size
+            if self.max_documents_per_cycle:
+                size = min(size, self.max_documents_per_cycle - fetched)
+                if size <= 0:
+                    break
+            documents = await self._claim_ready(size)
+            if not documents:
+                break
+            fetched += len(documents)
+            processed = await asyncio.gather(
+                *(self._process_document(doc, semaphore) for doc in documents),
+            )
+            failed.extend(doc for doc, done in zip(documents, processed) if not done)
+            removed = [doc for doc, done in zip(documents, processed) if done]
+            await self._release(removed, [])
+            self._removed += len(removed)
+        if failed:
+            await self._release([], failed)
+        self.logger.info('Processed %d jobs', fetched)
+        return fetched
+
+    async def _next_due(self, after: float) -> typing.Optional[float]:
+        """Return the earliest timestamp past `after` at which a payload can be claimed."""
+        scores = []
+        for key in (self.schedule_key, self.processing_key):
+            first = await self.client.zrangebyscore(
+                key, f'({_milliseconds(after)}', '+inf', start=0, num=1, withscores=True,
+            )
+            scores.extend(score for _, score in first)
+        if not scores:
+            return None
+        return min(scores) / 1000
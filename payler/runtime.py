@@ -6,18 +6,62 @@
     workflows:
       - name: 'Consume broker payloads and store'
         callable: "client.process_queue"
+        input:
+          driver: broker
+          prefetch_count: 100
+          max_concurrency: 16
+        output:
+          driver: redis
+          url: "redis://localhost:6379/1"
       - name: "Poll storage and re-inject in RabbitMQ"
         callable: "client.watch_storage"
+        input:
+          driver: redis
+          url: "redis://localhost:6379/1"
+          sleep_duration: 5
 
-The default runtime will start every workflow in a background thread.
+The optional `input`, `output` and `spooler` mappings declare the drivers of the
+workflow (see `DRIVERS`), their `url` (defaulting to the matching setting) and
+their options. They are resolved into `DriverSpec` passed to the workflow
+callable as keyword arguments, which builds its drivers from them.
+
+A top-level `backpressure` mapping shares a `BackpressureController` with the
+options it holds between the workflows, which throttle or pause their broker
+consumers when the spool is under pressure.
+
+The default runtime will start every workflow on a single event loop. When a
+workflow declares `replicas: N`, every workflow instead runs in its own worker
+processes (see `Supervisor`), each one with its own event loop and connections.
 """
 from asyncio.events import AbstractEventLoop
 import asyncio
 from dataclasses import dataclass, field
 import importlib
-from typing import Callable, Dict, List
+import logging
+import multiprocessing
+import signal
+import time
+from typing import Any, Callable, Dict, List, Optional
 
+from payler import config, metrics, utils
+from payler.backpressure import BackpressureController
+from payler.driver import BaseDriver, DriverConfiguration
 from payler.errors import ProcessingError
+from payler.logs import build_logger
+
+
+# Workflow entries passed to the workflow callable
+WORKFLOW_OPTIONS = ('input', 'output', 'spooler')
+
+# Drivers selectable with the `driver` key of a workflow entry, along the
+# setting holding their default URL
+DRIVERS = {
+    'broker': ('payler.broker', 'BrokerManager', 'BROKER_URL'),
+    'mongodb': ('payler.db', 'SpoolManager', 'MONGODB_URL'),
+    'redis': ('payler.redis', 'RedisManager', 'REDIS_URL'),
+    'sqlite': ('payler.sqlite', 'SQLiteManager', 'SQLITE_URL'),
+    'wheel': ('payler.wheel', 'WheelManager', None),
+}  # type: Dict[str, tuple]
 
 
 @dataclass
@@ -31,7 +75,7 @@ class Workflow:
 
     def register_action(self):
         """Register self.action as an asyncio.Future."""
-        self.future = asyncio.ensure_future(self.action(self.loop))
+        self.future = asyncio.ensure_future(self.action(self.loop, **(self.kwargs or {})))
 
 
 def get_callable(location: str = "payler", process: str = None):
@@ -57,8 +101,99 @@ def get_callable(location: str = "payler", process: str = None):
         ) from err
 
 
-def register_workflows(workflow_config: List[Dict[str, str]],
-                       loop: AbstractEventLoop) -> List[Workflow]:
+@dataclass
+class DriverSpec:
+    """Driver declared by a workflow entry, along its options.
+
+    `driver` is None when the workflow callable should use its default driver.
+    """
+    driver: Optional[str] = None
+    url: Optional[str] = None
+    options: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, entry: Optional[Dict[str, Any]]) -> 'DriverSpec':
+        """Create the DriverSpec matching a workflow `input`/`output` mapping."""
+        options = dict(entry or {})
+        driver = options.pop('driver', None)
+        if driver is not None and driver not in DRIVERS:
+            raise ProcessingError(f'Unknown driver {driver}, expected one of {sorted(DRIVERS)}')
+        return cls(driver, options.pop('url', None), options)
+
+    async def build(self, name: str, loop: AbstractEventLoop, logger: logging.Logger,
+                    default: str, workflow: Optional[str] = None) -> BaseDriver:
+        """Create the driver, `default` being used when none was declared.
+
+        `workflow` names the workflow running the driver, to label its metrics.
+        """
+        location, class_name, url_setting = DRIVERS[self.driver or default]
+        driver_class = get_callable(location, class_name)
+        url = self.url
+        if url is None and url_setting is not None:
+            url = config.get(url_setting)
+        configuration = DriverConfiguration(
+            name,
+            url,
+            loop,
+            logger,
+            dict(self.options),
+            workflow,
+        )
+        create = getattr(driver_class, 'create', None)
+        if create is not None:
+            return await create(configuration)
+        return driver_class(configuration)
+
+
+def driver_spec(entry: Any) -> DriverSpec:
+    """Return `entry` as a DriverSpec, converting plain mappings."""
+    if isinstance(entry, DriverSpec):
+        return entry
+    return DriverSpec.from_config(entry)
+
+
+def check_workflow(item: Dict[str, Any]):
+    """Refuse a workflow entry whose drivers cannot work together.
+
+    Replicas of `client.watch_storage` watching a MongoDB spool would publish
+    the same payloads unless they claim them with leases (`lease_duration`)
+    or split the spool with one shard each (`shard_count`).
+    """
+    name = item.get('name', 'unnamed')
+    process = item.get('callable') or ''
+    source = item.get('input') or {}
+    batch_size = int(source.get('batch_size', 1))
+    if process.endswith('process_queue_in_memory') and batch_size > 1:
+        raise ProcessingError(
+            f'Workflow {name} holds messages one by one, its input batch_size must be 1',
+        )
+    replicas = int(item.get('replicas', 1))
+    if not process.endswith('watch_storage') or replicas <= 1:
+        return
+    if source.get('driver', 'mongodb') != 'mongodb' or float(source.get('lease_duration', 0)):
+        return
+    if int(source.get('shard_count', 1)) != replicas:
+        raise ProcessingError(
+            f'Workflow {name} runs {replicas} watchers of the same spool, '
+            f'set its input lease_duration or a shard_count of {replicas}',
+        )
+
+
+def replica_item(item: Dict[str, Any], index: int) -> Dict[str, Any]:
+    """Return the workflow entry run by the replica `index`.
+
+    A replica watching a sharded spool processes the shard matching its index,
+    unless the entry sets its `shard_index`.
+    """
+    source = item.get('input') or {}
+    if 'shard_count' not in source or 'shard_index' in source:
+        return item
+    return dict(item, input=dict(source, shard_index=index))
+
+
+def register_workflows(workflow_config: List[Dict[str, Any]],
+                       loop: AbstractEventLoop,
+                       backpressure: Optional[Dict[str, Any]] = None) -> List[Workflow]:
     """Transform the `workflows` config entry in a list of `Workflow`.
 
     This function takes the `.workflows` list and creates the corresponding
@@ -70,15 +205,194 @@ def register_workflows(workflow_config: List[Dict[str, str]],
 
         - name: "Consume broker payloads and store in MongoDB"
           callable: "client.process_queue"
+          input:
+            prefetch_count: 100
+          output:
+            driver: mongodb
         - name: "Poll storage and re-inject in RabbitMQ"
           callable: "client.watch_storage"
+
+    The `input`, `output` and `spooler` entries are resolved into `DriverSpec`,
+    unknown drivers, or drivers which cannot work together (see
+    `check_workflow`), raising a ProcessingError. The callable also receives the
+    workflow name as `workflow` and, given `backpressure` options, the
+    `BackpressureController` shared by the workflows as `backpressure`.
     """
     workflows = []
+    controller = None
+    if backpressure is not None:
+        controller = BackpressureController(backpressure)
     for item in workflow_config:
+        check_workflow(item)
+        name = item.get('name', 'unnamed')
+        kwargs = {
+            key: DriverSpec.from_config(item[key]) for key in WORKFLOW_OPTIONS if key in item
+        }  # type: Dict[str, Any]
+        kwargs['workflow'] = name
+        if controller is not None:
+            kwargs['backpressure'] = controller
         workflow = Workflow(
-            item.get('name', 'unnamed'),
+            name,
             get_callable(process=item.get('callable')),
             loop,
+            kwargs=kwargs,
         )
         workflows.append(workflow)
     return workflows
+
+
+def has_replicas(workflow_config: List[Dict[str, Any]]) -> bool:
+    """Return True when a workflow asks for several worker processes."""
+    return any(int(item.get('replicas', 1)) > 1 for item in workflow_config)
+
+
+def run_worker(item: Dict[str, Any], backpressure: Optional[Dict[str, Any]] = None):
+    """Run a single workflow entry on a new event loop, in the current process.
+
+    The worker runs its own `backpressure` controller, if any.
+    """
+    utils.install_event_loop_policy(config.get('EVENT_LOOP'))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    workflow = register_workflows([item], loop, backpressure)[0]
+    workflow.register_action()
+    loop.run_until_complete(workflow.future)
+
+
+@dataclass
+class Replica:
+    """Worker process running a workflow entry."""
+    item: Dict[str, Any]
+    index: int
+    process: Optional[multiprocessing.process.BaseProcess] = None
+    restarts: int = 0
+    # consecutive crashes, the restart delay growing with them
+    failures: int = 0
+    started_at: float = 0.0
+    retry_at: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        """Human-friendly replica name."""
+        return f"{self.item.get('name', 'unnamed')}#{self.index}"
+
+
+class Supervisor:
+    """Start `replicas` worker processes per workflow and restart crashed ones.
+
+    Workers are spawned rather than forked, so that each of them starts its own
+    event loop and connections from a clean interpreter. Each one runs the
+    entry returned by `replica_item` for its index.
+
+    A crashed worker is restarted at once, then after `backoff` seconds,
+    doubled on every consecutive crash up to `max_backoff`; a worker which ran
+    for `max_backoff` seconds is restarted at once again. SIGTERM stops the
+    workers before exiting.
+    """
+
+    def __init__(self, workflow_config: List[Dict[str, Any]],  # pylint: disable=too-many-arguments
+                 logger: Optional[logging.Logger] = None,
+                 context: str = 'spawn',
+                 target: Callable[..., None] = run_worker,
+                 backpressure: Optional[Dict[str, Any]] = None,
+                 *,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0):
+        self.logger = logger or build_logger(self.__class__.__name__)
+        self.backpressure = backpressure
+        self.context = multiprocessing.get_context(context)
+        self.target = target
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        for item in workflow_config:
+            check_workflow(item)
+        self.replicas = [
+            Replica(item, index)
+            for item in workflow_config
+            for index in range(int(item.get('replicas', 1)))
+        ]
+
+    def _spawn(self, replica: Replica):
+        replica.process = self.context.Process(
+            target=self.target,
+            args=(replica_item(replica.item, replica.index),),
+            kwargs={'backpressure': self.backpressure} if self.backpressure is not None else {},
+            name=replica.name,
+            daemon=True,
+        )
+        replica.process.start()
+        replica.started_at = time.monotonic()
+        self.logger.info('Started worker %s with pid=%s', replica.name, replica.process.pid)
+
+    def start(self):
+        """Start every replica."""
+        for replica in self.replicas:
+            self._spawn(replica)
+
+    def _schedule_restart(self, replica: Replica, now: float):
+        """Plan the restart of an exited replica, backing off on consecutive crashes."""
+        metrics.mark_process_dead(replica.process.pid)
+        if now - replica.started_at >= self.max_backoff:
+            replica.failures = 0
+        delay = 0.0
+        if replica.failures:
+            delay = min(self.max_backoff, self.backoff * 2 ** (replica.failures - 1))
+        replica.failures += 1
+        replica.retry_at = now + delay
+        self.logger.error(
+            'Worker %s with pid=%s exited with code=%s, restarting in %.1fs',
+            replica.name,
+            replica.process.pid,
+            replica.process.exitcode,
+            delay,
+        )
+
+    def check(self) -> int:
+        """Restart the replicas whose process exited, return how many were restarted."""
+        restarted = 0
+        now = time.monotonic()
+        for replica in self.replicas:
+            if replica.process is None or replica.process.is_alive():
+                continue
+            if replica.retry_at is None:
+                self._schedule_restart(replica, now)
+            if now < replica.retry_at:
+                continue
+            replica.retry_at = None
+            replica.restarts += 1
+            self._spawn(replica)
+            restarted += 1
+        return restarted
+
+    def stop(self, timeout: float = 10.0):
+        """Send SIGTERM to every replica, killing those still alive after `timeout` seconds."""
+        for replica in self.replicas:
+            if replica.process is not None and replica.process.is_alive():
+                replica.process.terminate()
+        deadline = time.monotonic() + timeout
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            replica.process.join(max(0.0, deadline - time.monotonic()))
+            if replica.process.is_alive():
+                self.logger.error(
+                    'Killing worker %s with pid=%s', replica.name, replica.process.pid,
+                )
+                replica.process.kill()
+                replica.process.join()
+
+    @staticmethod
+    def _terminate(signum: int, _frame: Any):
+        raise SystemExit(128 + signum)
+
+    def run(self, check_interval: float = 1.0):
+        """Start the replicas and watch them until interrupted or terminated."""
+        previous = signal.signal(signal.SIGTERM, self._terminate)
+        self.start()
+        try:
+            while True:
+                time.sleep(check_interval)
+                self.check()
+        finally:
+            self.stop()
+            signal.signal(signal.SIGTERM, previous)
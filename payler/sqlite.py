@@ -0,0 +1,383 @@
+"""Embedded storage of spooled payloads in a local SQLite database.
+
+The database runs in WAL mode, so that the watcher reads while payloads are
+being written, and is only accessed from a dedicated thread. Payloads stored
+using `process` are committed together by groups of `commit_size`, or every
+`commit_interval` milliseconds.
+
+Payloads are claimed for `lease_duration` seconds before being processed and
+deleted once done: payloads claimed by a stopped process are claimed again
+once their lease expired, or made pending again by `setup`.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import sqlite3
+import time
+import typing
+
+import pendulum
+
+from payler import compression
+from payler.driver import DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.logs import SAMPLED
+from payler.metrics import INSERT_LATENCY
+from payler.structs import Payload
+from payler.watcher import WatchingDriver
+
+STATE_PENDING = 'pending'
+STATE_CLAIMED = 'claimed'
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message BLOB NOT NULL,
+        reference_date REAL NOT NULL,
+        source TEXT NOT NULL,
+        destination TEXT NOT NULL,
+        codec TEXT,
+        state TEXT NOT NULL DEFAULT 'pending',
+        priority INTEGER NOT NULL DEFAULT 0,
+        lease_expiry REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS {table}_reference_date ON {table} (state, reference_date)',
+    'CREATE INDEX IF NOT EXISTS {table}_release ON {table} (state, priority DESC, reference_date)',
+    'CREATE INDEX IF NOT EXISTS {table}_lease ON {table} (state, lease_expiry)',
+)
+
+# Columns missing from the tables created by earlier releases
+ADDED_COLUMNS = (
+    ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+    ('lease_expiry', 'REAL'),
+)
+
+# Errors raised by the payloads themselves rather than by the database
+INVALID_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+URL_PREFIX = 'sqlite:///'
+
+
+def _path(url: str) -> str:
+    """Return the database path of a `sqlite:///path` URL, or the URL itself."""
+    if url.startswith(URL_PREFIX):
+        return url[len(URL_PREFIX):]
+    return url
+
+
+class SQLiteManager(WatchingDriver):  # pylint: disable=too-many-instance-attributes
+    """Service to store payloads in a local SQLite database."""
+    STORAGE = 'SQLite'
+    DEFAULTS = {
+        'table': 'payloads',
+        'sleep_duration': 30,
+        'claim_size': 100,
+        'lease_duration': 60,
+        'max_concurrency': 16,
+        'commit_size': 100,
+        'commit_interval': 10,
+        'synchronous': 'NORMAL',
+        'compression': None,
+        'compression_threshold': 1024,
+    }
+
+    def __init__(self, configuration: DriverConfiguration):
+        """Prepare the database access, the file being opened on first use."""
+        super().__init__(configuration)
+        extra = configuration.extra
+        self.path = _path(configuration.url)
+        self.table = extra.get('table', self.DEFAULTS['table'])
+        self.sleep_duration = float(extra.get('sleep_duration', self.DEFAULTS['sleep_duration']))
+        self.claim_size = int(extra.get('claim_size', self.DEFAULTS['claim_size']))
+        self.lease_duration = float(extra.get('lease_duration', self.DEFAULTS['lease_duration']))
+        self.max_concurrency = int(extra.get('max_concurrency', self.DEFAULTS['max_concurrency']))
+        self.commit_size = int(extra.get('commit_size', self.DEFAULTS['commit_size']))
+        self.commit_interval = float(extra.get(
+            'commit_interval',
+            self.DEFAULTS['commit_interval'],
+        ))
+        self.synchronous = extra.get('synchronous', self.DEFAULTS['synchronous'])
+        self.compression = extra.get('compression', self.DEFAULTS['compression'])
+        if self.compression is not None:
+            compression.get_codec(self.compression)
+        self.compression_threshold = int(extra.get(
+            'compression_threshold',
+            self.DEFAULTS['compression_threshold'],
+        ))
+        self.connection = None  # type: typing.Optional[sqlite3.Connection]
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []  # type: typing.List[typing.Tuple[tuple, asyncio.Future]]
+        self._flush = None  # type: typing.Optional[asyncio.TimerHandle]
+
+    def __str__(self):
+        return f'{type(self)} - {self.path}'
+
+    @property
+    def storage_key(self) -> tuple:
+        return (self.path, self.table)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                self.path,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(f'PRAGMA synchronous={self.synchronous}')
+            # writers may not run `setup`
+            table, *indexes = SCHEMA
+            self.connection.execute(table.format(table=self.table))
+            columns = {
+                row[1] for row in self.connection.execute(f'PRAGMA table_info({self.table})')
+            }
+            for name, declaration in ADDED_COLUMNS:
+                if name not in columns:
+                    self.connection.execute(
+                        f'ALTER TABLE {self.table} ADD COLUMN {name} {declaration}',
+                    )
+            for statement in indexes:
+                self.connection.execute(statement.format(table=self.table))
+        return self.connection
+
+    @contextlib.contextmanager
+    def _transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        """Run statements in an immediate transaction, rolled back on errors."""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    async def _run(self, function: typing.Callable, *args) -> typing.Any:
+        """Run `function` in the database thread."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _recover(self) -> int:
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                f'UPDATE {self.table} SET state = ?, lease_expiry = NULL '
+                'WHERE state = ? AND (lease_expiry IS NULL OR lease_expiry <= ?)',
+                (STATE_PENDING, STATE_CLAIMED, time.time()),
+            )
+        return cursor.rowcount
+
+    async def setup(self, **kwargs) -> typing.Any:
+        """Recover the payloads of a previous run.
+
+        The table and its indexes are created when opening the database.
+        Payloads claimed by a previous run whose lease expired are made
+        pending again, and their number is returned; payloads claimed by a
+        running watcher are left alone.
+        """
+        recovered = await self._run(self._recover)
+        if recovered:
+            self.logger.warning('Recovered %d claimed payloads', recovered)
+        return recovered
+
+    async def is_reachable(self) -> bool:
+        """Ensure the database can be opened."""
+        row = await self._run(lambda: self._connect().execute('SELECT 1').fetchone())
+        return row is not None
+
+    async def depth(self) -> int:
+        """Return the number of spooled payloads."""
+        row = await self._run(
+            lambda: self._connect().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone(),
+        )
+        return row[0]
+
+    def _row(self, payload: Payload) -> tuple:
+        message, codec = compression.compress(
+            payload.message,
+            self.compression,
+            self.compression_threshold,
+        )
+        return (
+            message,
+            payload.reference_date.timestamp(),
+            payload.source,
+            payload.destination,
+            codec,
+            payload.priority,
+        )
+
+    def _insert(self, rows: typing.List[tuple]) -> typing.List[int]:
+        with self._transaction() as connection:
+            return [
+                connection.execute(
+                    f'INSERT INTO {self.table} '
+                    '(message, reference_date, source, destination, codec, priority) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    row,
+                ).lastrowid
+                for row in rows
+            ]
+
+    async def _store(self, rows: typing.List[tuple]) -> typing.List[typing.Optional[int]]:
+        """Insert `rows` in a single transaction and return their ids.
+
+        The ids are None when the database is unavailable (locked, full...),
+        in which case the payloads should be delivered again.
+        """
+        try:
+            with INSERT_LATENCY.labels(self.workflow).time():
+                return await self._run(self._insert, rows)
+        except INVALID_ERRORS as err:
+            raise ProcessingError(f'Invalid payload: {err}') from err
+        except sqlite3.Error as err:
+            self.logger.error('Could not store %d payloads: %s', len(rows), err)
+            return [None] * len(rows)
+
+    async def _commit_pending(self):
+        """Insert the pending rows in a single transaction and resolve their futures."""
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            identifiers = await self._store([row for row, _ in pending])
+        except ProcessingError as err:
+            for _, future in pending:
+                future.set_exception(err)
+            return
+        for (_, future), identifier in zip(pending, identifiers):
+            future.set_result(identifier)
+
+    async def process(self, payload: Payload, **kwargs) -> Result:
+        """Store the Payload, once committed along the other pending payloads."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((self._row(payload), future))
+        if len(self._pending) >= self.commit_size:
+            asyncio.ensure_future(self._commit_pending())
+        elif self._flush is None:
+            self._flush = loop.call_later(
+                self.commit_interval / 1000,
+                lambda: asyncio.ensure_future(self._commit_pending()),
+            )
+        identifier = await future
+        if identifier is not None:
+            self._notify_watchers(payload.reference_date.timestamp())
+            self.logger.debug(
+                'stored payload with id=%s reference_date=%s kwargs=%s',
+                identifier,
+                payload.reference_date,
+                kwargs,
+                extra=SAMPLED,
+            )
+        return Result(
+            success=identifier is not None,
+            headers={'location': self.table},
+            payload=payload,
+            data=identifier,
+        )
+
+    async def process_many(self, payloads: typing.List[Payload],
+                           **kwargs) -> typing.List[Result]:
+        """Store the Payloads in a single transaction."""
+        identifiers = await self._store([self._row(payload) for payload in payloads])
+        if None not in identifiers:
+            self._notify_watchers(min(payload.reference_date.timestamp() for payload in payloads))
+            self.logger.debug('stored %d payloads kwargs=%s', len(identifiers), kwargs)
+        return [
+            Result(
+                success=identifier is not None,
+                headers={'location': self.table},
+                payload=payload,
+                data=identifier,
+            )
+            for payload, identifier in zip(payloads, identifiers)
+        ]
+
+    def _claim(self, match_date: float) -> typing.List[dict]:
+        """Claim the payloads due before `match_date`, by priority then date.
+
+        Payloads are pending, or claimed by a watcher whose lease expired.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute(
+                'SELECT id, message, reference_date, source, destination, codec, priority '
+                f'FROM {self.table} WHERE reference_date <= ? AND '
+                '(state = ? OR (state = ? AND lease_expiry <= ?)) '
+                'ORDER BY priority DESC, reference_date LIMIT ?',
+                (match_date, STATE_PENDING, STATE_CLAIMED, now, self.claim_size),
+            ).fetchall()
+            connection.executemany(
+                f'UPDATE {self.table} SET state = ?, lease_expiry = ? WHERE id = ?',
+                [(STATE_CLAIMED, now + self.lease_duration, row[0]) for row in rows],
+            )
+        return [
+            {
+                '_id': identifier,
+                'message': message,
+                'reference_date': pendulum.from_timestamp(reference_date),
+                'source': source,
+                'destination': destination,
+                'codec': codec,
+                'priority': priority,
+            }
+            for identifier, message, reference_date, source, destination, codec, priority in rows
+        ]
+
+    def _release(self, done: typing.List[int], failed: typing.List[int]):
+        """Delete the processed payloads and make the failed ones pending again."""
+        with self._transaction() as connection:
+            connection.executemany(
+                f'DELETE FROM {self.table} WHERE id = ?',
+                [(identifier,) for identifier in done],
+            )
+            connection.executemany(
+                f'UPDATE {self.table} SET state = ?, lease_expiry = NULL WHERE id = ?',
+                [(STATE_PENDING, identifier) for identifier in failed],
+            )
+
+    def _next_reference_date(self, after: float) -> typing.Optional[float]:
+        row = self._connect().execute(
+            f'SELECT (SELECT MIN(reference_date) FROM {self.table} '
+            'WHERE state = ? AND reference_date > ?), '
+            f'(SELECT MIN(lease_expiry) FROM {self.table} WHERE state = ? AND lease_expiry > ?)',
+            (STATE_PENDING, after, STATE_CLAIMED, after),
+        ).fetchone()
+        dates = [date for date in row if date is not None]
+        return min(dates) if dates else None
+
+    async def _next_due(self, after: float) -> typing.Optional[float]:
+        """Return the earliest date past `after` at which a payload can be claimed."""
+        return await self._run(self._next_reference_date, after)
+
+    async def process_and_cleanup(self) -> int:
+        """Process the matured payloads by claims of `claim_size`.
+
+        Processed payloads are deleted after each claim, failed ones are made
+        pending again at the end of the pass. Return the number of payloads
+        fetched; the number of payloads removed is kept in `_removed`.
+        """
+        match_date = time.time()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._removed = 0
+        fetched = 0
+        failed = []  # type: typing.List[int]
+        while True:
+            documents = await self._run(self._claim, match_date)
+            if not documents:
+                break
+            fetched += len(documents)
+            processed = await asyncio.gather(
+                *(self._process_document(doc, semaphore) for doc in documents),
+            )
+            failed.extend(doc['_id'] for doc, done in zip(documents, processed) if not done)
+            removed = [doc['_id'] for doc, done in zip(documents, processed) if done]
+            await self._run(self._release, removed, [])
+            self._removed += len(removed)
+        if failed:
+            await self._run(self._release, [], failed)
+        self.logger.info('Processed %d jobs with match_date=%s', fetched, match_date)
+        return fetched
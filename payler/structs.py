@@ -3,28 +3,51 @@ from datetime import datetime
 import json
 
 from typing import Any
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(init=False)
 class Payload:
     """Wrapper around the actual payload.
 
     Wrap the payload content and provide metadata for payler.
+    The class is slotted and never copies `message`, which is kept as received
+    (usually the `bytes` body of the original message).
 
     message: Original payload  # NOTE: could be pickled
     reup_time: Date after which the payload should be sent to the output queue.
     source: Queue from which the payload originated
     destination: Queue to which the payload should be sent back
+    priority: Release priority, higher values being released first
     """
+    __slots__ = ('message', 'reference_date', 'source', 'destination', 'priority')
     message: Any
     reference_date: datetime
     source: str
     destination: str
+    priority: int
+
+    def __init__(self, message: Any, reference_date: datetime, source: str, destination: str,
+                 priority: int = 0):
+        # slotted fields cannot have dataclass defaults
+        self.message = message
+        self.reference_date = reference_date
+        self.source = source
+        self.destination = destination
+        self.priority = priority
 
     def asdict(self) -> dict:
-        """Return a the Payload using a dictionary representation."""
-        return asdict(self)
+        """Return a the Payload using a dictionary representation.
+
+        Unlike `dataclasses.asdict`, the message is not deep-copied.
+        """
+        return {
+            'message': self.message,
+            'reference_date': self.reference_date,
+            'source': self.source,
+            'destination': self.destination,
+            'priority': self.priority,
+        }
 
     def message_as_amqp_job(self) -> bytes:
         """Format the payload for amqp processing."""
@@ -1 +1,34 @@
 """Utility functions for Payler."""
+import asyncio
+from datetime import datetime, timezone
+import importlib
+
+
+EVENT_LOOPS = ('auto', 'uvloop', 'asyncio')
+
+
+def install_event_loop_policy(name: str = 'auto') -> str:
+    """Install the event loop policy matching `name` and return the one in use.
+
+    `auto` picks uvloop when it is installed and falls back to asyncio.
+    """
+    if name not in EVENT_LOOPS:
+        raise RuntimeError(f'Unknown event loop {name}, expected one of {EVENT_LOOPS}')
+    if name == 'asyncio':
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    try:
+        uvloop = importlib.import_module('uvloop')
+    except ImportError as err:
+        if name == 'uvloop':
+            raise RuntimeError('uvloop is not installed') from err
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+def timestamp(date: datetime) -> float:
+    """Return the POSIX timestamp of `date`, naive dates being UTC as in MongoDB."""
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
@@ -0,0 +1,165 @@
+"""Watch loop shared by the drivers claiming matured payloads from a storage.
+
+A `WatchingDriver` processes the matured payloads by passes, sleeping until
+the next payload is due between two passes. Drivers of the same storage in a
+process wake up each other's watchers when storing payloads.
+
+An action can defer a payload by returning an unsuccessful `Result` with a
+`retry_after` header, in seconds: the payload is kept in storage, reported as
+`deferred`, and the watcher wakes up in time to retry it.
+"""
+from abc import abstractmethod
+import asyncio
+import collections
+import time
+import typing
+import weakref
+
+from payler.driver import BaseDriver, DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.logs import SAMPLED
+
+
+# Listening WatchingDrivers by storage, to wake them up on new payloads
+_WATCHERS = collections.defaultdict(weakref.WeakSet)  # type: typing.DefaultDict[tuple, typing.Any]
+
+
+class WatchingDriver(BaseDriver):
+    """Parent class of the drivers processing matured payloads by passes.
+
+    Subclasses implement `process_and_cleanup`, which returns the number of
+    payloads fetched and keeps the number removed in `_removed`, and
+    `_next_due`. `sleep_duration` and `max_documents_per_cycle` (0 meaning
+    unlimited) tune the loop.
+    """
+    # Name of the storage in the logs
+    STORAGE = 'storage'
+
+    def __init__(self, configuration: DriverConfiguration):
+        super().__init__(configuration)
+        self.sleep_duration = 30.0
+        self.max_documents_per_cycle = 0
+        self._removed = 0
+        self._wakeup = None  # type: typing.Optional[asyncio.Event]
+        self._wake_at = None  # type: typing.Optional[float]
+        self._retry_at = None  # type: typing.Optional[float]
+
+    @property
+    @abstractmethod
+    def storage_key(self) -> tuple:
+        """Identify the storage shared by the drivers to wake up."""
+
+    @abstractmethod
+    async def process_and_cleanup(self) -> int:
+        """Process the matured payloads and return the number fetched."""
+
+    @abstractmethod
+    async def _next_due(self, after: float) -> typing.Optional[float]:
+        """Return the earliest timestamp past `after` at which a payload can be claimed."""
+
+    def _max_wait(self) -> float:
+        """Return the longest wait between two passes."""
+        return self.sleep_duration
+
+    def _notify_watchers(self, due: float):
+        """Wake up the local watchers of the same storage planning to sleep past `due`."""
+        for watcher in _WATCHERS[self.storage_key]:
+            watcher.wake_up(due)
+
+    def wake_up(self, due: float):
+        """Interrupt the current wait if `due` comes before the planned wake up."""
+        if self._wakeup is None:
+            return
+        if self._wake_at is None or due < self._wake_at:
+            self._wakeup.set()
+
+    def _outcome(self, result: typing.Any, confirm: bool = False) -> str:
+        """Return the status of an action `result`: `success`, `deferred` or `failed`.
+
+        A falsy result, an unsuccessful `Result`, or anything but a `Result`
+        with `confirm`, keeps the payload in storage.
+        """
+        if not isinstance(result, Result):
+            return 'success' if result and not confirm else 'failed'
+        if result.success:
+            return 'success'
+        retry_after = result.headers.get('retry_after')
+        if retry_after is None:
+            return 'failed'
+        retry_at = time.time() + retry_after
+        if self._retry_at is None or retry_at < self._retry_at:
+            self._retry_at = retry_at
+        return 'deferred'
+
+    async def _process_document(self, doc: dict, semaphore: asyncio.Semaphore) -> bool:
+        """Apply the action to `doc` and tell whether it can be removed."""
+        async with semaphore:
+            try:
+                result = await self.action(doc, self.driver)
+            except ProcessingError as err:
+                self.logger.error('Could not process id=%s reason=%s', doc['_id'], err)
+                self._notify_done('failed')
+                return False
+        self.logger.debug(
+            'Processed job with id=%s result=%s', doc['_id'], result, extra=SAMPLED,
+        )
+        outcome = self._outcome(result)
+        self._notify_done(outcome)
+        return outcome == 'success'
+
+    async def _wait_next(self, last_pass: float):
+        """Sleep until the next payload due after the previous pass.
+
+        The wait never exceeds `_max_wait` (`sleep_duration` by default), to
+        retry the payloads left behind and catch up with payloads stored by
+        other processes, nor the time the earliest deferred payload can be
+        retried at, and is cut short when a local driver stores a payload due
+        before the planned wake up.
+        """
+        self._wakeup.clear()
+        next_due = await self._next_due(last_pass)
+        if self._retry_at is not None:
+            next_due = self._retry_at if next_due is None else min(next_due, self._retry_at)
+            self._retry_at = None
+        delay = self._max_wait()
+        if next_due is not None:
+            delay = max(0.0, min(delay, next_due - time.time()))
+        self._wake_at = time.time() + delay
+        self.logger.debug('waiting for %.3fs', delay)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # payloads stored during a pass are found by the next lookup
+            self._wake_at = None
+
+    async def listen(self, **kwargs):
+        """Process the matured payloads, sleeping until the next one is due.
+
+        A pass capped by `max_documents_per_cycle` is followed by the next one
+        at once, unless it removed no payload. Otherwise the watcher waits for
+        the next payload due (see `_wait_next`).
+        """
+        self.logger.info(
+            "Engaging %s polling - Applying (action=%s, driver=%s) to events",
+            self.STORAGE,
+            self.action.__name__,
+            type(self.driver),
+        )
+        if not kwargs.get('should_loop', True):
+            return await self.process_and_cleanup()
+        self._wakeup = asyncio.Event()
+        _WATCHERS[self.storage_key].add(self)
+        try:
+            while True:
+                last_pass = time.time()
+                fetched = await self.process_and_cleanup()
+                self._notify_cycle(time.time() - last_pass, fetched)
+                capped = self.max_documents_per_cycle and fetched >= self.max_documents_per_cycle
+                if capped and self._removed:
+                    # more matured payloads are waiting
+                    continue
+                await self._wait_next(last_pass)
+        finally:
+            _WATCHERS[self.storage_key].discard(self)
@@ -0,0 +1,226 @@
+"""In-memory storage for short-lived delays.
+
+Payloads due within `delay_threshold` milliseconds are kept in a hierarchical
+timing wheel instead of being spooled in a Database, and re-injected once they
+mature. Longer delays are handed over to the `spooler` driver, if any.
+
+Held payloads keep their incoming message unacknowledged until they are
+released, so the consumer `prefetch_count` bounds the number of payloads the
+wheel holds at once.
+"""
+import asyncio
+import math
+import time
+import typing
+
+from payler.driver import BaseDriver, DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.logs import SAMPLED
+from payler.structs import Payload
+
+
+class TimingWheel:
+    """Hierarchical timing wheel with O(1) insertion and expiry.
+
+    Level `n` holds `size` slots of `size ** n` ticks each. Entries are moved
+    down to a finer level when the current tick reaches their slot.
+    """
+
+    def __init__(self, size: int = 64, levels: int = 4, start: int = 0):
+        self.size = size
+        self.levels = levels
+        self.current = start
+        self.slots = [
+            [[] for _ in range(size)] for _ in range(levels)
+        ]  # type: typing.List[typing.List[typing.List[typing.Tuple[int, typing.Any]]]]
+        self.count = 0
+
+    @property
+    def span(self) -> int:
+        """Number of ticks covered by the wheel."""
+        return self.size ** self.levels
+
+    def _place(self, tick: int, item: typing.Any):
+        # overdue entries expire on the next tick
+        tick = max(tick, self.current + 1)
+        delta = tick - self.current
+        if delta >= self.span:
+            raise ValueError(f'tick {tick} is out of the wheel span')
+        level = 0
+        while delta >= self.size ** (level + 1):
+            level += 1
+        index = (tick // self.size ** level) % self.size
+        self.slots[level][index].append((tick, item))
+
+    def insert(self, tick: int, item: typing.Any):
+        """Schedule `item` to expire at `tick`."""
+        self._place(tick, item)
+        self.count += 1
+
+    def _cascade(self) -> typing.List[typing.Any]:
+        """Move the entries of the coarser slots reached by self.current."""
+        expired = []
+        for level in range(1, self.levels):
+            if self.current % self.size ** level:
+                break
+            index = (self.current // self.size ** level) % self.size
+            bucket, self.slots[level][index] = self.slots[level][index], []
+            for tick, item in bucket:
+                if tick <= self.current:
+                    expired.append(item)
+                else:
+                    self._place(tick, item)
+        return expired
+
+    def advance(self, tick: int) -> typing.List[typing.Any]:
+        """Move the wheel up to `tick` and return the expired items."""
+        expired = []  # type: typing.List[typing.Any]
+        if not self.count:
+            self.current = max(self.current, tick)
+            return expired
+        while self.current < tick:
+            self.current += 1
+            expired.extend(self._cascade())
+            index = self.current % self.size
+            bucket, self.slots[0][index] = self.slots[0][index], []
+            expired.extend(item for _, item in bucket)
+        self.count -= len(expired)
+        return expired
+
+
+class WheelManager(BaseDriver):
+    """Service to hold payloads in memory until they mature."""
+    DEFAULTS = {
+        'tick_duration': 0.01,
+        'wheel_size': 64,
+        'wheel_levels': 4,
+        'delay_threshold': 5000,
+    }
+
+    def __init__(self, configuration: DriverConfiguration):
+        super().__init__(configuration)
+        extra = configuration.extra
+        self.tick_duration = float(extra.get('tick_duration', self.DEFAULTS['tick_duration']))
+        self.delay_threshold = int(extra.get('delay_threshold', self.DEFAULTS['delay_threshold']))
+        self.wheel = TimingWheel(
+            int(extra.get('wheel_size', self.DEFAULTS['wheel_size'])),
+            int(extra.get('wheel_levels', self.DEFAULTS['wheel_levels'])),
+            self._tick(time.time()),
+        )
+        max_delay = self.wheel.span * self.tick_duration * 1000
+        if self.delay_threshold >= max_delay:
+            raise ProcessingError(
+                f'delay_threshold must be lower than the wheel span ({max_delay:.0f}ms)',
+            )
+
+    def _tick(self, timestamp: float) -> int:
+        return math.ceil(timestamp / self.tick_duration)
+
+    async def setup(self, **kwargs) -> typing.Any:
+        """Nothing to prepare for an in-memory storage."""
+        return None
+
+    async def is_reachable(self) -> bool:
+        """The wheel is always available."""
+        return True
+
+    async def process(self, payload: Payload, **kwargs) -> Result:
+        """Hold the Payload in memory, or spool it when due later than `delay_threshold`.
+
+        The incoming `message` passed in kwargs is acknowledged once the payload
+        has been re-injected.
+        """
+        due = payload.reference_date.timestamp()
+        spooler = self.kwargs.get('spooler')
+        if spooler is not None and (due - time.time()) * 1000 > self.delay_threshold:
+            return await spooler.process(payload)
+
+        message = kwargs.get('message')
+        try:
+            self.wheel.insert(self._tick(due), (payload, message))
+        except ValueError as err:
+            raise ProcessingError('Payload is due too late to be held in memory') from err
+        self.logger.debug('holding payload due for %s', payload.reference_date, extra=SAMPLED)
+        headers = {'location': 'memory', 'deferred_ack': message is not None}
+        return Result(
+            success=True,
+            headers=headers,
+            payload=payload,
+            data=None,
+        )
+
+    async def _release(self, payload: Payload, message: typing.Any):
+        """Apply the action to a matured payload, then acknowledge its message.
+
+        The message of a payload which could not be released is requeued. A
+        payload deferred by the action, returning an unsuccessful `Result`
+        with a `retry_after` header, is held again until it can be retried.
+        """
+        released = True
+        try:
+            result = await self.action(payload.asdict(), self.driver)
+        except Exception as err:  # pylint: disable=broad-except
+            # one failing payload must not stop the release of the others
+            self.logger.error(
+                'Could not process reason=%s payload due for %s',
+                err,
+                payload.reference_date,
+            )
+            self._notify_done('failed')
+            released = False
+        else:
+            if isinstance(result, Result) and not result.success:
+                retry_after = result.headers.get('retry_after')
+                if retry_after is not None and self._hold(payload, message, retry_after):
+                    self._notify_done('deferred')
+                    return
+                self._notify_done('failed')
+                released = False
+            else:
+                self._notify_done('success')
+            self.logger.debug(
+                'Processed payload due for %s result=%s',
+                payload.reference_date,
+                result,
+                extra=SAMPLED,
+            )
+        if message is not None:
+            await self._settle(message, released, payload)
+
+    def _hold(self, payload: Payload, message: typing.Any, retry_after: float) -> bool:
+        """Hold a deferred payload again for `retry_after` seconds, if the wheel spans it."""
+        try:
+            self.wheel.insert(self._tick(time.time() + retry_after), (payload, message))
+        except ValueError:
+            return False
+        return True
+
+    async def _settle(self, message: typing.Any, released: bool, payload: Payload):
+        """Acknowledge the message of a released payload, requeue it otherwise."""
+        try:
+            if released:
+                await message.ack()
+            else:
+                await message.reject(requeue=True)
+        except Exception as err:  # pylint: disable=broad-except
+            # the broker redelivers the message once its channel is closed
+            self.logger.error(
+                'Could not settle the message of payload due for %s reason=%s',
+                payload.reference_date,
+                err,
+            )
+
+    async def listen(self, **kwargs):
+        """Release the payloads as the wheel turns."""
+        self.logger.info(
+            "Engaging timing wheel - Applying (action=%s, driver=%s) to events",
+            self.action.__name__,
+            type(self.driver),
+        )
+        while True:
+            await asyncio.sleep(self.tick_duration)
+            expired = self.wheel.advance(int(time.time() // self.tick_duration))
+            if expired:
+                await asyncio.gather(
+                    *(self._release(payload, message) for payload, message in expired),
+                )
@@ -0,0 +1,77 @@
+"""Tests for payler.backpressure."""
+import pytest
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram
+
+from payler.backpressure import BackpressureController
+from payler.metrics import INSERT_LATENCY, PUBLISH_LATENCY
+
+
+class FakeConsumer:
+    def __init__(self):
+        self.applied = []
+
+    async def apply_pressure(self, state, prefetch_count):
+        self.applied.append((state, prefetch_count))
+
+
+@pytest.mark.asyncio
+async def test_tick():
+    """Ensure consumers are throttled, paused, then resumed with hysteresis."""
+    depth = 0
+
+    async def probe():
+        return depth
+
+    controller = BackpressureController({
+        'max_depth': 100,
+        'max_write_latency': 0,
+        'max_publish_latency': 0,
+        'throttled_prefetch': 5,
+    })
+    consumer = FakeConsumer()
+    controller.consumers.append(consumer)
+    controller.probes.append(probe)
+    states = []
+    for depth in (50, 120, 250, 190, 150, 90, 70):
+        states.append(await controller.tick())
+    assert states == [
+        'open', 'throttled', 'paused', 'paused', 'throttled', 'throttled', 'open',
+    ]
+    assert consumer.applied[-1] == ('open', 5)
+    assert REGISTRY.get_sample_value('payler_spool_depth') == 70
+    assert REGISTRY.get_sample_value('payler_backpressure_state') == 0
+
+
+@pytest.mark.asyncio
+async def test_write_latency():
+    """Ensure the mean write latency of the last interval is a signal."""
+    controller = BackpressureController({'max_write_latency': 0.1, 'max_publish_latency': 0})
+    assert await controller.tick() == 'open'
+    for _ in range(4):
+        INSERT_LATENCY.labels('backpressure').observe(0.3)
+    assert await controller.tick() == 'paused'
+    assert REGISTRY.get_sample_value('payler_backpressure_pressure') == pytest.approx(3)
+    # paused consumers store nothing, the last latency holds while decaying
+    assert await controller.tick() == 'throttled'
+    assert REGISTRY.get_sample_value('payler_backpressure_pressure') == pytest.approx(1.5)
+    assert await controller.tick() == 'open'
+
+
+@pytest.mark.asyncio
+async def test_multiprocess_latency(monkeypatch, tmp_path):
+    """Ensure latencies observed by the other worker processes are a signal."""
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    controller = BackpressureController({'max_write_latency': 0, 'max_publish_latency': 0.1})
+    assert controller._registry is not None
+    # stands for the histograms aggregated from the worker files
+    workers = CollectorRegistry()
+    publish = Histogram(
+        PUBLISH_LATENCY.describe()[0].name,
+        'Publish latency of the workers.',
+        labelnames=['workflow'],
+        registry=workers,
+    )
+    controller._registry = workers
+    assert await controller.tick() == 'open'
+    publish.labels('worker').observe(0.15)
+    assert await controller.tick() == 'throttled'
@@ -1,10 +1,13 @@
 """Tests for payler.broker."""
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime, timedelta, timezone
 import pytest
 
 from payler import config
-from payler.broker import BrokerManager
-from payler.driver import DriverConfiguration
+from payler.broker import BrokerManager, ChannelPool
+from payler.driver import DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.process import spool_messages
 from payler.structs import Payload
 
 
@@ -44,6 +47,124 @@ async def test_store():
     assert delivered.data.body == body
 
 
+@pytest.mark.asyncio
+async def test_store_reuses_channel():
+    """Ensure consecutive publishes borrow the same pooled channel."""
+    reference = datetime.now() + timedelta(seconds=5)
+    payload = Payload(b'sample test', reference, 'source', 'example')
+    broker_url = config.get('BROKER_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        broker_url,
+        None,
+        None,
+        {'channel_pool_size': 2},
+    )
+    manager = await BrokerManager.create(driver_config)
+    for _ in range(5):
+        await manager.process(payload, routing_key=payload.destination)
+    assert manager.channel_pool.created == 1
+
+
+@pytest.mark.asyncio
+async def test_store_confirm():
+    """Ensure confirmed publishes report the broker acknowledgement."""
+    reference = datetime.now() + timedelta(seconds=5)
+    payload = Payload(b'sample test', reference, 'source', 'example')
+    broker_url = config.get('BROKER_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        broker_url,
+        None,
+        None,
+    )
+    manager = await BrokerManager.create(driver_config)
+    results = await asyncio.gather(*(
+        manager.process(payload, routing_key=payload.destination, confirm=True)
+        for _ in range(10)
+    ))
+    assert all(result.success for result in results)
+
+
+class FakeChannel:
+    """Minimal stand-in for an aio_pika channel."""
+    def __init__(self):
+        self.is_closed = False
+        self.prefetch_counts = []
+        self.published = []
+        self.default_exchange = self
+
+    async def close(self):
+        self.is_closed = True
+
+    async def publish(self, message, routing_key):
+        self.published.append(routing_key)
+
+    async def set_qos(self, prefetch_count):
+        self.prefetch_counts.append(prefetch_count)
+
+
+class FakeConnection:
+    """Minimal stand-in for an aio_pika connection."""
+    def __init__(self):
+        self.opened = []
+
+    async def channel(self):
+        channel = FakeChannel()
+        self.opened.append(channel)
+        return channel
+
+
+@pytest.mark.asyncio
+async def test_channel_pool():
+    """Ensure closed or invalidated channels are replaced."""
+    connection = FakeConnection()
+    pool = ChannelPool(connection, 2)
+    async with pool.acquire() as channel:
+        first = channel
+    async with pool.acquire() as channel:
+        assert channel is first
+        channel.is_closed = True
+    async with pool.acquire() as channel:
+        assert channel is not first
+        pool.invalidate()
+    async with pool.acquire() as channel:
+        pass
+    assert len(connection.opened) == 3
+    assert pool.created == 1
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_discard_wakes_up():
+    """Ensure borrowers waiting on a full pool get a channel once one is discarded."""
+    connection = FakeConnection()
+    pool = ChannelPool(connection, 1)
+    borrowing = pool.acquire()
+    async with pool.acquire() as channel:
+        waiting = asyncio.ensure_future(borrowing.__aenter__())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        pool.invalidate()
+    replacement = await asyncio.wait_for(waiting, timeout=0.5)
+    assert replacement is not channel
+    assert channel.is_closed
+    assert pool.created == 1
+    await borrowing.__aexit__(None, None, None)
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_shared():
+    """Ensure shared channels are handed out in turn."""
+    connection = FakeConnection()
+    pool = ChannelPool(connection, 2)
+    async with pool.acquire(shared=True) as first:
+        async with pool.acquire(shared=True) as second:
+            async with pool.acquire(shared=True) as third:
+                assert first is not second
+                assert third is first
+    assert pool.created == 2
+
+
 @pytest.mark.asyncio
 async def configure():
     """Ensure the BrokerManager connects to RabbitMQ."""
@@ -80,3 +201,218 @@ async def test_serve(event_loop):
 
     manager.configure(get_payload)
     assert manager.action is not None
+
+
+class FakeIterator:
+    """Minimal stand-in for an aio_pika queue iterator."""
+    def __init__(self, items):
+        self.items = asyncio.Queue()
+        for item in items:
+            self.items.put_nowait(item)
+
+    async def __anext__(self):
+        return await self.items.get()
+
+
+@pytest.mark.asyncio
+async def test_batches():
+    """Ensure messages are grouped by batch_size or batch_timeout."""
+    driver_config = DriverConfiguration(
+        'test',
+        None,
+        None,
+        None,
+        {'batch_size': 3, 'batch_timeout': 50},
+    )
+    manager = BrokerManager(driver_config)
+    batches = manager._batches(FakeIterator(range(5)))
+    assert await batches.__anext__() == [0, 1, 2]
+    assert await batches.__anext__() == [3, 4]
+
+
+@pytest.mark.asyncio
+async def test_consume_concurrently():
+    """Ensure at most max_concurrency items are handled at the same time."""
+    driver_config = DriverConfiguration(
+        'test',
+        None,
+        None,
+        None,
+        {'max_concurrency': 3},
+    )
+    manager = BrokerManager(driver_config)
+    running = []
+    peak = []
+
+    async def handler(item):
+        running.append(item)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(item)
+
+    async def items():
+        for item in range(10):
+            yield item
+
+    await manager._consume(items(), handler)
+    assert max(peak) == 3
+    assert not running
+
+
+@pytest.mark.asyncio
+async def test_apply_pressure():
+    """Ensure a paused consumer holds its messages and prefetch is restored."""
+    driver_config = DriverConfiguration(
+        'test',
+        None,
+        None,
+        None,
+        {'prefetch_count': 100},
+    )
+    manager = BrokerManager(driver_config)
+    manager.channel = FakeChannel()
+    manager._resumed = asyncio.Event()
+    manager._resumed.set()
+    handled = []
+
+    async def handler(item):
+        handled.append(item)
+
+    async def items():
+        for item in range(3):
+            yield item
+
+    await manager.apply_pressure('paused', 10)
+    consumer = asyncio.ensure_future(manager._consume(items(), handler))
+    await asyncio.sleep(0.01)
+    assert not handled
+    await manager.apply_pressure('throttled', 10)
+    await consumer
+    assert handled == [0, 1, 2]
+    await manager.apply_pressure('open', 10)
+    assert manager.channel.prefetch_counts == [10, 100]
+
+
+class FakeMessage:
+
+    def __init__(self, body=b'data', headers=None):
+        self.body = body
+        self.headers = headers or {}
+        self.outcome = None
+
+    async def ack(self, multiple=False):
+        self.outcome = 'ack'
+
+    async def nack(self, requeue=True):
+        self.outcome = 'requeued' if requeue else 'nack'
+
+    async def reject(self, requeue=False):
+        self.outcome = 'requeued' if requeue else 'rejected'
+
+
+@pytest.mark.asyncio
+async def test_handle():
+    """Ensure stored and invalid messages are acked, unstored ones requeued."""
+    manager = BrokerManager(DriverConfiguration('test', None, None, None))
+    outcomes = []
+    for stored in (True, False, None):
+
+        async def store(message, driver, stored=stored):
+            if stored is None:
+                raise ProcessingError('invalid payload')
+            return Result(stored, {}, None, None)
+
+        manager.configure(store, driver=None)
+        message = FakeMessage()
+        await manager._handle(message)
+        outcomes.append(message.outcome)
+    assert outcomes == ['ack', 'requeued', 'ack']
+
+
+@pytest.mark.asyncio
+async def test_process_jitter():
+    """Ensure the jitter spreads payloads past their due date without delaying late ones."""
+    manager = BrokerManager(DriverConfiguration('test', None, None, None, {'jitter': 500}))
+    connection = FakeConnection()
+    manager.channel_pool = ChannelPool(connection, 1)
+    late = Payload(b'late', datetime.now(timezone.utc) - timedelta(seconds=10), 'source', 'destination')
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    for _ in range(20):
+        assert (await manager.process(late, routing_key='late')).success
+    assert loop.time() - start < 0.5
+    assert connection.opened[0].published == ['late'] * 20
+
+    due = Payload(b'due', datetime.now(timezone.utc) + timedelta(seconds=0.2), 'source', 'destination')
+    start = loop.time()
+    await manager.process(due, routing_key='due')
+    assert 0.15 < loop.time() - start < 0.75
+
+
+@pytest.mark.asyncio
+async def test_process_rate_limit():
+    """Ensure payloads over the limit of their routing key are deferred without waiting."""
+    manager = BrokerManager(DriverConfiguration('test', None, None, None, {
+        'rate_limits': {'slow': {'rate': 1, 'burst': 1}},
+    }))
+    connection = FakeConnection()
+    manager.channel_pool = ChannelPool(connection, 1)
+    payload = Payload(b'data', datetime.now(timezone.utc), 'source', 'destination')
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    assert (await manager.process(payload, routing_key='slow')).success
+    deferred = await manager.process(payload, routing_key='slow')
+    assert not deferred.success
+    assert 0 < deferred.headers['retry_after'] <= 1
+    assert (await manager.process(payload, routing_key='fast')).success
+    assert loop.time() - start < 0.5
+    assert connection.opened[0].published == ['slow', 'fast']
+
+
+@pytest.mark.asyncio
+async def test_handle_batch():
+    """Ensure unstored messages of a batch are requeued, and all of them on errors."""
+    manager = BrokerManager(DriverConfiguration('test', None, None, None))
+    stored = [True, False, True]
+
+    async def store(messages, driver):
+        return [Result(success, {}, None, None) for success in stored]
+
+    manager.configure(store, driver=None)
+    messages = [FakeMessage() for _ in stored]
+    await manager._handle_batch(messages)
+    assert [message.outcome for message in messages] == ['ack', 'requeued', 'ack']
+
+    async def crash(messages, driver):
+        raise ConnectionError('storage is gone')
+
+    manager.configure(crash, driver=None)
+    messages = [FakeMessage() for _ in stored]
+    with pytest.raises(ConnectionError):
+        await manager._handle_batch(messages)
+    assert [message.outcome for message in messages] == ['requeued'] * 3
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_invalid():
+    """Ensure only the invalid messages of a batch are rejected, the others being spooled."""
+    manager = BrokerManager(DriverConfiguration('test', None, None, None))
+    spooled = []
+
+    class Spooler:
+        """Fake spooler."""
+        logger = manager.logger
+
+        async def process_many(self, payloads, **kwargs):
+            spooled.extend(payloads)
+            return [Result(True, {}, payload, None) for payload in payloads]
+
+    manager.configure(spool_messages, driver=Spooler())
+    messages = [
+        FakeMessage(headers={'x-delay': 10}),
+        FakeMessage(headers={'x-delay': 10, 'x-priority': 'high'}),
+        FakeMessage(headers={'x-delay': 10, 'x-priority': 5}),
+    ]
+    await manager._handle_batch(messages)
+    assert [message.outcome for message in messages] == ['ack', 'rejected', 'ack']
+    assert [payload.priority for payload in spooled] == [0, 5]
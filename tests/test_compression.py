@@ -0,0 +1,30 @@
+"""Tests for payler.compression."""
+import pytest
+
+from payler import compression
+from payler.errors import ProcessingError
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'zstd', 'lz4'])
+def test_roundtrip(codec):
+    """Ensure compressed bodies are restored."""
+    pytest.importorskip({'zlib': 'zlib', 'zstd': 'zstandard', 'lz4': 'lz4'}[codec])
+    body = b'{"message": "sampletest hey"}' * 100
+    compressed, name = compression.compress(body, codec)
+    assert name == codec
+    assert len(compressed) < len(body)
+    assert compression.decompress(compressed, name) == body
+
+
+def test_threshold():
+    """Ensure small or non-bytes bodies are left as is."""
+    assert compression.compress(b'small', 'zlib', threshold=1024) == (b'small', None)
+    assert compression.compress({'a': 1}, 'zlib') == ({'a': 1}, None)
+    assert compression.compress(b'body', None) == (b'body', None)
+    assert compression.decompress(b'body', None) == b'body'
+
+
+def test_unknown_codec():
+    """Ensure unknown codecs are refused."""
+    with pytest.raises(ProcessingError):
+        compression.get_codec('brotli')
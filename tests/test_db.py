@@ -1,13 +1,18 @@
 """Tests for payler.db."""
+import asyncio
 import datetime
+import time
 
+import motor.motor_asyncio
 import pendulum
 import pytest
 import pymongo
 
 from payler import config
 from payler.db import SpoolManager
-from payler.driver import DriverConfiguration
+from payler.driver import DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.structs import Payload
 
 
 @pytest.mark.asyncio
@@ -37,12 +42,38 @@ async def test_setup(event_loop):
     manager = SpoolManager(driver_config)
     assert await manager.is_reachable()
 
-    index_name = await manager.setup()
+    index_names = await manager.setup()
     infos = await manager.collection.index_information()
-    assert index_name in infos
+    assert len(index_names) == len(manager.indexes)
+    assert all(name in infos for name in index_names)
 
-    _ = await manager.setup()
-    await manager.collection.drop_index(index_name)
+    assert await manager.setup() == index_names
+    for name in index_names:
+        await manager.collection.drop_index(name)
+
+
+@pytest.mark.asyncio
+async def test_setup_replace(event_loop):
+    """Ensure indexes are matched by keys and options."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_indexes', 'abandoned_ttl': 3600},
+    )
+    manager = SpoolManager(driver_config)
+    await manager.collection.drop()
+    await manager.collection.insert_one({'reference_date': pendulum.now()})
+    legacy = await manager.collection.create_index([('reference_date', pymongo.ASCENDING)])
+
+    index_names = await manager.setup()
+    infos = await manager.collection.index_information()
+    assert infos[legacy]['expireAfterSeconds'] == 3600
+    assert legacy in index_names
+    assert await manager.collection.count_documents({'state': 'pending'}) == 1
+    await manager.collection.drop()
 
 
 @pytest.mark.asyncio
@@ -113,3 +144,587 @@ async def test_search_ready(event_loop, payload):
 
     })
     assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_process_batches(event_loop, payload):
+    """Ensure matured documents are processed and removed by windows."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'batch_size': 2, 'max_concurrency': 2},
+    )
+    manager = SpoolManager(driver_config)
+    payload.reference_date = pendulum.now().subtract(minutes=2)
+    inserted = []
+    for _ in range(3):
+        result = await manager.process(payload)
+        inserted.append(result.data.inserted_id)
+
+    async def accept(document, driver):
+        return document['_id'] in inserted
+
+    manager.configure(accept, driver=None)
+    processed = await manager.process_and_cleanup()
+    assert processed >= 3
+
+    count = await manager.collection.count_documents({'_id': {'$in': inserted}})
+    assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_process_legacy(event_loop, payload):
+    """Ensure documents written without a state by earlier writers are processed."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_legacy'},
+    )
+    manager = SpoolManager(driver_config)
+    await manager.collection.delete_many({})
+    document = manager._document(payload)
+    document['reference_date'] = pendulum.now().subtract(minutes=2)
+    del document['state']
+    inserted = (await manager.collection.insert_one(document)).inserted_id
+
+    async def accept(document, driver):
+        return True
+
+    manager.configure(accept, driver=None)
+    assert await manager.process_and_cleanup() == 1
+    assert await manager.collection.count_documents({'_id': inserted}) == 0
+
+
+@pytest.mark.asyncio
+async def test_process_legacy_since_last_pass(event_loop, payload):
+    """Ensure passes only look for stateless documents matured since the previous one."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_legacy'},
+    ))
+    await manager.collection.delete_many({})
+
+    async def accept(document, driver):
+        return True
+
+    manager.configure(accept, driver=None)
+    assert await manager.process_and_cleanup() == 0
+    for minutes in (0.5, 120):
+        document = manager._document(payload)
+        document['reference_date'] = pendulum.now().subtract(minutes=minutes)
+        del document['state']
+        await manager.collection.insert_one(document)
+    assert await manager.process_and_cleanup() == 1
+    # left to setup, which marks every document
+    assert await manager.collection.count_documents({'state': {'$exists': False}}) == 1
+    await manager.collection.delete_many({})
+
+@pytest.mark.asyncio
+async def test_setup_legacy(event_loop, payload):
+    """Ensure setup backfills the state and priority of documents from earlier writers."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_legacy'},
+    ))
+    await manager.collection.delete_many({})
+    document = manager._document(payload)
+    del document['state']
+    del document['priority']
+    inserted = (await manager.collection.insert_one(document)).inserted_id
+
+    await manager.setup()
+    stored = await manager.collection.find_one({'_id': inserted})
+    assert stored['state'] == 'pending'
+    assert stored['priority'] == 0
+    await manager.collection.delete_many({})
+
+
+@pytest.mark.asyncio
+async def test_process_confirm_mode(event_loop, payload):
+    """Ensure only confirmed documents are removed in confirm_mode."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'batch_size': 4, 'confirm_mode': True},
+    )
+    manager = SpoolManager(driver_config)
+    payload.reference_date = pendulum.now().subtract(minutes=2)
+    confirmed = (await manager.process(payload)).data.inserted_id
+    rejected = (await manager.process(payload)).data.inserted_id
+
+    async def publish(document, driver, confirm=False):
+        assert confirm is True
+        return Result(document['_id'] != rejected, {}, None, None)
+
+    manager.configure(publish, driver=None)
+    await manager.process_and_cleanup()
+
+    assert await manager.collection.count_documents({'_id': confirmed}) == 0
+    assert await manager.collection.count_documents({'_id': rejected}) == 1
+    await manager.collection.delete_one({'_id': rejected})
+
+
+@pytest.mark.asyncio
+async def test_listen_wakeup(event_loop, payload):
+    """Ensure a local insert wakes up the watcher before its sleep_duration."""
+    mongo_url = config.get('MONGODB_URL')
+    watcher = SpoolManager(DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_wakeup', 'sleep_duration': 60},
+    ))
+    spooler = SpoolManager(DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_wakeup'},
+    ))
+    await watcher.collection.delete_many({})
+    processed = asyncio.Event()
+
+    async def release(document, driver):
+        processed.set()
+        return True
+
+    watcher.configure(release, driver=None)
+    task = asyncio.ensure_future(watcher.listen())
+    await asyncio.sleep(0.5)
+
+    payload.reference_date = pendulum.now().add(seconds=1)
+    await spooler.process(payload)
+    await asyncio.wait_for(processed.wait(), timeout=5)
+    task.cancel()
+    await watcher.collection.drop()
+
+
+@pytest.mark.asyncio
+async def test_process_many(event_loop, payload):
+    """Ensure payloads are stored using a single insert_many."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+    )
+    manager = SpoolManager(driver_config)
+    results = await manager.process_many([payload, payload, payload])
+    assert all(result.success for result in results)
+
+    identifiers = [result.data for result in results]
+    assert await manager.collection.count_documents({'_id': {'$in': identifiers}}) == 3
+    await manager.collection.delete_many({'_id': {'$in': identifiers}})
+
+
+@pytest.mark.asyncio
+async def test_claim_ready(event_loop, payload):
+    """Ensure concurrent watchers never claim the same document."""
+    mongo_url = config.get('MONGODB_URL')
+    watchers = [
+        SpoolManager(DriverConfiguration(
+            'test',
+            mongo_url,
+            event_loop,
+            None,
+            {'spool_collection': 'test_claims', 'lease_duration': 60, 'claim_size': 3},
+        ))
+        for _ in range(3)
+    ]
+    await watchers[0].collection.delete_many({})
+    payload.reference_date = pendulum.now().subtract(minutes=2)
+    await watchers[0].process_many([payload] * 20)
+
+    now = pendulum.now()
+    claimed = await asyncio.gather(*(claim_at(watcher, now) for watcher in watchers))
+    identifiers = [identifier for batch in claimed for identifier in batch]
+    assert len(identifiers) == 20
+    assert len(set(identifiers)) == 20
+
+    # expired leases can be claimed again
+    expired = pendulum.now().add(seconds=120)
+    assert len(await claim_at(watchers[0], expired)) == 20
+    await watchers[0].collection.drop()
+
+
+@pytest.mark.asyncio
+async def test_process_deferred_lease(event_loop, payload):
+    """Ensure deferred documents are kept, their lease expiring once they can be retried."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_deferred', 'lease_duration': 60},
+    ))
+    await manager.collection.delete_many({})
+    await manager.setup()
+    payload.reference_date = pendulum.now().subtract(seconds=1)
+    await manager.process(payload)
+
+    async def defer(document, driver):
+        return Result(False, {'retry_after': 1}, None, None)
+
+    manager.configure(defer, None)
+    assert await manager.process_and_cleanup() == 1
+    assert manager._removed == 0
+    document = await manager.collection.find_one({})
+    assert document['lease_expiry'] < datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
+    assert not await claim_at(manager, pendulum.now())
+    assert len(await claim_at(manager, pendulum.now().add(seconds=2))) == 1
+    await manager.collection.drop()
+
+
+async def claim_at(watcher, match_date):
+    """Claim every document ready at `match_date`."""
+    return [doc['_id'] async for doc in watcher._claim_ready(match_date)]
+
+
+@pytest.mark.asyncio
+async def test_shards(event_loop, payload):
+    """Ensure shards split the collection between watchers."""
+    mongo_url = config.get('MONGODB_URL')
+    watchers = [
+        SpoolManager(DriverConfiguration(
+            'test',
+            mongo_url,
+            event_loop,
+            None,
+            {'spool_collection': 'test_shards', 'shard_count': 2, 'shard_index': index},
+        ))
+        for index in range(2)
+    ]
+    await watchers[0].collection.delete_many({})
+    payload.reference_date = pendulum.now().subtract(minutes=2)
+    await watchers[0].process_many([payload] * 20)
+    found = [
+        {doc['_id'] async for doc in watcher._search_ready(pendulum.now())}
+        for watcher in watchers
+    ]
+    assert not found[0] & found[1]
+    assert len(found[0] | found[1]) == 20
+    await watchers[0].collection.drop()
+
+
+@pytest.mark.asyncio
+async def test_process_compression(event_loop, payload):
+    """Ensure large messages are stored compressed along their codec."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'compression': 'zlib', 'compression_threshold': 16},
+    )
+    manager = SpoolManager(driver_config)
+    result = await manager.process(payload)
+    doc = await manager.collection.find_one({'_id': result.data.inserted_id})
+    assert doc['codec'] == 'zlib'
+    assert doc['message'] != payload.message
+    await manager.collection.delete_one({'_id': doc['_id']})
+
+
+@pytest.mark.asyncio
+async def test_search_ready_cursor(event_loop, payload):
+    """Ensure a pass fetches the oldest documents first, up to its cap."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_cursor', 'max_documents_per_cycle': 2},
+    )
+    manager = SpoolManager(driver_config)
+    await manager.collection.delete_many({})
+    now = pendulum.now()
+    for minutes in (1, 3, 2):
+        payload.reference_date = now.subtract(minutes=minutes)
+        await manager.process(payload)
+
+    documents = [doc async for doc in manager._search_ready(now)]
+    assert [doc['reference_date'] for doc in documents] == sorted(
+        doc['reference_date'] for doc in documents
+    )
+    assert len(documents) == 2
+    assert 'shard' not in documents[0]
+
+    manager.configure(lambda document, driver: asyncio.sleep(0, True), driver=None)
+    assert await manager.process_and_cleanup() == 2
+    assert await manager.collection.count_documents({}) == 1
+    await manager.collection.drop()
+
+
+@pytest.mark.asyncio
+async def test_search_ready_priority(event_loop, payload):
+    """Ensure matured documents are released by priority, then reference_date."""
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_priority', 'lease_duration': 60},
+    )
+    manager = SpoolManager(driver_config)
+    await manager.collection.delete_many({})
+    await manager.setup()
+    now = pendulum.now()
+    for minutes, priority in ((1, 0), (3, 0), (2, 5)):
+        payload.reference_date = now.subtract(minutes=minutes)
+        payload.priority = priority
+        await manager.process(payload)
+
+    documents = [doc async for doc in manager._claim_ready(now)]
+    assert [doc['priority'] for doc in documents] == [5, 0, 0]
+    assert documents[1]['reference_date'] < documents[2]['reference_date']
+    await manager.collection.drop()
+
+
+@pytest.mark.asyncio
+async def test_schedule(event_loop, payload):
+    """Ensure only documents due within the horizon are scheduled, and popped once due."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'watch_mode': 'change_stream', 'schedule_horizon': 60},
+    ))
+    manager._synced_at = time.time()
+    now = pendulum.now()
+    manager._plan({'_id': 1, 'reference_date': now.add(seconds=10)})
+    manager._plan({'_id': 2, 'reference_date': now.add(seconds=120)})
+    manager._plan({'_id': 3, 'reference_date': now.subtract(seconds=10)})
+    assert [item for _, item in sorted(manager._schedule)] == [3, 1]
+
+    assert manager._next_scheduled() == now.subtract(seconds=10).timestamp()
+    assert manager._pop_scheduled(now.timestamp()) == [3]
+    assert manager._next_scheduled() == now.add(seconds=10).timestamp()
+    assert len(manager._schedule) == 1
+
+
+def test_watch_mode(event_loop):
+    """Ensure unknown watch modes are refused."""
+    with pytest.raises(ProcessingError):
+        SpoolManager(DriverConfiguration(
+            'test',
+            config.get('MONGODB_URL'),
+            event_loop,
+            None,
+            {'watch_mode': 'tail'},
+        ))
+
+
+def test_change_pipeline(event_loop):
+    """Ensure the change stream leaves the message bodies in the database."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_stream', 'bucket_duration': 60},
+    ))
+    match, project = manager._change_pipeline()
+    assert match['$match']['ns.coll'] == {'$regex': '^test_stream_[0-9]+$'}
+    assert project == {'$project': {'documentKey': True, 'fullDocument.reference_date': True}}
+
+@pytest.mark.asyncio
+async def test_listen_change_stream(event_loop, payload):
+    """Ensure documents inserted by other processes are picked up from the change stream."""
+    mongo_url = config.get('MONGODB_URL')
+    watcher = SpoolManager(DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+        {'spool_collection': 'test_stream', 'sleep_duration': 60, 'watch_mode': 'change_stream'},
+    ))
+    status = await watcher.client.admin.command('isMaster')
+    if 'setName' not in status:
+        pytest.skip('change streams require a replica set')
+    await watcher.collection.delete_many({})
+    processed = asyncio.Event()
+
+    async def release(document, driver):
+        processed.set()
+        return True
+
+    watcher.configure(release, driver=None)
+    task = asyncio.ensure_future(watcher.listen())
+    await asyncio.sleep(0.5)
+
+    # inserted without a local wake up, as another process would
+    payload.reference_date = pendulum.now().add(seconds=1)
+    await watcher.collection.insert_one(watcher._document(payload))
+    await asyncio.wait_for(processed.wait(), timeout=5)
+    task.cancel()
+    await watcher.collection.drop()
+
+
+def test_bucket_start(event_loop):
+    """Ensure payloads are routed to their window, due ones to the current window."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'bucket_duration': 60},
+    ))
+    now = time.time()
+    later = pendulum.from_timestamp(now + 3600)
+    assert manager._bucket_start(later) == int((now + 3600) // 60 * 60)
+    assert manager._bucket_start(pendulum.from_timestamp(now - 3600)) == int(now // 60 * 60)
+
+
+@pytest.mark.asyncio
+async def test_process_buckets(event_loop, payload):
+    """Ensure payloads are stored by time window and drained buckets are dropped."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_buckets', 'bucket_duration': 1},
+    ))
+    for collection, _ in await manager._due_buckets():
+        await collection.drop()
+    processed = []
+
+    async def release(document, driver):
+        processed.append(document['_id'])
+        return True
+
+    manager.configure(release, driver=None)
+    payload.reference_date = pendulum.now()
+    results = await manager.process_many([payload, payload])
+    later = await manager.process(Payload(
+        payload.message,
+        pendulum.now().add(hours=1),
+        payload.source,
+        payload.destination,
+    ))
+    assert results[0].headers['location'] != later.headers['location']
+    assert len(await manager._due_buckets()) == 2
+
+    await asyncio.sleep(1.1)
+    assert await manager.process_and_cleanup() == 2
+    assert len(processed) == 2
+    buckets = await manager._due_buckets()
+    assert [collection.name for collection, _ in buckets] == [later.headers['location']]
+    await buckets[0][0].drop()
+
+
+@pytest.mark.asyncio
+async def test_drain_bucket(event_loop, payload):
+    """Ensure ended buckets are drained without deletes and their failures moved."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_drain', 'bucket_duration': 1, 'bucket_grace': 0},
+    ))
+    for collection, _ in await manager._due_buckets():
+        await collection.drop()
+    processed = []
+
+    async def release(document, driver):
+        processed.append(document['_id'])
+        return len(processed) > 1
+
+    manager.configure(release, driver=None)
+    payload.reference_date = pendulum.now()
+    results = await manager.process_many([payload, payload])
+    ended = results[0].headers['location']
+
+    await asyncio.sleep(1.1)
+    assert await manager.process_and_cleanup() == 2
+    buckets = await manager._due_buckets()
+    assert ended not in [collection.name for collection, _ in buckets]
+    remaining = [await collection.find_one() for collection, _ in buckets]
+    assert [document['_id'] for document in remaining if document] == processed[:1]
+    for collection, _ in buckets:
+        await collection.drop()
+
+
+@pytest.mark.asyncio
+async def test_process_unreachable(event_loop, payload):
+    """Ensure payloads are not stored, rather than lost, when the database is down."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_unreachable'},
+    ))
+    client = motor.motor_asyncio.AsyncIOMotorClient(
+        'mongodb://localhost:1/payler',
+        serverSelectionTimeoutMS=100,
+        io_loop=event_loop,
+    )
+    manager.collection = client.get_default_database()['test_unreachable']
+    results = await manager.process_many([payload, payload])
+    assert [result.success for result in results] == [False, False]
+    assert not (await manager.process(payload)).success
+
+
+@pytest.mark.asyncio
+async def test_drain_bucket_resume(event_loop, payload):
+    """Ensure a drain resumes after the last released document once its cursor is lost."""
+    manager = SpoolManager(DriverConfiguration(
+        'test',
+        config.get('MONGODB_URL'),
+        event_loop,
+        None,
+        {'spool_collection': 'test_resume', 'bucket_duration': 1, 'bucket_grace': 0,
+         'cursor_batch_size': 1},
+    ))
+    for collection, _ in await manager._due_buckets():
+        await collection.drop()
+    processed = []
+
+    async def release(document, driver):
+        processed.append(document['_id'])
+        return True
+
+    manager.configure(release, driver=None)
+    payload.reference_date = pendulum.now()
+    await manager.process_many([payload, payload, payload])
+    await asyncio.sleep(1.1)
+    (collection, _), = await manager._due_buckets()
+    assert await manager._drain_bucket(collection, limit=1) == 1
+    # a restarted watcher
+    manager._drains.clear()
+    assert await manager._drain_bucket(collection) == 2
+    assert len(set(processed)) == 3
+    assert await manager._due_buckets() == []
+    assert await manager._drain_progress.count_documents({}) == 0
+
+
+def test_drain_query():
+    """Ensure drains resume after the last released document, by release order."""
+    assert SpoolManager._drain_query(None) == {'state': 'pending'}
+    progress = {'priority': 1, 'reference_date': datetime.datetime(2021, 1, 1), 'last_id': 7}
+    branches = SpoolManager._drain_query(progress)['$or']
+    assert branches[0]['priority'] == {'$lt': 1}
+    assert branches[1]['reference_date'] == {'$gt': progress['reference_date']}
+    assert branches[2]['_id'] == {'$gt': 7}
@@ -0,0 +1,50 @@
+"""Tests for payler.logs."""
+import json
+import logging
+import logging.handlers
+import sys
+
+from payler import logs
+
+
+def test_json_formatter():
+    """Ensure records are formatted as JSON lines."""
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'stored id=%s', (3,), None)
+    document = json.loads(logs.JSONFormatter().format(record))
+    assert document['level'] == 'INFO'
+    assert document['logger'] == 'test'
+    assert document['message'] == 'stored id=3'
+
+
+def test_sampling_filter():
+    """Ensure only the sampled records are dropped."""
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'message', (), None)
+    sampled = logging.LogRecord('test', logging.INFO, __file__, 1, 'message', (), None)
+    sampled.sampled = True
+    assert logs.SamplingFilter(0).filter(record)
+    assert not logs.SamplingFilter(0).filter(sampled)
+    assert logs.SamplingFilter(1).filter(sampled)
+
+
+def test_build_logger(monkeypatch):
+    """Ensure loggers enqueue their records from the configured level."""
+    monkeypatch.setenv('LOG_LEVEL', 'warning')
+    logger = logs.build_logger('test_build_logger')
+    assert logger.level == logging.WARNING
+    assert isinstance(logger.handlers[0], logging.handlers.QueueHandler)
+    assert logs.build_logger('test_build_logger') is logger
+    assert len(logger.handlers) == 1
+
+
+def test_queue_handler_prepare():
+    """Ensure enqueued records hold their message and traceback as text."""
+    try:
+        raise ValueError('invalid')
+    except ValueError:
+        record = logging.LogRecord(
+            'test', logging.ERROR, __file__, 1, 'failed id=%s', (3,), sys.exc_info(),
+        )
+    prepared = logs.QueueHandler(None).prepare(record)
+    assert prepared.msg == 'failed id=3'
+    assert prepared.exc_info is None
+    assert 'ValueError: invalid' in json.loads(logs.JSONFormatter().format(prepared))['exception']
@@ -3,10 +3,12 @@ import pendulum
 import pymongo
 import pytest
 from aio_pika import Message
+from prometheus_client import REGISTRY
 
-from payler import config, process
+from payler import compression, config, process
 from payler.db import SpoolManager
 from payler.driver import DriverConfiguration
+from payler.errors import ProcessingError
 
 
 @pytest.mark.asyncio
@@ -41,3 +43,86 @@ async def test_spool_message(event_loop, monkeypatch):
     ref = result.payload.reference_date
     expected_ref = now.add(microseconds=int(delay) * 1_000)
     assert ref == expected_ref
+
+
+@pytest.mark.asyncio
+async def test_spool_messages(event_loop):
+    """Ensure a batch of messages is spooled at once."""
+    messages = [
+        Message(f'data-{index}'.encode(), headers={'x-delay': '10000'})
+        for index in range(3)
+    ]
+    mongo_url = config.get('MONGODB_URL')
+    driver_config = DriverConfiguration(
+        'test',
+        mongo_url,
+        event_loop,
+        None,
+    )
+    manager = SpoolManager(driver_config)
+    results = await process.spool_messages(messages, manager)
+    assert [result.payload.message for result in results] == [
+        message.body for message in messages
+    ]
+    await manager.collection.delete_many({'_id': {'$in': [result.data for result in results]}})
+
+
+@pytest.mark.asyncio
+async def test_send_message_back_decompress():
+    """Ensure compressed documents are re-injected decompressed."""
+    body = b'data' * 1000
+    compressed, codec = compression.compress(body, 'zlib')
+    document = {
+        'message': compressed,
+        'codec': codec,
+        'reference_date': pendulum.now(),
+        'source': 'source',
+        'destination': 'destination',
+    }
+
+    class Output:
+        """Fake output driver."""
+        workflow = 'test'
+
+        async def process(self, payload, **kwargs):
+            return payload
+
+    payload = await process.send_message_back(document, Output())
+    assert payload.message == body
+    assert payload.priority == 0
+
+
+def test_build_payload_priority():
+    """Ensure the x-priority header is kept along the payload."""
+    message = Message(b'data', headers={'x-delay': 10, 'x-priority': '5'})
+    assert process.build_payload(message).priority == 5
+    message = Message(b'data', headers={'x-delay': 10})
+    assert process.build_payload(message).priority == 0
+    message = Message(b'data', headers={'x-delay': 10, 'x-priority': 'urgent'})
+    with pytest.raises(ProcessingError):
+        process.build_payload(message)
+    with pytest.raises(ProcessingError):
+        process.build_payload(Message(b'data', headers={}))
+
+
+@pytest.mark.asyncio
+async def test_send_message_back_lateness():
+    """Ensure the re-injection lateness is observed for the workflow."""
+    document = {
+        'message': b'data',
+        'reference_date': pendulum.now().subtract(seconds=2),
+        'source': 'source',
+        'destination': 'destination',
+    }
+
+    class Output:
+        """Fake output driver."""
+        workflow = 'lateness'
+
+        async def process(self, payload, **kwargs):
+            return payload
+
+    await process.send_message_back(document, Output())
+    labels = {'workflow': 'lateness'}
+    assert REGISTRY.get_sample_value('payler_reinjection_lateness_seconds_count', labels) == 1
+    assert REGISTRY.get_sample_value('payler_reinjection_lateness_seconds_sum', labels) >= 2
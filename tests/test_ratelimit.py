@@ -0,0 +1,49 @@
+"""Tests for payler.ratelimit."""
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from payler.ratelimit import RateLimiter, TokenBucket
+
+
+def test_token_bucket():
+    """Ensure bursts are allowed and later acquisitions are told when to retry."""
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take(0) == 0
+    assert bucket.take(0) == 0
+    assert bucket.take(0) == pytest.approx(0.1)
+    assert bucket.take(0.05) == pytest.approx(0.05)
+    assert bucket.take(0.1) == 0
+    assert bucket.take(1) == 0
+    assert bucket.tokens == 1
+
+
+def test_limits_by_routing_key():
+    """Ensure routing keys use their own limits, or the default ones."""
+    limiter = RateLimiter(
+        {'rate': 0, 'burst': 1, 'jitter': 0},
+        {'slow': {'rate': 5, 'burst': 10}},
+    )
+    assert limiter.bucket('fast') is None
+    assert limiter.bucket('slow').rate == 5
+    assert limiter.bucket('slow').burst == 10
+    assert limiter.bucket('slow') is limiter.bucket('slow')
+
+
+@pytest.mark.asyncio
+async def test_acquire():
+    """Ensure payloads over the limit are deferred at once and counted."""
+    limiter = RateLimiter({'rate': 50, 'burst': 1, 'jitter': 0}, workflow='test')
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    delays = [await limiter.acquire('payloads') for _ in range(3)]
+    assert loop.time() - start < 0.01
+    assert delays[0] == 0
+    assert 0 < delays[1] <= 0.02
+    assert 0 < delays[2] <= 0.02
+    assert await limiter.acquire('others') == 0
+    labels = {'workflow': 'test', 'routing_key': 'payloads'}
+    assert REGISTRY.get_sample_value('payler_throttled_payloads_total', labels) == 2
+    await asyncio.sleep(delays[2])
+    assert await limiter.acquire('payloads') == 0
@@ -0,0 +1,141 @@
+"""Tests for payler.redis."""
+import asyncio
+
+import fakeredis.aioredis
+import pendulum
+import pytest
+
+from payler.driver import DriverConfiguration
+from payler.errors import ProcessingError
+from payler.process import send_message_back
+from payler.redis import RedisManager
+from payler.structs import Payload
+
+
+def build_manager(**extra):
+    manager = RedisManager(DriverConfiguration(
+        'test', 'redis://localhost:6379/0', None, None, extra,
+    ))
+    manager.client = fakeredis.aioredis.FakeRedis()
+    return manager
+
+
+@pytest.mark.asyncio
+async def test_process(payload):
+    """Ensure payloads are scored by their reference_date."""
+    manager = build_manager()
+    assert await manager.is_reachable()
+    result = await manager.process(payload)
+    assert result.success
+    score = await manager.client.zscore(manager.schedule_key, result.data)
+    assert score == int(payload.reference_date.timestamp() * 1000)
+    assert await manager.client.hget(manager.payload_prefix + result.data, 'message') == \
+        payload.message
+
+
+@pytest.mark.asyncio
+async def test_process_and_cleanup(payload):
+    """Ensure matured payloads are sent back and removed, failed ones are rescheduled."""
+    manager = build_manager(compression='zlib', compression_threshold=0, claim_size=2)
+    payload.reference_date = pendulum.now().subtract(seconds=1)
+    await manager.process_many([payload, payload, payload])
+    later = pendulum.now().add(hours=1)
+    await manager.process(type(payload)(payload.message, later, 'source', 'destination'))
+    sent = []
+
+    class Output:
+        workflow = 'test'
+
+        async def process(self, payload, **kwargs):
+            sent.append(payload)
+            if len(sent) == 2:
+                raise ProcessingError('unavailable')
+            return True
+
+    manager.configure(send_message_back, Output())
+    assert await manager.process_and_cleanup() == 3
+    assert [item.message for item in sent] == [payload.message] * 3
+    assert await manager.client.zcard(manager.schedule_key) == 2
+    assert await manager.client.zcard(manager.processing_key) == 0
+    assert len(await manager.client.keys(manager.payload_prefix + '*')) == 2
+
+
+@pytest.mark.asyncio
+async def test_claim_expired(payload):
+    """Ensure payloads claimed by a stopped watcher are claimed again after their lease."""
+    manager = build_manager(lease_duration=0.1)
+    payload.reference_date = pendulum.now()
+    await manager.process(payload)
+    assert len(await manager._claim_ready(10)) == 1
+    assert await manager._claim_ready(10) == []
+
+    await asyncio.sleep(0.2)
+    assert len(await manager._claim_ready(10)) == 1
+    assert await manager.depth() == 1
+
+
+@pytest.mark.asyncio
+async def test_listen_wakeup(payload):
+    """Ensure a local insert wakes up the watcher before its sleep_duration."""
+    watcher = build_manager(sleep_duration=60)
+    spooler = build_manager()
+    spooler.client = watcher.client
+    processed = asyncio.Event()
+
+    async def release(document, driver):
+        processed.set()
+        return True
+
+    watcher.configure(release, driver=None)
+    task = asyncio.ensure_future(watcher.listen())
+    await asyncio.sleep(0.2)
+
+    payload.reference_date = pendulum.now().add(seconds=1)
+    await spooler.process(payload)
+    await asyncio.wait_for(processed.wait(), timeout=5)
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_claim_by_priority(payload):
+    """Ensure the payloads of a claim are returned by priority."""
+    manager = build_manager()
+    now = pendulum.now()
+    await manager.process_many([
+        Payload(b'early', now.subtract(seconds=2), 'source', 'destination'),
+        Payload(b'urgent', now.subtract(seconds=1), 'source', 'destination', 5),
+    ])
+    claimed = await manager._claim_ready(10)
+    assert [doc['message'] for doc in claimed] == [b'urgent', b'early']
+
+
+@pytest.mark.asyncio
+async def test_listen_failed_cycle(payload):
+    """Ensure a capped pass which removed nothing waits before the next pass."""
+    manager = build_manager(sleep_duration=60, max_documents_per_cycle=1)
+    payload.reference_date = pendulum.now().subtract(seconds=1)
+    await manager.process(payload)
+    attempts = []
+
+    async def fail(document, driver):
+        attempts.append(document)
+        raise ProcessingError('unavailable')
+
+    manager.configure(fail, driver=None)
+    task = asyncio.ensure_future(manager.listen())
+    await asyncio.sleep(0.2)
+    task.cancel()
+    assert len(attempts) == 1
+    assert await manager.depth() == 1
+
+
+@pytest.mark.asyncio
+async def test_process_unavailable(payload):
+    """Ensure payloads are reported as failed, not dropped, while Redis is down."""
+    manager = build_manager()
+    server = fakeredis.FakeServer()
+    server.connected = False
+    manager.client = fakeredis.aioredis.FakeRedis(server=server)
+    results = await manager.process_many([payload, payload])
+    assert [result.success for result in results] == [False, False]
+    assert not (await manager.process(payload)).success
@@ -1,6 +1,12 @@
 """Test runtime-related operations."""
 import asyncio
+import functools
 import importlib
+import multiprocessing
+import os
+import signal
+import threading
+import time
 from unittest.mock import MagicMock
 import pytest
 
@@ -53,3 +59,158 @@ def test_register_workflows(event_loop):
     workflow = runtime.register_workflows([workflow_config], event_loop)
     assert workflow[0].name == workflow_config['name']
     assert callable(workflow[0].action)
+
+
+def test_register_workflows_options(event_loop):
+    """Ensure the driver options are passed to the workflow callable."""
+    workflow_config = {
+        'name': 'Consumer broker payloads',
+        'callable': 'client.process_queue',
+        'input': {'prefetch_count': 10, 'max_concurrency': 4},
+    }
+    workflow = runtime.register_workflows([workflow_config], event_loop)[0]
+    spec = runtime.DriverSpec(options=workflow_config['input'])
+    assert workflow.kwargs == {'input': spec, 'workflow': workflow_config['name']}
+
+    received = {}
+
+    async def action(loop, **kwargs):
+        received.update(kwargs)
+
+    workflow.action = action
+    workflow.register_action()
+    event_loop.run_until_complete(workflow.future)
+    assert received == {'input': spec, 'workflow': workflow_config['name']}
+
+
+def test_register_workflows_drivers(event_loop):
+    """Ensure the declared drivers are validated when registering workflows."""
+    workflow_config = {
+        'callable': 'client.watch_storage',
+        'input': {'driver': 'sqlite', 'url': 'sqlite:///:memory:', 'sleep_duration': 5},
+    }
+    workflow = runtime.register_workflows([workflow_config], event_loop)[0]
+    assert workflow.kwargs['input'] == runtime.DriverSpec(
+        'sqlite', 'sqlite:///:memory:', {'sleep_duration': 5},
+    )
+
+    workflow_config['input'] = {'driver': 'cassandra'}
+    with pytest.raises(ProcessingError):
+        runtime.register_workflows([workflow_config], event_loop)
+
+
+def test_register_workflows_in_memory_batches(event_loop):
+    """Ensure in-memory workflows refuse batched inputs."""
+    workflow_config = {
+        'callable': 'client.process_queue_in_memory',
+        'input': {'batch_size': 10},
+    }
+    with pytest.raises(ProcessingError):
+        runtime.register_workflows([workflow_config], event_loop)
+    with pytest.raises(ProcessingError):
+        runtime.Supervisor([dict(workflow_config, replicas=2)])
+
+
+@pytest.mark.asyncio
+async def test_driver_spec_build(event_loop):
+    """Ensure drivers are built with their options, or the default driver."""
+    spec = runtime.driver_spec({'driver': 'sqlite', 'url': 'sqlite:///:memory:', 'table': 'spool'})
+    storage = await spec.build('test', event_loop, None, 'mongodb', 'spooling')
+    assert type(storage).__name__ == 'SQLiteManager'
+    assert storage.workflow == 'spooling'
+    assert storage.table == 'spool'
+    assert storage.sleep_duration == storage.DEFAULTS['sleep_duration']
+
+    wheel = await runtime.driver_spec(None).build('test', event_loop, None, 'wheel')
+    assert type(wheel).__name__ == 'WheelManager'
+
+
+def test_has_replicas():
+    """Ensure workflows asking for replicas are detected."""
+    assert not runtime.has_replicas([{'callable': 'client.process_queue'}])
+    assert runtime.has_replicas([{'callable': 'client.process_queue', 'replicas': 2}])
+
+
+def exit_worker(item):
+    """Worker exiting right away."""
+
+
+def test_supervisor_restart():
+    """Ensure exited workers are restarted."""
+    workflow_config = [{'name': 'exiting', 'replicas': 2}]
+    supervisor = runtime.Supervisor(workflow_config, context='fork', target=exit_worker)
+    assert len(supervisor.replicas) == 2
+    supervisor.start()
+    for replica in supervisor.replicas:
+        replica.process.join()
+    assert supervisor.check() == 2
+    assert all(replica.restarts == 1 for replica in supervisor.replicas)
+    supervisor.stop()
+
+
+def test_supervisor_backoff():
+    """Ensure workers crashing again are restarted after a growing delay."""
+    workflow_config = [{'name': 'exiting'}]
+    supervisor = runtime.Supervisor(
+        workflow_config, context='fork', target=exit_worker, backoff=0.2, max_backoff=1,
+    )
+    supervisor.start()
+    replica = supervisor.replicas[0]
+    replica.process.join()
+    assert supervisor.check() == 1
+    replica.process.join()
+    assert supervisor.check() == 0
+    time.sleep(0.25)
+    assert supervisor.check() == 1
+    replica.process.join()
+    assert supervisor.check() == 0
+    assert replica.retry_at - time.monotonic() > 0.3
+    supervisor.stop()
+
+
+def record_worker(item, queue):
+    """Worker reporting the entry it runs."""
+    queue.put(item)
+
+
+def test_supervisor_shards():
+    """Ensure replicas of a sharded spool watch their own shard."""
+    workflow_config = [{
+        'name': 'watching',
+        'callable': 'client.watch_storage',
+        'replicas': 2,
+        'input': {'shard_count': 2},
+    }]
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    supervisor = runtime.Supervisor(
+        workflow_config, context='fork', target=functools.partial(record_worker, queue=queue),
+    )
+    supervisor.start()
+    indexes = sorted(queue.get(timeout=5)['input']['shard_index'] for _ in range(2))
+    assert indexes == [0, 1]
+    supervisor.stop()
+
+    workflow_config[0]['input'] = {}
+    with pytest.raises(ProcessingError):
+        runtime.Supervisor(workflow_config)
+    workflow_config[0]['input'] = {'lease_duration': 30}
+    assert len(runtime.Supervisor(workflow_config).replicas) == 2
+
+
+def sleep_worker(item):
+    """Worker running until terminated."""
+    time.sleep(60)
+
+
+def test_supervisor_sigterm():
+    """Ensure SIGTERM stops the workers along the supervisor."""
+    supervisor = runtime.Supervisor(
+        [{'name': 'sleeping', 'replicas': 2}], context='fork', target=sleep_worker,
+    )
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    with pytest.raises(SystemExit):
+        supervisor.run(check_interval=0.1)
+    assert all(not replica.process.is_alive() for replica in supervisor.replicas)
+    assert signal.getsignal(signal.SIGTERM) is signal.SIG_DFL
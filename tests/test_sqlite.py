@@ -0,0 +1,265 @@
+"""Tests for payler.sqlite."""
+import asyncio
+import sqlite3
+import time
+
+import pendulum
+import pytest
+from prometheus_client import REGISTRY
+
+from payler.driver import DriverConfiguration, Result
+from payler.errors import ProcessingError
+from payler.process import send_message_back
+from payler.sqlite import SQLiteManager
+from payler.structs import Payload
+
+
+@pytest.fixture
+def spool_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'spool.db'}"
+
+
+@pytest.mark.asyncio
+async def test_setup(spool_url):
+    """Ensure the table is created in WAL mode."""
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None))
+    assert await manager.is_reachable()
+    assert await manager.setup() == 0
+    assert manager.connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+
+
+@pytest.mark.asyncio
+async def test_process_before_setup(spool_url, payload):
+    """Ensure a writer stores payloads before any watcher ran setup."""
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None))
+    result = await manager.process(payload)
+    assert result.success
+    count = manager.connection.execute('SELECT COUNT(*) FROM payloads').fetchone()
+    assert count == (1,)
+
+
+@pytest.mark.asyncio
+async def test_process_commits_together(spool_url, payload):
+    """Ensure concurrent payloads are committed by groups of commit_size."""
+    manager = SQLiteManager(DriverConfiguration(
+        'test', spool_url, None, None, {'commit_size': 3, 'commit_interval': 1000},
+    ))
+    await manager.setup()
+    results = await asyncio.wait_for(
+        asyncio.gather(*(manager.process(payload) for _ in range(3))),
+        timeout=0.5,
+    )
+    assert [result.data for result in results] == [1, 2, 3]
+
+    result = await manager.process(payload)
+    assert result.success
+
+
+@pytest.mark.asyncio
+async def test_process_and_cleanup(spool_url, payload):
+    """Ensure matured payloads are sent back and removed, failed ones are kept."""
+    manager = SQLiteManager(DriverConfiguration(
+        'test', spool_url, None, None, {'commit_interval': 1, 'compression': 'zlib',
+                                        'compression_threshold': 0},
+    ))
+    await manager.setup()
+    payload.reference_date = pendulum.now().subtract(seconds=1)
+    await manager.process_many([payload, payload])
+    await manager.process(payload)
+    sent = []
+
+    class Output:
+        workflow = 'test'
+
+        async def process(self, payload, **kwargs):
+            sent.append(payload)
+            if len(sent) == 2:
+                raise ProcessingError('unavailable')
+            return True
+
+    manager.configure(send_message_back, Output())
+    assert await manager.process_and_cleanup() == 3
+    assert [item.message for item in sent] == [payload.message] * 3
+    count = manager.connection.execute('SELECT COUNT(*) FROM payloads').fetchone()
+    assert count == (1,)
+
+
+@pytest.mark.asyncio
+async def test_recovery(spool_url, payload):
+    """Ensure payloads claimed by a stopped process are recovered once their lease expired."""
+    config = {'lease_duration': 0.1}
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None, config))
+    await manager.setup()
+    payload.reference_date = pendulum.now()
+    await manager.process_many([payload])
+    assert len(await manager._run(manager._claim, pendulum.now().timestamp())) == 1
+
+    restarted = SQLiteManager(DriverConfiguration('test', spool_url, None, None, config))
+    assert await restarted.setup() == 0
+    assert await restarted._run(restarted._claim, pendulum.now().timestamp()) == []
+
+    await asyncio.sleep(0.2)
+    assert len(await restarted._run(restarted._claim, pendulum.now().timestamp())) == 1
+    await asyncio.sleep(0.2)
+    assert await restarted.setup() == 1
+    assert await restarted.depth() == 1
+
+
+@pytest.mark.asyncio
+async def test_process_unavailable(spool_url, payload):
+    """Ensure payloads are reported as failed, not dropped, when they cannot be written."""
+    manager = SQLiteManager(DriverConfiguration(
+        'test', spool_url, None, None, {'commit_interval': 1},
+    ))
+    await manager.setup()
+    manager.connection.execute('DROP TABLE payloads')
+    assert not (await manager.process(payload)).success
+    results = await manager.process_many([payload, payload])
+    assert [result.success for result in results] == [False, False]
+
+
+@pytest.mark.asyncio
+async def test_listen_wakeup(spool_url, payload):
+    """Ensure a local insert wakes up the watcher before its sleep_duration."""
+    config = {'sleep_duration': 60, 'commit_interval': 1}
+    watcher = SQLiteManager(DriverConfiguration('test', spool_url, None, None, config))
+    spooler = SQLiteManager(DriverConfiguration('test', spool_url, None, None, config))
+    await watcher.setup()
+    processed = asyncio.Event()
+
+    async def release(document, driver):
+        processed.set()
+        return True
+
+    watcher.configure(release, driver=None)
+    task = asyncio.ensure_future(watcher.listen())
+    await asyncio.sleep(0.2)
+
+    payload.reference_date = pendulum.now().add(seconds=1)
+    await spooler.process(payload)
+    await asyncio.wait_for(processed.wait(), timeout=5)
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_listen_deferred(spool_url, payload):
+    """Ensure deferred payloads are kept and retried before the sleep_duration."""
+    config = {'sleep_duration': 60, 'commit_interval': 1}
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None, config, 'deferring'))
+    await manager.setup()
+    payload.reference_date = pendulum.now()
+    await manager.process(payload)
+    attempts = []
+    released = asyncio.Event()
+
+    async def release(document, driver):
+        attempts.append(time.time())
+        if len(attempts) == 1:
+            return Result(False, {'retry_after': 0.2}, None, None)
+        released.set()
+        return Result(True, {}, None, None)
+
+    manager.configure(release, driver=None)
+    task = asyncio.ensure_future(manager.listen())
+    await asyncio.wait_for(released.wait(), timeout=5)
+    await asyncio.sleep(0.1)
+    task.cancel()
+    assert attempts[1] - attempts[0] >= 0.2
+    assert await manager.depth() == 0
+    labels = {'workflow': 'deferring', 'status': 'deferred'}
+    assert REGISTRY.get_sample_value('payler_workflow_jobs_total', labels) == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics(spool_url, payload):
+    """Ensure insert latency and failed or kept jobs are reported for the workflow."""
+    manager = SQLiteManager(DriverConfiguration(
+        'test', spool_url, None, None, {'commit_interval': 1}, 'sqlite-metrics',
+    ))
+    await manager.setup()
+    payload.reference_date = pendulum.now()
+    await manager.process(payload)
+    labels = {'workflow': 'sqlite-metrics'}
+    assert REGISTRY.get_sample_value('payler_storage_insert_seconds_count', labels) == 1
+
+    async def fail(document, driver):
+        raise ProcessingError('unavailable')
+
+    manager.configure(fail, None)
+    await manager.process_and_cleanup()
+    labels['status'] = 'failed'
+    assert REGISTRY.get_sample_value('payler_workflow_jobs_total', labels) == 1
+
+    async def keep(document, driver):
+        return None
+
+    manager.configure(keep, None)
+    await manager.process_and_cleanup()
+    assert REGISTRY.get_sample_value('payler_workflow_jobs_total', labels) == 2
+    assert await manager.depth() == 1
+
+
+@pytest.mark.asyncio
+async def test_claim_by_priority(spool_url, payload):
+    """Ensure matured payloads are claimed by priority, then reference_date."""
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None))
+    now = pendulum.now()
+    payloads = [
+        Payload(b'late', now.subtract(seconds=1), 'source', 'destination'),
+        Payload(b'early', now.subtract(seconds=3), 'source', 'destination'),
+        Payload(b'urgent', now.subtract(seconds=2), 'source', 'destination', 5),
+    ]
+    await manager.process_many(payloads)
+    claimed = await manager._run(manager._claim, now.timestamp())
+    assert [doc['message'] for doc in claimed] == [b'urgent', b'early', b'late']
+    assert [doc['priority'] for doc in claimed] == [5, 0, 0]
+
+
+def test_add_priority_column(tmp_path):
+    """Ensure tables created without the priority column are upgraded."""
+    path = tmp_path / 'spool.db'
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE payloads (id INTEGER PRIMARY KEY AUTOINCREMENT, message BLOB NOT NULL, '
+        'reference_date REAL NOT NULL, source TEXT NOT NULL, destination TEXT NOT NULL, '
+        "codec TEXT, state TEXT NOT NULL DEFAULT 'pending')",
+    )
+    connection.close()
+    manager = SQLiteManager(DriverConfiguration('test', f'sqlite:///{path}', None, None))
+    columns = [row[1] for row in manager._connect().execute('PRAGMA table_info(payloads)')]
+    assert 'priority' in columns
+
+
+@pytest.mark.asyncio
+async def test_listen_after_failure(spool_url, payload):
+    """Ensure a payload left behind by a pass does not delay the next due one."""
+    config = {'sleep_duration': 60, 'commit_interval': 1}
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None, config))
+    await manager.setup()
+    payload.reference_date = pendulum.now().subtract(seconds=1)
+    left = await manager.process(payload)
+    payload.reference_date = pendulum.now().add(microseconds=300000)
+    await manager.process(payload)
+    released = asyncio.Event()
+
+    async def release(document, driver):
+        if document['_id'] == left.data:
+            raise ProcessingError('unavailable')
+        released.set()
+        return True
+
+    manager.configure(release, driver=None)
+    task = asyncio.ensure_future(manager.listen())
+    await asyncio.wait_for(released.wait(), timeout=5)
+    task.cancel()
+
+
+def test_wake_up(spool_url):
+    """Ensure watchers are only woken up by payloads due before their planned wake up."""
+    manager = SQLiteManager(DriverConfiguration('test', spool_url, None, None))
+    manager._wakeup = asyncio.Event()
+    manager._wake_at = time.time() + 10
+    manager.wake_up(time.time() + 20)
+    assert not manager._wakeup.is_set()
+    manager.wake_up(time.time() + 1)
+    assert manager._wakeup.is_set()
@@ -13,5 +13,18 @@ def test_payload(base_payload, time_1, payload):
         'destination': 'destination_queue',
         'message': base_payload,
         'reference_date': time_1 + timedelta(seconds=5),
+        'priority': 0,
     }
     assert asdict(payload) == expected
+
+
+def test_payload_asdict(payload):
+    """Ensure the dictionary representation shares the message."""
+    document = payload.asdict()
+    assert document == asdict(payload)
+    assert document['message'] is payload.message
+
+
+def test_payload_slots(payload):
+    """Ensure Payload instances do not carry a __dict__."""
+    assert not hasattr(payload, '__dict__')
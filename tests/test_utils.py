@@ -0,0 +1,30 @@
+"""Tests for payler.utils."""
+import asyncio
+import importlib
+
+import pytest
+
+from payler import utils
+
+
+def test_event_loop_asyncio():
+    """Ensure the default asyncio policy can be requested."""
+    assert utils.install_event_loop_policy('asyncio') == 'asyncio'
+
+
+def test_event_loop_unknown():
+    """Ensure unknown event loops are refused."""
+    with pytest.raises(RuntimeError):
+        utils.install_event_loop_policy('trio')
+
+
+def test_event_loop_fallback(monkeypatch):
+    """Ensure `auto` falls back to asyncio when uvloop is missing."""
+    def missing(name):
+        raise ImportError(name)
+
+    monkeypatch.setattr(importlib, 'import_module', missing)
+    assert utils.install_event_loop_policy('auto') == 'asyncio'
+    with pytest.raises(RuntimeError):
+        utils.install_event_loop_policy('uvloop')
+    assert isinstance(asyncio.get_event_loop_policy(), asyncio.DefaultEventLoopPolicy)
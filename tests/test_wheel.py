@@ -0,0 +1,162 @@
+"""Tests for payler.wheel."""
+import asyncio
+import random
+import time
+
+import pendulum
+import pytest
+
+from payler.driver import DriverConfiguration, Result
+from payler.structs import Payload
+from payler.wheel import TimingWheel, WheelManager
+
+
+def test_timing_wheel_expiry():
+    """Ensure entries expire on their tick, including across levels."""
+    wheel = TimingWheel(size=4, levels=3)
+    ticks = [1, 3, 4, 5, 17, 40, 63]
+    for tick in ticks:
+        wheel.insert(tick, tick)
+    for tick in range(1, 64):
+        assert wheel.advance(tick) == ([tick] if tick in ticks else [])
+    assert wheel.count == 0
+
+
+def test_timing_wheel_random():
+    """Ensure no entry expires early nor gets lost."""
+    wheel = TimingWheel(size=8, levels=3, start=100)
+    expected = {}
+    for item in range(200):
+        tick = wheel.current + random.randint(1, 500)
+        wheel.insert(tick, item)
+        expected[item] = tick
+    now = wheel.current
+    while wheel.count:
+        now += random.randint(1, 7)
+        for item in wheel.advance(now):
+            assert expected.pop(item) <= now
+    assert not expected
+
+
+def test_timing_wheel_span():
+    """Ensure entries past the wheel span are refused."""
+    wheel = TimingWheel(size=4, levels=2)
+    with pytest.raises(ValueError):
+        wheel.insert(wheel.span, 'late')
+
+
+class FakeMessage:
+    """Minimal stand-in for an aio_pika incoming message."""
+    def __init__(self):
+        self.acked = False
+        self.requeued = False
+
+    async def ack(self):
+        self.acked = True
+
+    async def reject(self, requeue=False):
+        self.requeued = requeue
+
+
+class ClosedMessage(FakeMessage):
+    """Message whose channel was closed before it could be settled."""
+    async def ack(self):
+        raise ConnectionError('channel is closed')
+
+
+@pytest.mark.asyncio
+async def test_wheel_manager(payload):
+    """Ensure held payloads are released and their message acked afterwards."""
+    manager = WheelManager(DriverConfiguration('test', None, None, None))
+    released = []
+
+    async def release(document, driver):
+        released.append(document)
+        return True
+
+    manager.configure(release, driver=None)
+    message = FakeMessage()
+    payload.reference_date = pendulum.now().add(microseconds=50_000)
+    result = await manager.process(payload, message=message)
+    assert result.headers['deferred_ack'] is True
+    assert not message.acked
+
+    task = asyncio.ensure_future(manager.listen())
+    await asyncio.sleep(0.2)
+    task.cancel()
+    assert released[0]['message'] == payload.message
+    assert message.acked
+
+
+@pytest.mark.asyncio
+async def test_wheel_manager_spooler(payload):
+    """Ensure payloads due after delay_threshold are handed to the spooler."""
+    manager = WheelManager(DriverConfiguration('test', None, None, None))
+    spooled = []
+
+    class Spooler:
+        """Fake spooler."""
+        async def process(self, payload, **kwargs):
+            spooled.append(payload)
+
+    manager.configure(None, driver=None, spooler=Spooler())
+    payload.reference_date = pendulum.now().add(seconds=60)
+    await manager.process(payload, message=FakeMessage())
+    assert spooled == [payload]
+    assert manager.wheel.count == 0
+
+
+@pytest.mark.asyncio
+async def test_wheel_manager_failure(payload):
+    """Ensure failing payloads or acks do not stop the release of the others."""
+    manager = WheelManager(DriverConfiguration('test', None, None, None))
+
+    async def release(document, driver):
+        if document['message'] == b'fail':
+            raise ConnectionError('broker is gone')
+        return True
+
+    manager.configure(release, driver=None)
+    failing, message, closed = FakeMessage(), FakeMessage(), ClosedMessage()
+    payload.reference_date = pendulum.now().add(microseconds=50_000)
+    await manager.process(payload, message=message)
+    await manager.process(payload, message=closed)
+    await manager.process(
+        Payload(b'fail', payload.reference_date, payload.source, payload.destination),
+        message=failing,
+    )
+
+    task = asyncio.ensure_future(manager.listen())
+    await asyncio.sleep(0.2)
+    assert not task.done()
+    task.cancel()
+    assert message.acked
+    assert failing.requeued and not failing.acked
+
+
+@pytest.mark.asyncio
+async def test_wheel_manager_deferred(payload):
+    """Ensure deferred payloads are held again, their message left unacknowledged."""
+    manager = WheelManager(DriverConfiguration('test', None, None, None))
+    attempts = []
+
+    async def release(document, driver):
+        attempts.append(time.time())
+        if len(attempts) == 1:
+            return Result(False, {'retry_after': 0.1}, None, None)
+        return Result(True, {}, None, None)
+
+    manager.configure(release, driver=None)
+    message = FakeMessage()
+    payload.reference_date = pendulum.now().add(microseconds=20_000)
+    await manager.process(payload, message=message)
+
+    task = asyncio.ensure_future(manager.listen())
+    await asyncio.sleep(0.07)
+    assert len(attempts) == 1
+    assert not message.acked and not message.requeued
+    await asyncio.sleep(0.2)
+    task.cancel()
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.1
+    assert message.acked